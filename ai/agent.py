@@ -1,10 +1,12 @@
-import collections
-import random
+import time
 import torch
 import numpy as np
 import torch.nn as nn
 import torch.optim as optim
-from ai.model import Linear_QNetwork, QTrainer
+from ai.model import QTrainer, make_q_network
+from ai.replay import ReplayBuffer, PrioritizedReplayBuffer
+from ai.metrics import PhaseTimer
+from game.encoding import canonical_symmetries, inverse_transform_cells, transform_boards
 
 class DQNAgent:
     def __init__(self, config, reward_function=None, play_mode=False):
@@ -20,60 +22,145 @@ class DQNAgent:
         # The discount factor. See Bellman's equation in ai.model.py.
         self.gamma = config.GAMMA
 
-        self.memory = collections.deque(maxlen=config.MAX_MEMORY)
-        self.batch_size = config.BATCH_SIZE
-
         self.BOARD_SIZE_X = config.BOARD_SIZE_X
         self.BOARD_SIZE_Y = config.BOARD_SIZE_Y    
+
+        # With the canonical replay, the model only learns the canonical orientations, so it acts on them too.
+        self.replay_symmetry = config.REPLAY_SYMMETRY
+        board_size = (self.BOARD_SIZE_X, self.BOARD_SIZE_Y)
+        self.prioritized_replay = config.PRIORITIZED_REPLAY
+        if self.prioritized_replay:
+            self.memory = PrioritizedReplayBuffer(config.MAX_MEMORY, self.BOARD_SIZE_X*self.BOARD_SIZE_Y,
+                                                  alpha=config.PER_ALPHA, epsilon=config.PER_EPSILON,
+                                                  symmetry=self.replay_symmetry, board_size=board_size)
+        else:
+            self.memory = ReplayBuffer(config.MAX_MEMORY, self.BOARD_SIZE_X*self.BOARD_SIZE_Y,
+                                       symmetry=self.replay_symmetry, board_size=board_size)
+        self.batch_size = config.BATCH_SIZE
+        self.batch_buffers = self.memory.new_batch(self.batch_size)
         
-        self.model = Linear_QNetwork(input_size=self.BOARD_SIZE_X*self.BOARD_SIZE_Y + 2, 
-                                     hidden_size=256,
-                                     output_size=self.BOARD_SIZE_X*self.BOARD_SIZE_Y)
+        self.model = make_q_network(config, self.BOARD_SIZE_X, self.BOARD_SIZE_Y)
         
-        self.trainer = QTrainer(self.model, lr=config.LR, gamma=self.gamma)
+        self.trainer = QTrainer(self.model, lr=config.LR, gamma=self.gamma,
+                                compile=config.TORCH_COMPILE and not play_mode)
         self.games_played = self.training_steps_count = 0
+        # Time spent in the phases of train() (see ai/metrics.py).
+        self.timer = PhaseTimer()
 
 
+    def set_board_size(self, board_size_x, board_size_y):
+        # For playing on another board than the one in config (a convolutional model only).
+        self.model.set_board_size(board_size_x, board_size_y)
+        self.trainer.target_model.set_board_size(board_size_x, board_size_y)
+        self.BOARD_SIZE_X, self.BOARD_SIZE_Y = board_size_x, board_size_y
+
+    def update_epsilon(self):
+        # Linear decay over epsilon_decay_games games, called once a game is finished.
+        self.epsilon = max(self.epsilon_end, 
+                           self.epsilon_start - (self.games_played / self.epsilon_decay_games) * (self.epsilon_start - self.epsilon_end))
+
     def get_valid_actions(self, state_rep):
         # state_rep is a flattened board state with the current player ID + game over flag appended.
         # Return the indicies of the board cells with the zero values (the empty ones).
         return np.where(state_rep[:-2] == 0)[0] if state_rep[-1] == 0 else []
 
-    def select_action(self, state_rep):
-        valid_indices = self.get_valid_actions(state_rep)
-        if valid_indices.size == 0:
-            return None 
-        
-        # No randomness in the play mode.
-        if not self.play_mode and random.random() < self.epsilon:
-            index = random.choice(valid_indices)
-            y, x = divmod(index, self.BOARD_SIZE_X)
-            return (x, y)
+    def get_valid_actions_mask(self, state_reps):
+        # The batched version of get_valid_actions: (N, input_size) -> (N, output_size) bool mask.
+        return (state_reps[:, :-2] == 0) & (state_reps[:, -1:] == 0)
+
+    def get_losing_actions_mask(self, game):
+        # The (output_size,) bool mask of the empty cells where the player to move would complete a square,
+        # from the threat map of the game.
+        mask = np.zeros(self.BOARD_SIZE_X * self.BOARD_SIZE_Y, dtype=bool)
+        for x, y in game.losing_cells(game.current_player):
+            mask[y * self.BOARD_SIZE_X + x] = True
+        return mask
+
+    def select_actions(self, state_reps, avoid=None):
+        # state_reps - (N, input_size). Returns (N,) flattened actions y * BOARD_SIZE_X + x,
+        # or -1 for the states with no valid actions.
+        # avoid - an optional (N, output_size) bool mask of the actions to take only if there are no others
+        # (see get_losing_actions_mask).
+        state_reps = np.ascontiguousarray(state_reps, dtype=np.float32)
+        if self.replay_symmetry == 'canonical':
+            boards = state_reps[:, :-2].astype(np.int8)
+            symmetries = canonical_symmetries(boards, self.BOARD_SIZE_X, self.BOARD_SIZE_Y)
+            state_reps = state_reps.copy()
+            state_reps[:, :-2] = transform_boards(boards, self.BOARD_SIZE_X, self.BOARD_SIZE_Y, symmetries)
+            if avoid is not None:
+                avoid = transform_boards(avoid, self.BOARD_SIZE_X, self.BOARD_SIZE_Y, symmetries)
+        valid = self.get_valid_actions_mask(state_reps)
+        if avoid is not None:
+            preferred = valid & ~avoid
+            valid = np.where(preferred.any(axis=1, keepdims=True), preferred, valid)
+        has_valid = valid.any(axis=1)
+        actions = np.full(len(state_reps), -1, dtype=np.int64)
+
+        # Epsilon-greedy per row. No randomness in the play mode.
+        if self.play_mode:
+            explore = np.zeros(len(state_reps), dtype=bool)
         else:
-            state_tensor = torch.tensor(np.array(state_rep), dtype=torch.float32).unsqueeze(0)
-            with torch.no_grad():
-                q_values = self.model(state_tensor).squeeze()
-            q_values_flat = q_values.flatten()
-            # Argmaxing Q-values only over actions with valid indices.
-            best_index = max(valid_indices, key=lambda i: q_values_flat[i])
-            best_y, best_x = divmod(best_index, self.BOARD_SIZE_X)
+            explore = (np.random.random(len(state_reps)) < self.epsilon) & has_valid
+            if explore.any():
+                # A uniformly random valid cell: argmax of random scores, with the invalid cells scored -1.
+                scores = np.where(valid[explore], np.random.random((explore.sum(), valid.shape[1])), -1.0)
+                actions[explore] = scores.argmax(axis=1)
+
+        exploit = has_valid & ~explore
+        if exploit.any():
+            # One forward pass for all the greedy rows, argmaxing Q-values only over valid actions.
+            # inference_mode skips the autograd bookkeeping that no_grad still does (version counters, views).
+            with torch.inference_mode():
+                q_values = self.model(torch.from_numpy(state_reps[exploit]))
+            q_values = q_values.masked_fill(~torch.from_numpy(valid[exploit]), float('-inf'))
+            actions[exploit] = q_values.argmax(dim=1).numpy()
 
-            return (best_x, best_y)
+        if self.replay_symmetry == 'canonical':
+            # Back to the orientation of the given states.
+            actions[has_valid] = inverse_transform_cells(actions[has_valid], self.BOARD_SIZE_X, self.BOARD_SIZE_Y,
+                                                         symmetries[has_valid])
+        return actions
+
+    def select_action(self, state_rep, avoid=None):
+        index = self.select_actions(np.asarray(state_rep)[None, :], None if avoid is None else avoid[None, :])[0]
+        if index < 0:
+            return None
+        y, x = divmod(int(index), self.BOARD_SIZE_X)
+        return (x, y)
+
+    def train_on_schedule(self, env_steps):
+        # The learner schedule of the sequential session, called after every env step:
+        # TRAIN_GRADIENT_STEPS calls of train() every TRAIN_EVERY env steps. Returns the mean loss, if trained.
+        if env_steps % self.config.TRAIN_EVERY:
+            return None
+        losses = [loss for loss in (self.train() for _ in range(self.config.TRAIN_GRADIENT_STEPS))
+                  if loss is not None]
+        return sum(losses) / len(losses) if losses else None
 
     def train(self):
         if len(self.memory) < self.batch_size:
             return None 
         
-        batch = random.sample(self.memory, self.batch_size)
-        states, actions, rewards, next_states, dones = zip(*batch)
+        # The replay buffer returns contiguous arrays, wrapped as tensors without copying.
+        # The batch is decoded into the same buffers at every step.
+        t = time.perf_counter()
+        indices = self.memory.sample_indices(self.batch_size)
+        states, actions, rewards, next_states, dones = map(torch.from_numpy,
+                                                           self.memory.get_batch(indices, self.batch_buffers))
 
-        states = torch.tensor(np.array(states), dtype=torch.float32)
-        actions = torch.tensor(actions, dtype=torch.int32)
-        next_states = torch.tensor(np.array(next_states), dtype=torch.float32)
-        rewards = torch.tensor(rewards, dtype=torch.float32)
-        dones = torch.tensor(dones, dtype=torch.bool)
-
-        loss = self.trainer.train_step(states, actions, rewards, next_states, dones)
+        if self.prioritized_replay:
+            beta = min(1.0, self.config.PER_BETA_START + (1.0 - self.config.PER_BETA_START) 
+                       * self.training_steps_count / self.config.PER_BETA_STEPS)
+            weights = torch.from_numpy(self.memory.importance_weights(indices, beta))
+            t = self.timer.lap('replay_sample', t)
+            loss = self.trainer.train_step(states, actions, rewards, next_states, dones, weights)
+            t = self.timer.lap('train_step', t)
+            self.memory.update_priorities(indices, self.trainer.td_errors)
+            self.timer.lap('update_priorities', t)
+        else:
+            t = self.timer.lap('replay_sample', t)
+            loss = self.trainer.train_step(states, actions, rewards, next_states, dones)
+            self.timer.lap('train_step', t)
         self.training_steps_count += 1
 
         if not self.training_steps_count % self.config.TARGET_UPDATE_FREQUENCY:
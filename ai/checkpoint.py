@@ -0,0 +1,113 @@
+import copy
+import os
+import queue
+import random
+import shutil
+import threading
+import numpy as np
+import torch
+
+# Full training checkpoints: the model, the target network, the optimizer state, the replay memory,
+# the agent's counters, the random number generators and any extra state of the training loop.
+# A checkpoint is a directory checkpoint_<games played> under the checkpoint directory, and the file `latest`
+# names the newest complete one. The replay arrays are .npy files, reopened as memory maps on resume.
+
+
+class Checkpointer:
+    # Writes in a background thread. The state is copied on the caller's thread (in memory, a few milliseconds
+    # for the default replay size), and the thread writes the copy, so the training loop does not wait for the disk.
+    # At most one copy waits for the writer: if the disk falls behind by more than that, save() waits.
+    def __init__(self, keep=2):
+        self.keep = keep # The number of full checkpoints kept in a directory.
+        self.jobs = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                job()
+            except Exception as e:
+                print(f'Could not write a checkpoint due to {type(e).__name__}: {e}')
+
+    def save_weights(self, model, model_filename):
+        # The model weights only, as Linear_QNetwork.save writes them.
+        state_dict = copy.deepcopy(model.state_dict())
+        self.jobs.put(lambda: torch.save(state_dict, model_filename))
+
+    def save(self, agent, directory, extra=None):
+        snapshot = snapshot_training_state(agent, extra)
+        self.jobs.put(lambda: write_checkpoint(directory, snapshot, self.keep))
+
+    def close(self):
+        # Wait for the pending writes.
+        self.jobs.put(None)
+        self.thread.join()
+
+
+def snapshot_training_state(agent, extra=None):
+    return {'model': copy.deepcopy(agent.model.state_dict()),
+            'target_model': copy.deepcopy(agent.trainer.target_model.state_dict()),
+            'optimizer': copy.deepcopy(agent.trainer.optimizer.state_dict()),
+            'epsilon': agent.epsilon,
+            'games_played': agent.games_played,
+            'training_steps_count': agent.training_steps_count,
+            'random_state': random.getstate(),
+            'numpy_random_state': np.random.get_state(),
+            'torch_random_state': torch.get_rng_state(),
+            'extra': extra,
+            'replay': agent.memory.snapshot(),
+            'replay_class': type(agent.memory)}
+
+
+def write_checkpoint(directory, snapshot, keep=2):
+    # Written to a temporary directory first and renamed when complete, then `latest` is switched to it.
+    name = f'checkpoint_{snapshot["games_played"]}'
+    path = os.path.join(directory, name)
+    temporary_path = path + '.tmp'
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    os.makedirs(temporary_path)
+
+    snapshot = dict(snapshot)
+    snapshot.pop('replay_class').save(os.path.join(temporary_path, 'replay'), snapshot.pop('replay'))
+    torch.save(snapshot, os.path.join(temporary_path, 'training.pt'))
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(temporary_path, path)
+
+    with open(os.path.join(directory, 'latest.tmp'), 'w') as f:
+        f.write(name)
+    os.replace(os.path.join(directory, 'latest.tmp'), os.path.join(directory, 'latest'))
+
+    # Older checkpoints beyond `keep` are removed. A replay memory-mapped from one of them stays readable:
+    # the files are only unlinked.
+    checkpoints = sorted((entry for entry in os.listdir(directory)
+                          if entry.startswith('checkpoint_') and not entry.endswith('.tmp')),
+                         key=lambda entry: int(entry.split('_')[1]))
+    for entry in checkpoints[:-keep]:
+        shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+
+
+def is_checkpoint_directory(path):
+    return os.path.isfile(os.path.join(path, 'latest'))
+
+
+def load_checkpoint(agent, directory):
+    # Restore the latest checkpoint in the directory into the agent. Returns the extra state saved with it.
+    with open(os.path.join(directory, 'latest')) as f:
+        path = os.path.join(directory, f.read().strip())
+    # The checkpoint holds the random states (NumPy arrays, tuples), not only tensors.
+    state = torch.load(os.path.join(path, 'training.pt'), weights_only=False)
+    agent.model.load_state_dict(state['model'])
+    agent.trainer.target_model.load_state_dict(state['target_model'])
+    agent.trainer.optimizer.load_state_dict(state['optimizer'])
+    agent.epsilon = state['epsilon']
+    agent.games_played = state['games_played']
+    agent.training_steps_count = state['training_steps_count']
+    agent.memory.load(os.path.join(path, 'replay'))
+    random.setstate(state['random_state'])
+    np.random.set_state(state['numpy_random_state'])
+    torch.set_rng_state(state['torch_random_state'])
+    return state['extra']
@@ -0,0 +1,143 @@
+import csv
+import json
+import os
+import time
+
+# Instrumentation of the training loops: per-phase timers, a metrics sink (JSONL or CSV)
+# and an optional profiler over the first steps of a run. See train_agent.py for the phases timed.
+
+
+class PhaseTimer:
+    # Accumulated wall-clock seconds per phase. Timing a phase is one perf_counter call:
+    #   t = timer.lap('select_action', t)
+    # adds the time since t to the phase and returns the new time to measure the next phase from.
+    def __init__(self):
+        self.seconds = {}
+
+    def lap(self, phase, since):
+        now = time.perf_counter()
+        self.seconds[phase] = self.seconds.get(phase, 0.0) + now - since
+        return now
+
+    def reset(self):
+        seconds, self.seconds = self.seconds, {}
+        return seconds
+
+
+class MetricsSink:
+    # Appends one record (a flat dict) per call to write() to a .jsonl or a .csv file.
+    # A CSV file takes its columns from the first record.
+    def __init__(self, filename):
+        self.filename = filename
+        self.csv = filename.endswith('.csv')
+        self.file = open(filename, 'a', newline='')
+        self.writer = None
+
+    def write(self, record):
+        if self.csv:
+            if self.writer is None:
+                self.writer = csv.DictWriter(self.file, fieldnames=list(record), extrasaction='ignore')
+                if not self.file.tell():
+                    self.writer.writeheader()
+            self.writer.writerow(record)
+        else:
+            self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class TrainingMetrics:
+    # Collects the counters of a training run between reports and turns them into a record:
+    # games, env steps and train steps (total and per second), the mean loss, epsilon, the replay fill,
+    # and the milliseconds per env step spent in each of the phases (timed with agent.timer).
+    # The phases are listed upfront, so that every record has the same fields.
+    def __init__(self, agent, phases, filename=''):
+        self.agent = agent
+        self.timer = agent.timer
+        self.phases = phases
+        self.sink = MetricsSink(filename) if filename else None
+        self.env_steps = 0
+        self.losses = []
+        self.last_time = self.start_time = time.perf_counter()
+        self.last_env_steps = self.last_train_steps = 0
+
+    def add_loss(self, loss):
+        if loss is not None:
+            self.losses.append(loss)
+
+    def report(self, losers, game_length):
+        agent = self.agent
+        now = time.perf_counter()
+        interval = now - self.last_time
+        env_steps = self.env_steps - self.last_env_steps
+        train_steps = agent.training_steps_count - self.last_train_steps
+        record = {'time': now - self.start_time,
+                  'games': agent.games_played,
+                  'env_steps': self.env_steps,
+                  'train_steps': agent.training_steps_count,
+                  'env_steps_per_sec': env_steps / interval,
+                  'train_steps_per_sec': train_steps / interval,
+                  'loss': sum(self.losses) / len(self.losses) if self.losses else None,
+                  'epsilon': agent.epsilon,
+                  'replay_fill': len(agent.memory) / agent.memory.capacity,
+                  'mean_game_length': sum(game_length) / len(game_length),
+                  'p1_losing_ratio': list(losers).count(1) / len(losers),
+                  'p2_losing_ratio': list(losers).count(2) / len(losers)}
+        seconds = self.timer.reset()
+        for phase in self.phases:
+            record[f'ms_per_step_{phase}'] = 1000 * seconds.get(phase, 0.0) / max(env_steps, 1)
+        if self.sink:
+            self.sink.write(record)
+        self.last_time, self.last_env_steps, self.last_train_steps = now, self.env_steps, agent.training_steps_count
+        self.losses = []
+        return record
+
+    def close(self):
+        if self.sink:
+            self.sink.close()
+
+
+class StepProfiler:
+    # Profiles the first `steps` calls of step() with cProfile ('cprofile') or torch.profiler ('torch'),
+    # then writes the results (output + '.prof', or a Chrome trace output + '.json') and prints a summary.
+    # With kind None it does nothing.
+    def __init__(self, kind, steps, output='profile'):
+        self.kind = kind
+        self.steps_left = steps
+        self.output = output
+        self.profiler = None
+        if kind == 'cprofile':
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif kind == 'torch':
+            import torch
+            self.profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU])
+            self.profiler.start()
+        elif kind is not None:
+            raise ValueError(f'Unknown profiler {kind}.')
+
+    def step(self):
+        if self.profiler is None:
+            return
+        self.steps_left -= 1
+        if self.steps_left <= 0:
+            self.stop()
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        profiler, self.profiler = self.profiler, None
+        if self.kind == 'cprofile':
+            import pstats
+            profiler.disable()
+            profiler.dump_stats(self.output + '.prof')
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+            print(f'Profile written to {os.path.abspath(self.output)}.prof')
+        else:
+            profiler.stop()
+            profiler.export_chrome_trace(self.output + '.json')
+            print(profiler.key_averages().table(sort_by='cpu_time_total', row_limit=20))
+            print(f'Trace written to {os.path.abspath(self.output)}.json')
@@ -1,21 +1,18 @@
+import copy
 import torch
 import numpy as np
 import torch.nn as nn
 import torch.optim as optim
 import os
 
-class Linear_QNetwork(nn.Module):
-    def __init__(self, input_size, hidden_size, output_size):
-        super().__init__()
-        # Two layers seem to work OK-ish.
-        self.linear1 = nn.Linear(input_size, hidden_size)
-        self.linear2 = nn.Linear(hidden_size, output_size)
-        
-    def forward(self, x):
-        x = torch.relu(self.linear1(x))
-        x = self.linear2(x)
-        return x
-    
+# The Q-networks take the flat state reps of game/encoding.py, (N, BOARD_SIZE_X*BOARD_SIZE_Y + 2),
+# and return one Q-value per cell, (N, BOARD_SIZE_X*BOARD_SIZE_Y). See make_q_network for choosing one from config.
+
+class QNetwork(nn.Module):
+    def set_board_size(self, board_size_x, board_size_y):
+        # The board size of the state reps given to forward().
+        pass
+
     def save(self, model_filename):
         # if not os.path.exists('models'):
         #     os.makedirs('models')
@@ -31,42 +28,108 @@ class Linear_QNetwork(nn.Module):
         except Exception as e:
             print(f'Could not load a model from {model_filename} due to {type(e).__name__}.')
             raise e
+
+class Linear_QNetwork(QNetwork):
+    def __init__(self, input_size, hidden_size, output_size):
+        super().__init__()
+        # Two layers seem to work OK-ish.
+        self.linear1 = nn.Linear(input_size, hidden_size)
+        self.linear2 = nn.Linear(hidden_size, output_size)
+        
+    def forward(self, x):
+        x = torch.relu(self.linear1(x))
+        x = self.linear2(x)
+        return x
+
+    def set_board_size(self, board_size_x, board_size_y):
+        if board_size_x * board_size_y != self.linear2.out_features:
+            raise ValueError(f'A linear Q-network for {self.linear2.out_features} cells cannot play '
+                             f'on a {board_size_x}x{board_size_y} board.')
+
+class Conv_QNetwork(QNetwork):
+    # Fully convolutional, with a Q-value per cell from a final 1x1 convolution, so that the weights
+    # do not depend on the board size: a model trained on one board plays (or goes on training) on any other.
+    # The state reps are turned into three planes relative to the player to move: own disks, the opponent's disks
+    # and the empty cells (as game.encoding.encode_planes does), all zero off the board.
+    # The dilated 3x3 convolutions reach the corners of the large squares of the larger boards.
+    def __init__(self, board_size_x, board_size_y, channels=32, dilations=(1, 2, 4, 8, 1)):
+        super().__init__()
+        self.set_board_size(board_size_x, board_size_y)
+        layers = []
+        in_channels = 3
+        for dilation in dilations:
+            layers += [nn.Conv2d(in_channels, channels, 3, padding=dilation, dilation=dilation), nn.ReLU()]
+            in_channels = channels
+        layers.append(nn.Conv2d(in_channels, 1, 1))
+        self.layers = nn.Sequential(*layers)
+
+    def set_board_size(self, board_size_x, board_size_y):
+        self.board_size_x, self.board_size_y = board_size_x, board_size_y
+
+    def forward(self, x):
+        board = x[:, :-2].reshape(-1, 1, self.board_size_y, self.board_size_x)
+        # The player to move is -0.5 (player 1) or 0.5 (player 2), so the player ID is that + 1.5.
+        player = (x[:, -2] + 1.5).reshape(-1, 1, 1, 1)
+        planes = torch.cat((board == player, board == 3 - player, board == 0), dim=1).float()
+        return self.layers(planes).flatten(1)
+
+def make_q_network(config, board_size_x, board_size_y):
+    # The Q-network chosen by config.Q_NETWORK, for the given board size.
+    if config.Q_NETWORK == 'linear':
+        return Linear_QNetwork(input_size=board_size_x * board_size_y + 2,
+                               hidden_size=config.HIDDEN_SIZE,
+                               output_size=board_size_x * board_size_y)
+    if config.Q_NETWORK == 'conv':
+        return Conv_QNetwork(board_size_x, board_size_y,
+                             channels=config.CONV_CHANNELS, dilations=config.CONV_DILATIONS)
+    raise ValueError(f'Unknown Q-network {config.Q_NETWORK}.')
         
 class QTrainer():
-    def __init__(self, model, lr=0.001, gamma=0.9):
+    def __init__(self, model, lr=0.001, gamma=0.9, compile=False):
         self.gamma = gamma
         self.model = model
         self.optimizer = optim.Adam(model.parameters(), lr=lr)
         self.criterion = nn.MSELoss() 
 
-        self.target_model = Linear_QNetwork(model.linear1.in_features,
-                                            model.linear1.out_features,
-                                            model.linear2.out_features)
+        self.target_model = copy.deepcopy(model)
 
         self.target_model.load_state_dict(self.model.state_dict())
         self.target_model.eval()
 
-    def train_step(self, states, actions, rewards, next_states, dones):
+        # torch.compile'd forward passes for the training steps. They share the parameters with the models,
+        # which are saved and loaded as usual. The first steps (and the first step of a new batch size) are slow.
+        self.forward = torch.compile(self.model) if compile else self.model
+        self.target_forward = torch.compile(self.target_model) if compile else self.target_model
+
+    def train_step(self, states, actions, rewards, next_states, dones, weights=None):
         # states - (BATCH_SIZE, input_size), where input_size = BOARD_SIZE_X*BOARD_SIZE_Y+2
         # actions - a list of flattened (x,y) coordinates, length BATCH_SIZE
         # rewards - (BATCH_SIZE,)
         # next_states - (BATCH_SIZE, input_size)
         # dones - (BATCH_SIZE,) bool
+        # weights - (BATCH_SIZE,) optional importance-sampling weights (prioritized replay)
 
         self.model.train() # Important: unlike target_model, model is in the train mode.
 
-        pred_q_values = self.model(states) # Shape: (BATCH_SIZE, output_size)        
+        pred_q_values = self.forward(states) # Shape: (BATCH_SIZE, output_size)        
         pred_q_values_for_action = pred_q_values[range(len(actions)), actions]
 
         with torch.no_grad(): 
-            next_q_values_all_actions = self.target_model(next_states) # Shape: (BATCH_SIZE, output_size)
+            next_q_values_all_actions = self.target_forward(next_states) # Shape: (BATCH_SIZE, output_size)
           
             # For each next_state, maximize the Q-value over all possible actions.
             max_next_q_values, _ = next_q_values_all_actions.max(dim=1) # Shape: (BATCH_SIZE,)
             # Bellman's equation: relate target Q-values to the predicted ones.
             targets = rewards + self.gamma * max_next_q_values * (~dones)
         
-        loss = self.criterion(pred_q_values_for_action, targets)
+        # Kept for the prioritized replay to update the priorities with.
+        td_errors = targets - pred_q_values_for_action
+        self.td_errors = td_errors.detach().numpy()
+
+        if weights is None:
+            loss = self.criterion(pred_q_values_for_action, targets)
+        else:
+            loss = (weights * td_errors ** 2).mean()
 
         self.optimizer.zero_grad() 
         loss.backward()             
@@ -0,0 +1,131 @@
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+from game.encoding import canonical_symmetries, inverse_transform_cells, transform_boards
+
+# Inference of a trained Linear_QNetwork without torch: the weights are exported once to an .npz
+# and the two layers are run as NumPy matmuls. See AIPlayer for playing with an .npz model.
+
+
+def export_npz(model_filename, npz_filename=None):
+    # Write the linear1/linear2 weights of a .pth state dict to an .npz (next to it by default).
+    # The only place here that needs torch.
+    import torch
+    npz_filename = npz_filename or os.path.splitext(model_filename)[0] + '.npz'
+    state_dict = torch.load(model_filename, weights_only=True)
+    np.savez(npz_filename, **{name: tensor.numpy() for name, tensor in state_dict.items()})
+    return npz_filename
+
+
+class NumpyQNetwork:
+    # The forward pass of Linear_QNetwork: relu(x W1^T + b1) W2^T + b2, batched over the rows of x.
+    # The weights are kept transposed and contiguous, float32 as in torch.
+    # canonical_board_size - (BOARD_SIZE_X, BOARD_SIZE_Y) of a model trained with the canonical replay:
+    # select_actions then acts on the canonical orientations of the boards, as DQNAgent.select_actions does.
+    def __init__(self, npz_filename, canonical_board_size=None):
+        self.canonical_board_size = canonical_board_size
+        with np.load(npz_filename) as weights:
+            if 'linear1.weight' not in weights:
+                raise ValueError(f'{npz_filename} does not hold Linear_QNetwork weights.')
+            self.w1 = np.ascontiguousarray(weights['linear1.weight'].T, dtype=np.float32)
+            self.b1 = weights['linear1.bias'].astype(np.float32)
+            self.w2 = np.ascontiguousarray(weights['linear2.weight'].T, dtype=np.float32)
+            self.b2 = weights['linear2.bias'].astype(np.float32)
+        self.input_size, self.hidden_size = self.w1.shape
+        self.output_size = self.w2.shape[1]
+
+    def __call__(self, state_reps):
+        # state_reps - (N, input_size). Returns the (N, output_size) Q-values.
+        hidden = np.asarray(state_reps, dtype=np.float32) @ self.w1
+        hidden += self.b1
+        np.maximum(hidden, 0, out=hidden)
+        q_values = hidden @ self.w2
+        q_values += self.b2
+        return q_values
+
+    def select_actions(self, state_reps):
+        # The greedy valid actions (as in DQNAgent.select_actions in the play mode): (N,) flat indices,
+        # -1 for the states with no valid actions.
+        state_reps = np.asarray(state_reps, dtype=np.float32)
+        if self.canonical_board_size is not None:
+            boards = state_reps[:, :-2].astype(np.int8)
+            symmetries = canonical_symmetries(boards, *self.canonical_board_size)
+            state_reps = state_reps.copy()
+            state_reps[:, :-2] = transform_boards(boards, *self.canonical_board_size, symmetries)
+        valid = (state_reps[:, :-2] == 0) & (state_reps[:, -1:] == 0)
+        q_values = np.where(valid, self(state_reps), -np.inf)
+        actions = q_values.argmax(axis=1)
+        if self.canonical_board_size is not None:
+            # Back to the orientation of the given states.
+            actions = inverse_transform_cells(actions, *self.canonical_board_size, symmetries)
+        return np.where(valid.any(axis=1), actions, -1)
+
+
+def _player_benchmark(model_filename, num_moves):
+    # In a fresh process: per-move latency of an AIPlayer (microseconds) and the peak RSS (MB).
+    # The positions differ, so that the move cache is not hit.
+    import random
+    import config
+    from game.game_logic import HipGameLogic
+    from game.player import AIPlayer
+
+    player = AIPlayer('AI', model_filename)
+    rng = random.Random(0)
+    states = []
+    while len(states) < num_moves:
+        game = HipGameLogic(config.BOARD_SIZE_X, config.BOARD_SIZE_Y)
+        for _ in range(rng.randrange(config.BOARD_SIZE_X * config.BOARD_SIZE_Y // 2)):
+            empty = [(x, y) for y in range(game.BOARD_SIZE_Y) for x in range(game.BOARD_SIZE_X)
+                     if not game.board[y][x]]
+            game.make_move(game.current_player, rng.choice(empty))
+            if game.player_lost is not None:
+                break
+        if game.player_lost is None:
+            states.append(game.get_state())
+    start = time.perf_counter()
+    for state in states:
+        player.get_move(state)
+    latency = (time.perf_counter() - start) / num_moves * 1e6
+    # The high-water mark of this process image (ru_maxrss would carry over the parent's through exec).
+    with open('/proc/self/status') as status:
+        peak_rss = next(int(line.split()[1]) for line in status if line.startswith('VmHWM')) / 1024
+    print(latency, peak_rss)
+
+
+def benchmark(model_filename, num_moves=2000):
+    # Parity of the NumPy and torch Q-values on random positions, then the latency and RSS of both players.
+    import torch
+    from ai.model import Linear_QNetwork
+
+    npz_filename = export_npz(model_filename)
+    numpy_model = NumpyQNetwork(npz_filename)
+    torch_model = Linear_QNetwork(numpy_model.input_size, numpy_model.hidden_size, numpy_model.output_size)
+    torch_model.load(model_filename)
+    torch_model.eval()
+
+    rng = np.random.default_rng(0)
+    state_reps = np.zeros((1000, numpy_model.input_size), dtype=np.float32)
+    state_reps[:, :-2] = rng.integers(0, 3, size=(1000, numpy_model.output_size))
+    state_reps[:, -2] = rng.choice([-0.5, 0.5], size=1000)
+    with torch.no_grad():
+        torch_q_values = torch_model(torch.from_numpy(state_reps)).numpy()
+    numpy_q_values = numpy_model(state_reps)
+    max_error = float(np.abs(numpy_q_values - torch_q_values).max())
+    same_moves = float((numpy_model.select_actions(state_reps)
+                        == np.where(state_reps[:, :-2] == 0, torch_q_values, -np.inf).argmax(axis=1)).mean())
+    print(f'{model_filename}: max |Q difference| {max_error:.2e}, same greedy move {same_moves:.1%}')
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for filename in (model_filename, npz_filename):
+        result = subprocess.run([sys.executable, '-c', f'from ai.numpy_model import _player_benchmark; '
+                                                       f'_player_benchmark({filename!r}, {num_moves})'],
+                                cwd=root, env=dict(os.environ, PYTHONPATH=root),
+                                capture_output=True, text=True, check=True)
+        latency, rss = map(float, result.stdout.split('\n')[-2].split())
+        print(f'AIPlayer({filename!r}): {latency:.0f} us/move, peak RSS {rss:.0f} MB')
+
+
+if __name__ == '__main__':
+    benchmark('models/usual_6_by_6.pth')
@@ -0,0 +1,125 @@
+import numpy as np
+from game.game_logic import HipGameLogic
+from game.records import GAME_HEADER, UNFINISHED, read_header
+from game.encoding import canonical_symmetries, encode_boards, symmetry_arrays, transform_boards, transform_cells
+
+class GameRecordDataset:
+    # The transitions (state_rep, action, reward, next_state_rep, done) of the games in a game record file
+    # (see game/records.py), for offline training: the file is memory-mapped, and the batches are rebuilt
+    # from the moves on the fly. It has the sampling API of ai.replay.ReplayBuffer, so it can stand in
+    # for the replay memory of a DQNAgent (see train_agent.run_offline_training).
+    # In memory: an index of 19 bytes per game and the reward of every move (4 bytes), against about
+    # 300 bytes per transition materialized as float32 state reps (or 80 in the int8 columns of ReplayBuffer).
+    #
+    # The rewards are computed once, replaying the games with reward_function, so they follow the reward
+    # function of the training rather than the one the games were played with.
+    # symmetry - as in ReplayBuffer: None, 'augment' (a random symmetry per sampled transition) or 'canonical'
+    # (every transition in the canonical orientation of its state; the duplicates are not removed).
+    def __init__(self, filename, reward_function, symmetry=None):
+        with open(filename, 'rb') as f:
+            self.BOARD_SIZE_X, self.BOARD_SIZE_Y, self.players = read_header(f)
+            start = f.tell()
+        self.num_cells = self.BOARD_SIZE_X * self.BOARD_SIZE_Y
+        self.board_size = (self.BOARD_SIZE_X, self.BOARD_SIZE_Y)
+        self.symmetry = symmetry
+        if symmetry is not None:
+            self.num_symmetries = len(symmetry_arrays(*self.board_size)[0])
+        # A plain array over the memory map: indexing a np.memmap itself is several times slower.
+        self.data = np.asarray(np.memmap(filename, dtype=np.uint8, mode='r'))
+
+        # The games: where their moves start in the file, their lengths and outcomes. A record cut short is left out.
+        move_starts, lengths, outcomes = [], [], []
+        position, size = start, len(self.data)
+        while position + GAME_HEADER.size <= size:
+            _, _, moves_count, outcome = GAME_HEADER.unpack_from(self.data, position)
+            position += GAME_HEADER.size
+            if position + moves_count > size:
+                break
+            if moves_count:
+                move_starts.append(position)
+                lengths.append(moves_count)
+                outcomes.append(outcome)
+            position += moves_count
+        self.move_starts = np.array(move_starts, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int16)
+        self.finished = np.array(outcomes, dtype=np.uint8) != UNFINISHED
+        # The transitions are numbered game after game: game g has the ones from ends[g] - lengths[g] to ends[g].
+        self.ends = np.cumsum(self.lengths, dtype=np.int64)
+        self.size = int(self.ends[-1]) if len(self.ends) else 0
+        self.rewards = self._replay_rewards(reward_function)
+
+    def __len__(self):
+        return self.size
+
+    def _replay_rewards(self, reward_function):
+        # The reward of every move, from the game states before and after it. Checks that the moves are legal
+        # and lead to the outcomes recorded.
+        rewards = np.empty(self.size, dtype=np.float32)
+        game = HipGameLogic(self.BOARD_SIZE_X, self.BOARD_SIZE_Y)
+        i = 0
+        for move_start, length, finished in zip(self.move_starts.tolist(), self.lengths.tolist(),
+                                                self.finished.tolist()):
+            game.reset_game()
+            for cell in self.data[move_start:move_start + length].tolist():
+                state = game.get_state()
+                action = (cell % self.BOARD_SIZE_X, cell // self.BOARD_SIZE_X)
+                if game.player_lost is not None or not game.make_move(game.current_player, action):
+                    raise ValueError(f'An invalid move {action} in the game at byte {move_start}.')
+                rewards[i] = reward_function(state, game.get_state(), action)
+                i += 1
+            if finished != (game.player_lost is not None):
+                raise ValueError(f'The game at byte {move_start} does not end as recorded.')
+        return rewards
+
+    def sample_indices(self, batch_size):
+        return np.random.randint(0, self.size, size=batch_size)
+
+    def new_batch(self, batch_size):
+        # Buffers for get_batch to fill: states, actions, rewards, next_states, dones.
+        return (np.empty((batch_size, self.num_cells + 2), dtype=np.float32),
+                np.empty(batch_size, dtype=np.int64),
+                np.empty(batch_size, dtype=np.float32),
+                np.empty((batch_size, self.num_cells + 2), dtype=np.float32),
+                np.empty(batch_size, dtype=bool))
+
+    def get_batch(self, indices, out=None):
+        # Contiguous arrays: states, actions, rewards, next_states, dones, written into out (from new_batch) if given.
+        # Transition i is move t of game g: the state is the board after the first t moves of the game.
+        states, actions, rewards, next_states, dones = out or self.new_batch(len(indices))
+        indices = np.asarray(indices)
+        games = np.searchsorted(self.ends, indices, side='right')
+        plies = indices - (self.ends[games] - self.lengths[games])
+        # The moves up to move t of every game, as a (batch, longest t + 1) gather of the cells.
+        # The columns past move t are masked out (clipped to the file, as they may run past its end).
+        k = np.arange(int(plies.max()) + 1)
+        cells = self.data[np.minimum(self.move_starts[games, None] + k, len(self.data) - 1)].astype(np.intp)
+        before = k < plies[:, None]
+        rows = np.arange(len(indices))
+        boards = np.zeros((len(indices), self.num_cells), dtype=np.int8)
+        # Player 1 makes the even moves.
+        boards[np.broadcast_to(rows[:, None], before.shape)[before], cells[before]] = \
+            np.broadcast_to(k % 2 + 1, before.shape)[before]
+        action_cells = cells[rows, plies]
+        movers = (plies % 2 + 1).astype(np.int8)
+        next_boards = boards.copy()
+        next_boards[rows, action_cells] = movers
+        dones[...] = (plies == self.lengths[games] - 1) & self.finished[games]
+
+        if self.symmetry is not None:
+            if self.symmetry == 'canonical':
+                symmetries = canonical_symmetries(boards, *self.board_size)
+            else:
+                symmetries = np.random.randint(0, self.num_symmetries, len(indices))
+            boards = transform_boards(boards, *self.board_size, symmetries)
+            next_boards = transform_boards(next_boards, *self.board_size, symmetries)
+            action_cells = transform_cells(action_cells, *self.board_size, symmetries)
+
+        # After the last move the player to move does not change.
+        encode_boards(boards, movers, 0, states)
+        encode_boards(next_boards, np.where(dones, movers, 3 - movers), dones, next_states)
+        actions[...] = action_cells
+        rewards[...] = self.rewards[indices]
+        return states, actions, rewards, next_states, dones
+
+    def sample(self, batch_size):
+        return self.get_batch(self.sample_indices(batch_size))
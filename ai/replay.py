@@ -0,0 +1,308 @@
+import json
+import os
+import time
+import numpy as np
+from game.encoding import canonical_symmetries, symmetry_arrays, transform_boards, transform_cells
+
+class ReplayBuffer:
+    # A ring buffer of transitions (state_rep, action, reward, next_state_rep, done) in fixed-size columns.
+    # A state rep (the board + current player + game over flag) is stored as an int8 board and a flags byte:
+    # bit 0 is set if player 2 is to move, bit 1 is set if the game is over.
+    # The done flag of a transition is the game over bit of its next state.
+    PLAYER_2_BIT = 1
+    GAME_OVER_BIT = 2
+    # The player to move and the game over flag of a state rep, indexed by the flags byte.
+    PLAYER_VALUES = np.array([-0.5, 0.5, -0.5, 0.5], dtype=np.float32)
+    GAME_OVER_VALUES = np.array([0, 0, 1, 1], dtype=np.float32)
+
+    # With symmetry='augment' (board_size given as (BOARD_SIZE_X, BOARD_SIZE_Y)), every sampled transition
+    # comes out in a random orientation: its state, action and next state mapped by the same random symmetry.
+    # With symmetry='canonical', a transition is stored in the canonical orientation of its state
+    # (see game.encoding.canonical_symmetries), and not stored at all if the buffer already holds it.
+    def __init__(self, capacity, num_cells, symmetry=None, board_size=None):
+        self.capacity = capacity
+        self.num_cells = num_cells
+        self.symmetry = symmetry
+        self.board_size = board_size
+        if symmetry is not None:
+            self.num_symmetries = len(symmetry_arrays(*board_size)[0])
+        # 'canonical': (state board, action) bytes -> the index of the transition, and the key at every index.
+        self.transition_indices = {}
+        self.transition_keys = [None] * capacity if symmetry == 'canonical' else None
+        self.states = np.zeros((capacity, num_cells), dtype=np.int8)
+        self.state_flags = np.zeros(capacity, dtype=np.uint8)
+        self.next_states = np.zeros((capacity, num_cells), dtype=np.int8)
+        self.next_state_flags = np.zeros(capacity, dtype=np.uint8)
+        self.actions = np.zeros(capacity, dtype=np.int16)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.position = 0 # Where the next transition goes.
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    # The arrays of the buffer, as saved in a checkpoint.
+    COLUMNS = ('states', 'state_flags', 'next_states', 'next_state_flags', 'actions', 'rewards')
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.COLUMNS)
+
+    def snapshot(self):
+        # Copies of the arrays and the ring counters, to be written by save() while the buffer goes on changing.
+        return {name: np.array(getattr(self, name)) for name in self.COLUMNS}, \
+            {'position': self.position, 'size': self.size}
+
+    @classmethod
+    def save(cls, directory, snapshot):
+        # One .npy file per array, so that load() can memory-map them.
+        arrays, counters = snapshot
+        os.makedirs(directory, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, name + '.npy'), array)
+        with open(os.path.join(directory, 'counters.json'), 'w') as f:
+            json.dump(counters, f)
+
+    def load(self, directory):
+        # Reopen saved arrays as copy-on-write memory maps: pages are read from the file when first touched,
+        # and the changes stay in memory (the files are left as saved).
+        for name in self.COLUMNS:
+            array = np.load(os.path.join(directory, name + '.npy'), mmap_mode='c')
+            if array.shape != getattr(self, name).shape:
+                raise ValueError(f'The saved replay {name} has shape {array.shape}, '
+                                 f'expected {getattr(self, name).shape}.')
+            setattr(self, name, array)
+        with open(os.path.join(directory, 'counters.json')) as f:
+            for name, value in json.load(f).items():
+                setattr(self, name, value)
+        if self.symmetry == 'canonical':
+            self.transition_indices = {}
+            self.transition_keys = [None] * self.capacity
+            for i in range(self.size):
+                self._set_key(i, self._key(self.states[i], self.actions[i]))
+
+    def _encode_flags(self, state_reps):
+        return (state_reps[:, -2] > 0) * self.PLAYER_2_BIT + (state_reps[:, -1] != 0) * self.GAME_OVER_BIT
+
+    def _decode(self, boards, flags, out):
+        # Rebuild float32 state reps (the same layout as HipGameState.get_state_rep) in out.
+        out[:, :-2] = boards
+        out[:, -2] = self.PLAYER_VALUES[flags]
+        out[:, -1] = self.GAME_OVER_VALUES[flags]
+        return out
+
+    def _key(self, board, action):
+        return board.tobytes() + int(action).to_bytes(2, 'little')
+
+    def _set_key(self, index, key):
+        # The transition at index is (being) overwritten by the one of key.
+        old_key = self.transition_keys[index]
+        if old_key is not None and self.transition_indices.get(old_key) == index:
+            del self.transition_indices[old_key]
+        self.transition_keys[index] = key
+        self.transition_indices[key] = index
+
+    def append(self, transition):
+        # Same call as for the deque of tuples it replaces. Written straight into the columns, without temporaries.
+        # Returns the indices written (none for a duplicate in the canonical mode).
+        state_rep, action, reward, next_state_rep, done = transition
+        if self.symmetry == 'canonical':
+            next_state_rep = np.array(next_state_rep, dtype=np.float32)
+            next_state_rep[-1] = bool(done)
+            return self.append_batch(np.asarray(state_rep)[None, :], np.array([action]),
+                                     np.array([reward], dtype=np.float32), next_state_rep[None, :])
+        i = self.position
+        self.states[i] = state_rep[:-2]
+        self.state_flags[i] = (state_rep[-2] > 0) * self.PLAYER_2_BIT + (state_rep[-1] != 0) * self.GAME_OVER_BIT
+        self.next_states[i] = next_state_rep[:-2]
+        self.next_state_flags[i] = (next_state_rep[-2] > 0) * self.PLAYER_2_BIT + bool(done) * self.GAME_OVER_BIT
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return [i]
+
+    def _canonicalize(self, state_reps, actions, rewards, next_state_reps):
+        # The transitions in the canonical orientation of their states, less the ones already stored
+        # (or repeated in the batch). Returns (keys, state boards, state flags, actions, rewards, next boards, next flags).
+        boards = state_reps[:, :-2].astype(np.int8)
+        symmetries = canonical_symmetries(boards, *self.board_size)
+        boards = transform_boards(boards, *self.board_size, symmetries)
+        actions = transform_cells(np.asarray(actions), *self.board_size, symmetries)
+        keys, new = {}, []
+        for i, (board, action) in enumerate(zip(boards, actions)):
+            key = self._key(board, action)
+            if key not in self.transition_indices and key not in keys:
+                keys[key] = i
+                new.append(i)
+        next_boards = transform_boards(next_state_reps[new, :-2].astype(np.int8), *self.board_size, symmetries[new])
+        return (keys, boards[new], self._encode_flags(state_reps[new]), actions[new], np.asarray(rewards)[new],
+                next_boards, self._encode_flags(next_state_reps[new]))
+
+    def append_batch(self, state_reps, actions, rewards, next_state_reps):
+        # Store N transitions at once, e.g. one step of a VecHipEnv. Returns the indices written.
+        if self.symmetry == 'canonical':
+            keys, boards, flags, actions, rewards, next_boards, next_flags = \
+                self._canonicalize(state_reps, actions, rewards, next_state_reps)
+        else:
+            keys = None
+            boards, flags = state_reps[:, :-2], self._encode_flags(state_reps)
+            next_boards, next_flags = next_state_reps[:, :-2], self._encode_flags(next_state_reps)
+        n = len(boards)
+        indices = (self.position + np.arange(n)) % self.capacity
+        self.states[indices] = boards
+        self.state_flags[indices] = flags
+        self.next_states[indices] = next_boards
+        self.next_state_flags[indices] = next_flags
+        self.actions[indices] = actions
+        self.rewards[indices] = rewards
+        if keys is not None:
+            for index, key in zip(indices, keys):
+                self._set_key(index, key)
+        self.position = (self.position + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        return indices
+
+    def sample_indices(self, batch_size):
+        return np.random.randint(0, self.size, size=batch_size)
+
+    def new_batch(self, batch_size):
+        # Buffers for get_batch to fill: states, actions, rewards, next_states, dones.
+        return (np.empty((batch_size, self.num_cells + 2), dtype=np.float32),
+                np.empty(batch_size, dtype=np.int64),
+                np.empty(batch_size, dtype=np.float32),
+                np.empty((batch_size, self.num_cells + 2), dtype=np.float32),
+                np.empty(batch_size, dtype=bool))
+
+    def get_batch(self, indices, out=None):
+        # Contiguous arrays: states, actions, rewards, next_states, dones.
+        # Written into out (from new_batch) if given, so that a training loop can reuse the same buffers.
+        states, actions, rewards, next_states, dones = out or self.new_batch(len(indices))
+        boards, next_boards = self.states[indices], self.next_states[indices]
+        actions[...] = self.actions[indices]
+        if self.symmetry == 'augment':
+            symmetries = np.random.randint(0, self.num_symmetries, len(indices))
+            boards = transform_boards(boards, *self.board_size, symmetries)
+            next_boards = transform_boards(next_boards, *self.board_size, symmetries)
+            actions[...] = transform_cells(actions, *self.board_size, symmetries)
+        self._decode(boards, self.state_flags[indices], states)
+        next_state_flags = self.next_state_flags[indices]
+        self._decode(next_boards, next_state_flags, next_states)
+        np.not_equal(next_state_flags & self.GAME_OVER_BIT, 0, out=dones)
+        rewards[...] = self.rewards[indices]
+        return states, actions, rewards, next_states, dones
+
+    def sample(self, batch_size):
+        return self.get_batch(self.sample_indices(batch_size))
+
+
+class SumTree:
+    # A binary tree of priorities, every node holding the sum of its two children.
+    # Leaves are at tree[leaf_offset:leaf_offset + capacity], the root (the total) is tree[1].
+    # Both the updates and the sampling are vectorized over a batch, one NumPy op per tree level.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.leaf_offset = 1 << max(capacity - 1, 1).bit_length()
+        self.tree = np.zeros(2 * self.leaf_offset, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[self.leaf_offset + indices]
+
+    def update(self, indices, priorities):
+        if not len(indices):
+            return
+        nodes = self.leaf_offset + np.asarray(indices)
+        self.tree[nodes] = priorities
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        # For each value in [0, total), find the leaf where the prefix sums of the priorities exceed it.
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while nodes[0] < self.leaf_offset:
+            left = 2 * nodes
+            left_sums = self.tree[left]
+            go_right = values >= left_sums
+            values -= np.where(go_right, left_sums, 0.0)
+            nodes = left + go_right
+        return nodes - self.leaf_offset
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    # Proportional prioritized replay: a transition is sampled with probability ~ (|TD error| + eps)^alpha.
+    # New transitions get the largest priority seen so far, so each is replayed at least once or so.
+    def __init__(self, capacity, num_cells, alpha=0.6, epsilon=1e-3, symmetry=None, board_size=None):
+        super().__init__(capacity, num_cells, symmetry, board_size)
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.max_priority = 1.0
+        self.priorities = SumTree(capacity)
+
+    def snapshot(self):
+        arrays, counters = super().snapshot()
+        arrays['priorities'] = self.priorities.tree.copy()
+        counters['max_priority'] = self.max_priority
+        return arrays, counters
+
+    def load(self, directory):
+        super().load(directory)
+        self.priorities.tree = np.array(np.load(os.path.join(directory, 'priorities.npy')))
+
+    def append(self, transition):
+        indices = super().append(transition)
+        self.priorities.update(indices, self.max_priority ** self.alpha)
+        return indices
+
+    def append_batch(self, state_reps, actions, rewards, next_state_reps):
+        indices = super().append_batch(state_reps, actions, rewards, next_state_reps)
+        self.priorities.update(indices, self.max_priority ** self.alpha)
+        return indices
+
+    def sample_indices(self, batch_size):
+        # Stratified sampling: one value from each of batch_size equal slices of the total priority.
+        segment = self.priorities.total / batch_size
+        values = (np.arange(batch_size) + np.random.random(batch_size)) * segment
+        # Guard against floating-point round-off sending a value past the last filled leaf.
+        return np.minimum(self.priorities.find(values), self.size - 1)
+
+    def importance_weights(self, indices, beta):
+        # Corrects for the non-uniform sampling, normalized by the largest weight in the batch.
+        probabilities = self.priorities.get(indices) / self.priorities.total
+        weights = (self.size * probabilities) ** -beta
+        return (weights / weights.max()).astype(np.float32)
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(td_errors) + self.epsilon
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.priorities.update(indices, priorities ** self.alpha)
+
+
+def benchmark_sum_tree(capacity, batch_size=64, repeats=2000):
+    tree = SumTree(capacity)
+    tree.update(np.arange(capacity), np.random.random(capacity))
+    indices = np.random.randint(0, capacity, size=(repeats, batch_size))
+    priorities = np.random.random((repeats, batch_size))
+
+    start = time.perf_counter()
+    for i in range(repeats):
+        tree.find(np.random.random(batch_size) * tree.total)
+    sample_time = (time.perf_counter() - start) / repeats
+
+    start = time.perf_counter()
+    for i in range(repeats):
+        tree.update(indices[i], priorities[i])
+    update_time = (time.perf_counter() - start) / repeats
+    return sample_time, update_time
+
+
+if __name__ == '__main__':
+    for capacity in (100_000, 1_000_000):
+        sample_time, update_time = benchmark_sum_tree(capacity)
+        print(f'capacity {capacity}: sample(64) {sample_time * 1e6:.1f} us, update(64) {update_time * 1e6:.1f} us')
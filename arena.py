@@ -0,0 +1,174 @@
+import math
+import random
+import time
+from collections import defaultdict
+from itertools import combinations
+from multiprocessing import Pool
+
+import numpy as np
+import config
+from game.game_logic import GAME_ENGINES
+from game.player import RandomAIPlayer, AIPlayer
+from game.records import open_game_records, game_moves
+
+# A headless arena: round-robin matches between any Player implementations, spread over a process pool.
+# Players are given as specs (PlayerClass, args, kwargs) so that each worker builds its own copies, once.
+# See main.py for watching games with the pygame front end.
+
+
+def play_game(players, board_size_x, board_size_y, moves=None):
+    # players - {1: Player, 2: Player}. Returns (player_lost, moves_count).
+    # moves - a list the moves of the game are appended to (as cells y * board_size_x + x), if given.
+    game = GAME_ENGINES[config.GAME_ENGINE](board_size_x=board_size_x, board_size_y=board_size_y)
+    while game.player_lost == None:
+        move = players[game.current_player].get_move(game.get_state())
+        if not move or not game.make_move(game.current_player, move):
+            raise Exception(f'{players[game.current_player].player_name} could not make a valid move.')
+    if moves is not None:
+        moves.extend(game_moves(game))
+    return game.player_lost, game.moves_count
+
+
+# In a worker: the player specs of the tournament and the players built from them so far, by name.
+_worker_specs = {}
+_worker_players = {}
+
+
+def _init_worker(player_specs):
+    _worker_specs.update(player_specs)
+
+
+def _worker_player(name):
+    # A player is built on its first game in the worker and kept for the others: building an AIPlayer
+    # from a .pth file builds a whole DQNAgent.
+    if name not in _worker_players:
+        player_class, args, kwargs = _worker_specs[name]
+        _worker_players[name] = player_class(*args, **kwargs)
+    return _worker_players[name]
+
+
+def _play_games(name_1, name_2, num_games, board_size_x, board_size_y, seed, record=False):
+    # A chunk of games with the same colours, in a worker. Returns a list of (player_lost, moves_count, moves),
+    # the moves (see play_game) only if record is set, otherwise None.
+    random.seed(seed)
+    np.random.seed(seed)
+    players = {1: _worker_player(name_1), 2: _worker_player(name_2)}
+    results = []
+    for _ in range(num_games):
+        moves = [] if record else None
+        results.append(play_game(players, board_size_x, board_size_y, moves) + (moves,))
+    return results
+
+
+def fit_elo(results, names, iterations=200):
+    # Bradley-Terry ratings (on the Elo scale, averaging 0) from (name_a, name_b, score_a) results,
+    # score 1 for a win of a, 0.5 for a draw. A virtual draw per pair keeps the ratings finite.
+    score = defaultdict(float)
+    games = defaultdict(float)
+    for a, b, s in results:
+        score[a] += s
+        score[b] += 1 - s
+        games[frozenset((a, b))] += 1
+    for pair in games:
+        games[pair] += 1
+        for name in pair:
+            score[name] += 0.5
+
+    gamma = {name: 1.0 for name in names}
+    for _ in range(iterations):
+        for name in names:
+            denominator = sum(n / (gamma[name] + gamma[next(iter(pair - {name}))])
+                              for pair, n in games.items() if name in pair)
+            if denominator:
+                gamma[name] = score[name] / denominator
+        # Keep the scale fixed (the geometric mean at 1).
+        log_mean = sum(math.log(g) for g in gamma.values()) / len(gamma)
+        gamma = {name: g / math.exp(log_mean) for name, g in gamma.items()}
+    ratings = {name: 400 * math.log10(gamma[name]) for name in names}
+    mean = sum(ratings.values()) / len(ratings)
+    return {name: rating - mean for name, rating in ratings.items()}
+
+
+def elo_intervals(results, names, resamples=200, seed=0):
+    # 95% bootstrap intervals of the ratings, resampling the games of each pair.
+    rng = random.Random(seed)
+    by_pair = defaultdict(list)
+    for result in results:
+        by_pair[frozenset(result[:2])].append(result)
+    samples = defaultdict(list)
+    for _ in range(resamples):
+        resampled = [rng.choice(pair_results) for pair_results in by_pair.values() for _ in pair_results]
+        for name, rating in fit_elo(resampled, names, iterations=50).items():
+            samples[name].append(rating)
+    intervals = {}
+    for name, ratings in samples.items():
+        ratings.sort()
+        intervals[name] = (ratings[int(0.025 * resamples)], ratings[int(0.975 * resamples) - 1])
+    return intervals
+
+
+def run_tournament(player_specs, games_per_pair=100, processes=None, chunk_size=10,
+                   board_size_x=None, board_size_y=None, records_file=''):
+    # player_specs - {name: (PlayerClass, args, kwargs)}. Every pair plays games_per_pair games,
+    # half of them with the colours swapped. Returns the per-player stats and prints a report.
+    # records_file - a game record file (game/records.py) the games are appended to, if given.
+    board_size_x = board_size_x or config.BOARD_SIZE_X
+    board_size_y = board_size_y or config.BOARD_SIZE_Y
+    names = list(player_specs)
+
+    tasks = []
+    for name_a, name_b in combinations(names, 2):
+        for first, second, num_games in ((name_a, name_b, (games_per_pair + 1) // 2),
+                                         (name_b, name_a, games_per_pair // 2)):
+            for start in range(0, num_games, chunk_size):
+                tasks.append((first, second, min(chunk_size, num_games - start)))
+
+    # Opened before the games, so that a file for another board size or other players fails at once.
+    # Written here rather than in the workers, so that the file has a single writer.
+    records = open_game_records(records_file, board_size_x, board_size_y, names)
+    try:
+        start_time = time.perf_counter()
+        with Pool(processes, initializer=_init_worker, initargs=(player_specs,)) as pool:
+            chunks = pool.starmap(_play_games, [(first, second, num_games,
+                                                 board_size_x, board_size_y, seed, bool(records_file))
+                                                for seed, (first, second, num_games) in enumerate(tasks)])
+        elapsed = time.perf_counter() - start_time
+
+        if records is not None:
+            for (first, second, _), chunk in zip(tasks, chunks):
+                for player_lost, _, moves in chunk:
+                    records.write_game(moves, player_lost, (names.index(first), names.index(second)))
+    finally:
+        if records is not None:
+            records.close()
+
+    stats = {name: {'wins': 0, 'draws': 0, 'losses': 0, 'moves': 0, 'games': 0} for name in names}
+    results = [] # (name_a, name_b, score_a) for the ratings.
+    for (first, second, _), chunk in zip(tasks, chunks):
+        for player_lost, moves_count, _ in chunk:
+            for name, player_id in ((first, 1), (second, 2)):
+                outcome = 'draws' if player_lost == 0 else 'losses' if player_lost == player_id else 'wins'
+                stats[name][outcome] += 1
+                stats[name]['moves'] += moves_count
+                stats[name]['games'] += 1
+            results.append((first, second, 0.5 if player_lost == 0 else float(player_lost == 2)))
+
+    ratings = fit_elo(results, names)
+    intervals = elo_intervals(results, names)
+    num_games = len(results)
+    print(f'{num_games} games on a {board_size_x}x{board_size_y} board in {elapsed:.1f} s '
+          f'({num_games / elapsed:.1f} games/sec)')
+    for name in sorted(names, key=ratings.get, reverse=True):
+        s = stats[name]
+        s['elo'], s['elo_interval'] = ratings[name], intervals[name]
+        s['mean_game_length'] = s['moves'] / s['games'] if s['games'] else 0.0
+        print(f'{name}: W {s["wins"]} D {s["draws"]} L {s["losses"]}, '
+              f'mean game length {s["mean_game_length"]:.1f}, '
+              f'Elo {s["elo"]:+.0f} [{s["elo_interval"][0]:+.0f}, {s["elo_interval"][1]:+.0f}]')
+    return stats
+
+
+if __name__ == '__main__':
+    player_specs = {'Random': (RandomAIPlayer, ('Random',), {}),
+                    'AI': (AIPlayer, ('AI', 'models/usual_6_by_6.npz'), {})}
+    run_tournament(player_specs, games_per_pair=1000)
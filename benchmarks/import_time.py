@@ -0,0 +1,63 @@
+import os
+import subprocess
+import sys
+
+# The import cost of the headless entry points, measured with python -X importtime in a fresh interpreter.
+# Run from the repo root: python -m benchmarks.import_time. Exits with 1 if an import got too slow
+# or pulled in one of the heavy modules it should not need.
+
+# (statement, milliseconds allowed, modules that must not be imported)
+CHECKS = [
+    ('from game.game_logic import HipGameLogic', 50, ('numpy', 'torch', 'pygame')),
+    ('from game.player import RandomAIPlayer', 50, ('numpy', 'torch', 'pygame')),
+    ('from game.solver import HipSolver', 50, ('numpy', 'torch', 'pygame')),
+    ('import config', 20, ('numpy', 'torch', 'pygame')),
+]
+REPEATS = 5
+
+
+def _run(statement):
+    # The (cumulative microseconds, module name, nesting depth) lines of python -X importtime.
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            cwd=root, env=env, capture_output=True, text=True, check=True)
+    # Lines look like "import time:  self [us] | cumulative | imported package",
+    # the package indented by two spaces per nesting level.
+    lines = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        lines.append((int(cumulative), name.strip(), depth))
+    return lines
+
+
+def import_time(statement):
+    # The cumulative import time of the statement (milliseconds, the best of REPEATS runs)
+    # and the top-level packages it imported. The interpreter's own startup imports are left out.
+    startup = {name for _, name, _ in _run('pass')}
+    best, modules = None, set()
+    for _ in range(REPEATS):
+        total = 0
+        for cumulative, name, depth in _run(statement):
+            if name in startup:
+                continue
+            if depth == 0:
+                total += cumulative
+            modules.add(name.split('.')[0])
+        best = total if best is None else min(best, total)
+    return best / 1000, modules
+
+
+if __name__ == '__main__':
+    failed = False
+    for statement, limit, forbidden in CHECKS:
+        milliseconds, modules = import_time(statement)
+        heavy = [module for module in forbidden if module in modules]
+        ok = milliseconds <= limit and not heavy
+        failed |= not ok
+        print(f'{"ok  " if ok else "FAIL"} {statement}: {milliseconds:.1f} ms (limit {limit} ms)'
+              + (f', imports {", ".join(heavy)}' if heavy else ''))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,315 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import config
+from game.game_logic import GAME_ENGINES
+
+# The benchmark suite of the engine, agent and learner hot paths. From the repo root:
+#   python -m benchmarks.suite [--output results.json] [--baseline old_results.json] [--only engine]
+# Every benchmark is seeded, warmed up and repeated; the results (per-op times, median and spread over
+# the repetitions) go to JSON, by default to DEFAULT_OUTPUT (ignored by git). With a baseline,
+# the benchmarks whose median got slower by more than --threshold are flagged and the exit code is 1.
+
+WARMUP = 1
+REPEATS = 5
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', 'benchmark_results.json')
+
+
+def measure(run, ops):
+    # run() does ops operations. Returns the per-op microseconds over REPEATS runs, after WARMUP runs.
+    for _ in range(WARMUP):
+        run()
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        run()
+        times.append((time.perf_counter() - start) / ops * 1e6)
+    return {'unit': 'us/op', 'median': statistics.median(times), 'min': min(times),
+            'stdev': statistics.stdev(times) if len(times) > 1 else 0.0, 'runs': times}
+
+
+def _random_position(game, fill, rng):
+    # Random moves avoiding own squares until the fill ratio is reached (or no safe move is left).
+    num_cells = game.BOARD_SIZE_X * game.BOARD_SIZE_Y
+    while game.moves_count < fill * num_cells:
+        safe = [(x, y) for y in range(game.BOARD_SIZE_Y) for x in range(game.BOARD_SIZE_X)
+                if not game.board[y][x] and not game.is_losing_move(game.current_player, (x, y))]
+        if not safe or game.moves_count == num_cells - 1:
+            break
+        game.make_move(game.current_player, rng.choice(safe))
+
+
+def bench_engine(results):
+    # make_move + unmake_move on every empty cell of a position, and a full find_square scan,
+    # per engine, board size and fill level.
+    for engine_name, engine in GAME_ENGINES.items():
+        for size in range(4, 11):
+            for fill in (0.0, 0.25, 0.5, 0.75):
+                rng = random.Random(0)
+                game = engine(size, size)
+                _random_position(game, fill, rng)
+                empty = [(x, y) for y in range(size) for x in range(size) if not game.board[y][x]]
+                player = game.current_player
+
+                def moves():
+                    for _ in range(20):
+                        for cell in empty:
+                            game.make_move(player, cell)
+                            game.unmake_move()
+
+                def scans():
+                    for _ in range(200):
+                        game.find_square(player)
+
+                key = f'{engine_name}_{size}x{size}_fill{int(fill * 100)}'
+                results[f'engine/make_move/{key}'] = measure(moves, 20 * len(empty))
+                results[f'engine/find_square/{key}'] = measure(scans, 200)
+
+
+def bench_encoding(results):
+    import numpy as np
+    from game.encoding import encode_states
+    for size in (6, 10):
+        game = GAME_ENGINES['list'](size, size)
+        _random_position(game, 0.5, random.Random(0))
+        state = game.get_state()
+        out = np.empty(size * size + 2, dtype=np.float32)
+
+        def new_arrays():
+            for _ in range(2000):
+                state.get_state_rep()
+
+        def into_buffer():
+            for _ in range(2000):
+                state.get_state_rep(out)
+
+        # A batch of 64 states in one call, per state.
+        states = [state] * 64
+        batch_out = np.empty((64, size * size + 2), dtype=np.float32)
+
+        def batched():
+            for _ in range(2000 // 64):
+                encode_states(states, batch_out)
+
+        results[f'encoding/get_state_rep/{size}x{size}'] = measure(new_arrays, 2000)
+        results[f'encoding/get_state_rep_into_buffer/{size}x{size}'] = measure(into_buffer, 2000)
+        results[f'encoding/encode_states_batch64/{size}x{size}'] = measure(batched, 2000 // 64 * 64)
+
+
+def bench_agent(results):
+    # select_action latency in the play mode (torch), and the NumPy inference engine for comparison.
+    import numpy as np
+    import torch
+    from ai.agent import DQNAgent
+    from ai.numpy_model import NumpyQNetwork
+    torch.manual_seed(0)
+    np.random.seed(0)
+    agent = DQNAgent(config, play_mode=True)
+    game = GAME_ENGINES['list'](config.BOARD_SIZE_X, config.BOARD_SIZE_Y)
+    _random_position(game, 0.5, random.Random(0))
+    state_rep = game.get_state().get_state_rep()
+
+    def torch_actions():
+        for _ in range(500):
+            agent.select_action(state_rep)
+
+    results['agent/select_action/torch'] = measure(torch_actions, 500)
+
+    with tempfile.TemporaryDirectory() as directory:
+        weights_file = os.path.join(directory, 'weights.npz')
+        np.savez(weights_file, **{name: tensor.numpy() for name, tensor in agent.model.state_dict().items()})
+        numpy_model = NumpyQNetwork(weights_file)
+    state_reps = state_rep[None, :]
+
+    def numpy_actions():
+        for _ in range(500):
+            numpy_model.select_actions(state_reps)
+
+    results['agent/select_action/numpy'] = measure(numpy_actions, 500)
+
+
+def bench_replay(results):
+    import numpy as np
+    from ai.replay import ReplayBuffer, PrioritizedReplayBuffer
+    num_cells = config.BOARD_SIZE_X * config.BOARD_SIZE_Y
+    board_size = (config.BOARD_SIZE_X, config.BOARD_SIZE_Y)
+    for buffer_class, symmetry in ((ReplayBuffer, None), (PrioritizedReplayBuffer, None), (ReplayBuffer, 'augment')):
+        np.random.seed(0)
+        memory = buffer_class(100_000, num_cells, symmetry=symmetry, board_size=board_size)
+        for _ in range(100):
+            state_reps = np.zeros((1000, num_cells + 2), dtype=np.float32)
+            state_reps[:, :-2] = np.random.randint(0, 3, (1000, num_cells))
+            memory.append_batch(state_reps, np.random.randint(0, num_cells, 1000),
+                                np.random.random(1000).astype(np.float32), state_reps)
+        batch = memory.new_batch(64)
+
+        def sample():
+            for _ in range(500):
+                memory.get_batch(memory.sample_indices(64), batch)
+
+        results[f'replay/sample_64/{buffer_class.__name__}' + (f'_{symmetry}' if symmetry else '')] = \
+            measure(sample, 500)
+
+
+def bench_train_step(results):
+    import numpy as np
+    import torch
+    from ai.model import Linear_QNetwork, QTrainer
+    num_cells = config.BOARD_SIZE_X * config.BOARD_SIZE_Y
+    for batch_size in (32, 64, 256, 1024):
+        torch.manual_seed(0)
+        rng = np.random.default_rng(0)
+        model = Linear_QNetwork(num_cells + 2, 256, num_cells)
+        trainer = QTrainer(model, lr=config.LR, gamma=config.GAMMA)
+        states = torch.from_numpy(rng.integers(0, 3, (batch_size, num_cells + 2)).astype(np.float32))
+        actions = torch.from_numpy(rng.integers(0, num_cells, batch_size))
+        rewards = torch.from_numpy(rng.random(batch_size).astype(np.float32))
+        dones = torch.from_numpy(rng.random(batch_size) < 0.05)
+
+        def steps():
+            for _ in range(50):
+                trainer.train_step(states, actions, rewards, states, dones)
+
+        result = measure(steps, 50)
+        result['samples_per_sec'] = batch_size / result['median'] * 1e6
+        results[f'learner/train_step/batch{batch_size}'] = result
+
+
+def bench_q_networks(results):
+    # Batched inference (one forward pass) and a train step of the linear and the convolutional Q-networks,
+    # per board size. The linear network is a new one per size, the convolutional one is the same for all.
+    import numpy as np
+    import torch
+    from ai.model import Linear_QNetwork, Conv_QNetwork, QTrainer
+    torch.manual_seed(0)
+    conv_model = Conv_QNetwork(6, 6, channels=config.CONV_CHANNELS, dilations=config.CONV_DILATIONS)
+    for size in (6, 8, 10, 12):
+        num_cells = size * size
+        rng = np.random.default_rng(0)
+        conv_model.set_board_size(size, size)
+        models = {'linear': Linear_QNetwork(num_cells + 2, config.HIDDEN_SIZE, num_cells), 'conv': conv_model}
+        for name, model in models.items():
+            for batch_size in (1, 256):
+                states = np.zeros((batch_size, num_cells + 2), dtype=np.float32)
+                states[:, :-2] = rng.integers(0, 3, (batch_size, num_cells))
+                states[:, -2] = rng.choice([-0.5, 0.5], batch_size)
+                states = torch.from_numpy(states)
+
+                def forward():
+                    with torch.inference_mode():
+                        for _ in range(20):
+                            model(states)
+
+                result = measure(forward, 20)
+                result['states_per_sec'] = batch_size / result['median'] * 1e6
+                results[f'q_networks/forward/{name}_{size}x{size}_batch{batch_size}'] = result
+
+            trainer = QTrainer(model, lr=config.LR, gamma=config.GAMMA)
+            states = states[:64]
+            actions = torch.from_numpy(rng.integers(0, num_cells, 64))
+            rewards = torch.from_numpy(rng.random(64).astype(np.float32))
+            dones = torch.from_numpy(rng.random(64) < 0.05)
+
+            def steps():
+                for _ in range(5):
+                    trainer.train_step(states, actions, rewards, states, dones)
+
+            results[f'q_networks/train_step/{name}_{size}x{size}_batch64'] = measure(steps, 5)
+
+
+def bench_self_play(results):
+    # Whole games per second: random players through arena.play_game, and the DQN agent (epsilon-greedy,
+    # no training) playing both sides.
+    from arena import play_game
+    from game.player import RandomAIPlayer
+    random.seed(0)
+    players = {1: RandomAIPlayer('1'), 2: RandomAIPlayer('2')}
+
+    def random_games():
+        for _ in range(200):
+            play_game(players, config.BOARD_SIZE_X, config.BOARD_SIZE_Y)
+
+    result = measure(random_games, 200)
+    result['games_per_sec'] = 1e6 / result['median']
+    results['self_play/random'] = result
+
+    import numpy as np
+    import torch
+    from ai.agent import DQNAgent
+    torch.manual_seed(0)
+    np.random.seed(0)
+    agent = DQNAgent(config)
+    agent.epsilon = 0.1
+    game = GAME_ENGINES[config.GAME_ENGINE](config.BOARD_SIZE_X, config.BOARD_SIZE_Y)
+
+    def dqn_games():
+        for _ in range(20):
+            game.reset_game()
+            while game.player_lost is None:
+                game.make_move(game.current_player, agent.select_action(game.get_state().get_state_rep()))
+
+    result = measure(dqn_games, 20)
+    result['games_per_sec'] = 1e6 / result['median']
+    results['self_play/dqn'] = result
+
+
+BENCHMARKS = {'engine': bench_engine, 'encoding': bench_encoding, 'agent': bench_agent,
+              'replay': bench_replay, 'learner': bench_train_step, 'q_networks': bench_q_networks,
+              'self_play': bench_self_play}
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'date': datetime.now(timezone.utc).isoformat(), 'commit': commit, 'python': sys.version.split()[0],
+            'platform': platform.platform(), 'warmup': WARMUP, 'repeats': REPEATS,
+            'board_size': [config.BOARD_SIZE_X, config.BOARD_SIZE_Y]}
+
+
+def compare(results, baseline, threshold):
+    # The benchmarks slower than in the baseline by more than threshold (a fraction), as (name, ratio).
+    regressions = []
+    for name, result in results.items():
+        if name in baseline:
+            ratio = result['median'] / baseline[name]['median']
+            if ratio > 1 + threshold:
+                regressions.append((name, ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the benchmark suite.')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', help='Earlier results to compare with.')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Slowdown flagged as a regression.')
+    parser.add_argument('--only', nargs='*', choices=list(BENCHMARKS), help='Run only these groups.')
+    args = parser.parse_args()
+
+    results = {}
+    for group in args.only or BENCHMARKS:
+        start = time.perf_counter()
+        BENCHMARKS[group](results)
+        print(f'{group}: {time.perf_counter() - start:.1f} s', file=sys.stderr)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({'meta': metadata(), 'results': results}, f, indent=1)
+    for name, result in results.items():
+        print(f'{name}: {result["median"]:.2f} us/op (min {result["min"]:.2f}, stdev {result["stdev"]:.2f})')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.threshold)
+        for name, ratio in regressions:
+            print(f'REGRESSION {name}: {ratio:.2f}x the baseline')
+        sys.exit(1 if regressions else 0)
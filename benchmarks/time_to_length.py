@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Wall-clock time of the sequential training session until the rolling mean game length reaches a target
+# (about 27 moves on 6x6 after training, see the README), for several learner schedules. From the repo root:
+#   python -m benchmarks.time_to_length [--target 27] [--max-episodes 50000] [--only baseline every4_batch256]
+# Every setting runs seeded in a fresh process, as the torch thread pools can only be sized once per process.
+# The results go to JSON, by default to DEFAULT_OUTPUT (ignored by git).
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', 'time_to_length.json')
+
+# config overrides per setting.
+SETTINGS = {
+    'baseline': {},
+    'every4_batch256': {'TRAIN_EVERY': 4, 'BATCH_SIZE': 256},
+    'every8_steps2_batch256': {'TRAIN_EVERY': 8, 'TRAIN_GRADIENT_STEPS': 2, 'BATCH_SIZE': 256},
+    'every16_batch1024': {'TRAIN_EVERY': 16, 'BATCH_SIZE': 1024},
+    'every4_batch256_compile': {'TRAIN_EVERY': 4, 'BATCH_SIZE': 256, 'TORCH_COMPILE': True},
+    'every4_batch256_threads1': {'TRAIN_EVERY': 4, 'BATCH_SIZE': 256,
+                                 'TORCH_NUM_THREADS': 1, 'TORCH_INTEROP_THREADS': 1},
+    'every4_batch256_augment': {'TRAIN_EVERY': 4, 'BATCH_SIZE': 256, 'REPLAY_SYMMETRY': 'augment'},
+    'every4_batch256_canonical': {'TRAIN_EVERY': 4, 'BATCH_SIZE': 256, 'REPLAY_SYMMETRY': 'canonical'},
+    'conv_every4_batch64': {'Q_NETWORK': 'conv', 'TRAIN_EVERY': 4, 'EPSILON_DECAY': 5000},
+    'conv_every4_batch64_augment': {'Q_NETWORK': 'conv', 'TRAIN_EVERY': 4, 'EPSILON_DECAY': 5000,
+                                    'REPLAY_SYMMETRY': 'augment'},
+}
+
+
+def _run(overrides, target, max_episodes):
+    # In a fresh process: one training session, then its results as JSON on the last line.
+    import random
+    import statistics
+    import time
+    import numpy as np
+    import torch
+    import config
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    # The numbers come from the session itself, at the game it stopped on, and no files are written.
+    config.METRICS_FILE = ''
+    config.SAVE_EVERY = max_episodes + 1
+    from ai.agent import DQNAgent
+    from train_agent import run_training_session, reached_game_length, reward_usual
+
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    agent = DQNAgent(config, reward_function=reward_usual)
+    start = time.perf_counter()
+    game_length, env_steps = run_training_session(agent, num_episodes=max_episodes, target_game_length=target)
+    seconds = time.perf_counter() - start
+    print(json.dumps({'seconds': seconds, 'games': agent.games_played,
+                      'reached': bool(reached_game_length(game_length, target)),
+                      'env_steps': env_steps, 'train_steps': agent.training_steps_count,
+                      'mean_game_length': statistics.mean(game_length), 'epsilon': agent.epsilon}))
+
+
+def run(name, target, max_episodes):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', f'from benchmarks.time_to_length import _run; '
+                                                   f'_run({SETTINGS[name]!r}, {target!r}, {max_episodes})'],
+                            cwd=root, env=dict(os.environ, PYTHONPATH=root),
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.split('\n')[-2])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the training to a mean game length.')
+    parser.add_argument('--target', type=float, default=27)
+    parser.add_argument('--max-episodes', type=int, default=50_000)
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--only', nargs='*', choices=list(SETTINGS), help='Run only these settings.')
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    results = {}
+    for name in args.only or SETTINGS:
+        results[name] = dict(run(name, args.target, args.max_episodes), config=SETTINGS[name])
+        result = results[name]
+        print(f'{name}: {result["seconds"]:.0f} s, {result["games"]} games, {result["env_steps"]} env steps, '
+              f'{result["train_steps"]} train steps, mean game length {result["mean_game_length"]:.2f}'
+              + ('' if result['reached'] else ' (target not reached)'), flush=True)
+        # Written after every setting, as the whole run takes hours.
+        with open(args.output, 'w') as f:
+            json.dump({'target': args.target, 'max_episodes': args.max_episodes, 'results': results}, f, indent=1)
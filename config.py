@@ -1,11 +1,16 @@
-import pygame
+# Pure data only: no imports here, so that the game logic and the headless tools
+# do not pull in pygame or torch through the config.
 
+# Game settings
 BOARD_SIZE_X = 6
 BOARD_SIZE_Y = 6
 
+# 'list' (HipGameLogic) or 'bitboard' (HipBitboardLogic), see game.game_logic.GAME_ENGINES.
+GAME_ENGINE = 'list'
+
+# Graphics settings (pygame, game_graphics/ and main.py)
 GAME_TITLE = f'{BOARD_SIZE_X}x{BOARD_SIZE_Y} Hip Game'
 
-# Graphics settings
 CELL_SIZE = 80
 MARGIN = 50    
 
@@ -26,16 +31,30 @@ BUTTON_TEXT_COLOR = 0x000000
 MSGBOX_TEXT_COLOR = 0x000000
 MSGBOX_COLOR = 0xFFFFFF
 MSGBOX_BORDER_COLOR = 0x000000
-MSGBOX_RECT = pygame.Rect(WIDTH // 2 - 100, HEIGHT // 2 - 20, 200, 40)
+# (left, top, width, height), made into a pygame.Rect by HipGameGraphics.
+MSGBOX_RECT = (WIDTH // 2 - 100, HEIGHT // 2 - 20, 200, 40)
 
 FONT = None
 FONT_SIZE = 28
 
-# DQN training parameters.
+# The frame cap of the main loop while bots are playing.
+FPS = 30
+
+# DQN training parameters (torch, ai/ and train_agent.py).
+# The Q-network: 'linear' (ai.model.Linear_QNetwork, for one board size) or 'conv' (ai.model.Conv_QNetwork,
+# fully convolutional, for any board size). A model file is loaded into the network chosen here.
+Q_NETWORK = 'linear'
+HIDDEN_SIZE = 256
+CONV_CHANNELS = 32
+CONV_DILATIONS = (1, 2, 4, 8, 1)
 MAX_MEMORY = 100000
 BATCH_SIZE = 64
 LR = 0.001
 SAVE_EVERY = 80 
+# Full checkpoints (weights, target network, optimizer, replay memory, epsilon, counters, random states)
+# are written there every SAVE_EVERY games, if set. Pass the directory as load_model_from to resume.
+CHECKPOINT_DIR = ''
+CHECKPOINT_KEEP = 2
 
 EPSILON_START = 0.99
 EPSILON_END = 0.01
@@ -45,6 +64,80 @@ GAMMA = 0.9
 
 TARGET_UPDATE_FREQUENCY = 100
 
+# The learner schedule: TRAIN_GRADIENT_STEPS gradient steps (on a batch of BATCH_SIZE each) every TRAIN_EVERY
+# env steps, that is TRAIN_GRADIENT_STEPS / TRAIN_EVERY steps per env step. The actor/learner session keeps
+# the learner at most at that ratio. Training less often on larger batches cuts the per-step Python overhead.
+TRAIN_EVERY = 1
+TRAIN_GRADIENT_STEPS = 1
+# torch.compile the forward passes of the training steps (needs a C compiler; the first steps are slow).
+TORCH_COMPILE = False
+# torch.set_num_threads / torch.set_num_interop_threads for the training process. None for the torch defaults.
+TORCH_NUM_THREADS = None
+TORCH_INTEROP_THREADS = None
+
+# Prioritized experience replay (ai.replay.PrioritizedReplayBuffer) instead of the uniform one.
+PRIORITIZED_REPLAY = False
+PER_ALPHA = 0.6
+PER_EPSILON = 0.001
+# The importance-sampling exponent beta is annealed to 1 over this many training steps.
+PER_BETA_START = 0.4
+PER_BETA_STEPS = 100000
+
+# The board symmetries (8 on a square board, 4 on a rectangular one) in the replay memory. None for none;
+# 'augment': every sampled transition is replaced by a random rotation or reflection of it;
+# 'canonical': the transitions are stored in the canonical orientation of their states, once each,
+# and the agent acts on the canonical orientations (a model trained so needs the same setting to play).
+REPLAY_SYMMETRY = None
+
+# Mask out the moves completing own square (while there are others) when acting, exploring included.
+AVOID_LOSING_MOVES = False
+
+# Actor/learner training (train_agent.run_parallel_training_session).
+NUM_ACTORS = 4
+# The learner publishes its weights to the actors every that many training steps.
+ACTOR_SYNC_EVERY = 100
+# The maximum number of finished games waiting for the learner.
+ACTOR_QUEUE_SIZE = 256
+
 # When reporting on training progress.
 ROLLING_AVG_WINDOW = 1000
+# A JSONL (or, by the extension, CSV) file for a record of the training metrics every METRICS_EVERY games:
+# steps/sec, loss, epsilon, replay fill and the time per env step in each phase. '' for none.
+METRICS_FILE = ''
+METRICS_EVERY = 100
+# Profile the first PROFILE_STEPS steps (env steps, or learner train steps in the actor/learner session)
+# with 'cprofile' or 'torch' (torch.profiler), written to PROFILE_OUTPUT + '.prof' / '.json'. None for no profiling.
+PROFILE = None
+PROFILE_STEPS = 2000
+PROFILE_OUTPUT = 'profile'
+# The self-play games of the training sessions are appended to this game record file (game/records.py),
+# e.g. for train_agent.run_offline_training. '' for none.
+GAME_RECORDS_FILE = ''
 
+# Players (game/player.py)
+# AIPlayer: the number of positions whose chosen moves are remembered.
+AI_MOVE_CACHE_SIZE = 4096
+# MCTSPlayer: simulations per move, unless a time budget (seconds per move) is set.
+MCTS_SIMULATIONS = 800
+MCTS_TIME_BUDGET = None
+# Leaves evaluated together (one forward pass of the network), with virtual loss on their paths.
+MCTS_BATCH_SIZE = 8
+MCTS_VIRTUAL_LOSS = 1
+MCTS_C_PUCT = 1.5
+# With a model: priors are the softmax of Q-values / temperature over the empty cells.
+MCTS_PRIOR_TEMPERATURE = 1.0
+# Leaf values from tanh(max Q / scale) instead of random playouts.
+MCTS_NETWORK_VALUES = False
+MCTS_VALUE_SCALE = 10.0
+# An endgame tablebase (game/tablebase.py) for the board size: AIPlayer plays its best moves, MCTSPlayer
+# takes its values at the leaves and the sequential training its outcomes as terminal targets. Off if empty.
+TABLEBASE_FILE = ''
+# A position cache shared by the AI players of all the processes (game/position_cache.py): the moves (and values)
+# computed for the positions seen, looked up before inference. Off if empty.
+POSITION_CACHE_FILE = ''
+# The number of entries of a new cache file (32 bytes each), rounded up to a power of two.
+POSITION_CACHE_ENTRIES = 1 << 20
+# Whether the players add the moves they compute, or only look up (e.g. a finished opening book).
+POSITION_CACHE_WRITE = True
+# Only the positions before this move of a game are cached: later ones rarely recur.
+POSITION_CACHE_MAX_MOVES = 8
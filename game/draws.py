@@ -0,0 +1,146 @@
+import time
+from functools import lru_cache
+from itertools import product
+from multiprocessing import Pool
+from game.game_logic import HipGameState, get_square_masks, get_symmetries, masks_to_board
+
+# Enumerating the draws: the full-board colourings with no single-colour square,
+# player 1 (who starts) holding ceil(n/2) of the n cells and player 2 holding the rest.
+
+
+@lru_cache(maxsize=None)
+def _search_tables(board_size_x, board_size_y):
+    # The cell order of the backtracking, and for each position in it the squares completed there
+    # (the masks of their other three vertices).
+    num_cells = board_size_x * board_size_y
+    symmetries = get_symmetries(board_size_x, board_size_y)
+
+    # The prefix is the orbit of the corner cells under the symmetries, so the symmetries act on the prefix
+    # colourings and only one prefix per orbit needs to be searched. The rest goes row by row,
+    # which completes the small squares (and prunes) early.
+    prefix = sorted({perm[0] for perm in symmetries})
+    order = prefix + [cell for cell in range(num_cells) if cell not in prefix]
+    position = {cell: i for i, cell in enumerate(order)}
+
+    square_masks, _ = get_square_masks(board_size_x, board_size_y)
+    closing = [[] for _ in range(num_cells)]
+    for square_mask in square_masks:
+        cells = [cell for cell in range(num_cells) if square_mask >> cell & 1]
+        last = max(cells, key=position.get)
+        closing[position[last]].append(square_mask & ~(1 << last))
+    return order, len(prefix), closing
+
+
+def _search(board_size_x, board_size_y, prefix_colours):
+    # All the draws starting with the given prefix colouring. Returns (draws as mask pairs, nodes visited).
+    order, _, closing = _search_tables(board_size_x, board_size_y)
+    num_cells = len(order)
+    masks = [0, 0, 0]
+    left = [0, (num_cells + 1) // 2, num_cells // 2] # The disks left to place for each player.
+    for i, colour in enumerate(prefix_colours):
+        masks[colour] |= 1 << order[i]
+        left[colour] -= 1
+    if left[1] < 0 or left[2] < 0:
+        return [], 0
+    # The squares closing in the prefix (the four corners of a square board) are not checked by extend.
+    for pos in range(len(prefix_colours)):
+        mask = masks[prefix_colours[pos]]
+        if any(mask & rest == rest for rest in closing[pos]):
+            return [], 0
+
+    draws = []
+    nodes = 0
+
+    def extend(pos):
+        nonlocal nodes
+        if pos == num_cells:
+            draws.append((masks[1], masks[2]))
+            return
+        bit = 1 << order[pos]
+        for colour in (1, 2):
+            if not left[colour]:
+                continue
+            mask = masks[colour] | bit
+            if any(mask & rest == rest for rest in closing[pos]):
+                continue # A single-colour square.
+            nodes += 1
+            masks[colour] = mask
+            left[colour] -= 1
+            extend(pos + 1)
+            masks[colour] ^= bit
+            left[colour] += 1
+
+    extend(len(prefix_colours))
+    return draws, nodes
+
+
+def _transform(masks, perm):
+    return tuple(sum(1 << perm[cell] for cell in range(len(perm)) if mask >> cell & 1) for mask in masks)
+
+
+def canonical_form(masks, board_size_x, board_size_y, colour_swap=False):
+    # The smallest image of a position under the board symmetries (and swapping the colours, if asked).
+    images = [masks, masks[::-1]] if colour_swap else [masks]
+    return min(_transform(image, perm) for image in images for perm in get_symmetries(board_size_x, board_size_y))
+
+
+def enumerate_draws(board_size_x, board_size_y, processes=None):
+    # Returns all the draws as (player 1 mask, player 2 mask) pairs, the classes of draws up to symmetry
+    # (their canonical forms) and the number of search nodes. The search is split by prefix over a process pool.
+    # With an even number of cells swapping the colours of a draw gives a draw too, and the classes
+    # are taken up to that as well (this is how the 24 6x6 draws make 3 configurations).
+    order, prefix_length, _ = _search_tables(board_size_x, board_size_y)
+    symmetries = get_symmetries(board_size_x, board_size_y)
+    prefix_position = {cell: i for i, cell in enumerate(order[:prefix_length])}
+
+    # One prefix colouring per orbit under the symmetries (which permute the prefix cells).
+    representatives = set()
+    for colours in product((1, 2), repeat=prefix_length):
+        images = [tuple(colours[prefix_position[perm[cell]]] for cell in order[:prefix_length])
+                  for perm in symmetries]
+        representatives.add(min(images))
+
+    with Pool(processes) as pool:
+        results = pool.starmap(_search, [(board_size_x, board_size_y, colours) for colours in sorted(representatives)])
+
+    # Every draw is the image of one found under a representative prefix.
+    draws = set()
+    nodes = 0
+    for found, found_nodes in results:
+        nodes += found_nodes
+        for masks in found:
+            draws.update(_transform(masks, perm) for perm in symmetries)
+    colour_swap = (board_size_x * board_size_y) % 2 == 0
+    classes = sorted({canonical_form(masks, board_size_x, board_size_y, colour_swap) for masks in draws})
+    return sorted(draws), classes, nodes
+
+
+def save_draw_images(draws, filename_prefix='draw_'):
+    # Render the draws (as mask pairs) with HipGameGraphics, one image per draw.
+    # The board size of the graphics is the one in config.
+    import os
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    import config
+    from game_graphics.rendering import HipGameGraphics
+
+    pygame.init()
+    screen = pygame.display.set_mode((config.WIDTH, config.HEIGHT))
+    graphics = HipGameGraphics(screen, players={})
+    for i, masks in enumerate(draws):
+        board = masks_to_board((0,) + tuple(masks), config.BOARD_SIZE_X, config.BOARD_SIZE_Y)
+        state = HipGameState(board, current_player=1, player_lost=None, square_found=None,
+                             moves_count=config.BOARD_SIZE_X * config.BOARD_SIZE_Y)
+        graphics.save_screenshot(f'{filename_prefix}{i}.png', state)
+    pygame.quit()
+
+
+if __name__ == '__main__':
+    for board_size in (5, 6, 7):
+        start = time.perf_counter()
+        draws, classes, nodes = enumerate_draws(board_size, board_size)
+        seconds = time.perf_counter() - start
+        print(f'{board_size}x{board_size}: {len(draws)} draws, {len(classes)} up to symmetry, '
+              f'{nodes} nodes in {seconds:.2f} s ({nodes / seconds:.0f} nodes/sec)')
+        if board_size == 6:
+            save_draw_images(classes)
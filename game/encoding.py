@@ -0,0 +1,99 @@
+from functools import lru_cache
+import numpy as np
+from game.game_logic import get_symmetries
+
+# Encoders of game states into caller-provided NumPy buffers, float32 (for the network) or int8 (for storage).
+# The flat layout is the one of HipGameState.get_state_rep: the board row by row (0 empty, 1 or 2 the player),
+# then the player to move (-0.5 for player 1, 0.5 for player 2) and the game-over flag.
+# The int8 buffers cannot hold +-0.5, so there the player to move is stored as 0 or 1 instead.
+
+
+def state_rep_size(board_size_x, board_size_y):
+    return board_size_x * board_size_y + 2
+
+
+def encode_state(game_state, out):
+    # Write one state into out, a 1-D buffer of state_rep_size. Returns out.
+    board = game_state.board
+    out[:-2].reshape(len(board), len(board[0]))[...] = board
+    if out.dtype == np.int8:
+        out[-2] = game_state.current_player - 1
+    else:
+        out[-2] = game_state.current_player - 1.5
+    out[-1] = game_state.player_lost is not None
+    return out
+
+
+def encode_boards(boards, players, game_over, out):
+    # The batched version over arrays: boards (N, BOARD_SIZE_Y, BOARD_SIZE_X) or (N, cells), players (N,)
+    # the player to move and game_over (N,) the game-over flags (or scalars for all the rows).
+    # Row i of out (N, state_rep_size) gets board i. Returns out[:N].
+    boards = np.asarray(boards)
+    out = out[:len(boards)]
+    out[:, :-2] = boards.reshape(len(boards), -1)
+    out[:, -2] = np.asarray(players) - (1 if out.dtype == np.int8 else 1.5)
+    out[:, -1] = game_over
+    return out
+
+
+def encode_states(game_states, out):
+    # Row i of out (N, state_rep_size) gets game_states[i]. Returns out[:len(game_states)].
+    return encode_boards([game_state.board for game_state in game_states],
+                         [game_state.current_player for game_state in game_states],
+                         [game_state.player_lost is not None for game_state in game_states], out)
+
+
+def encode_planes(game_states, out):
+    # A one-hot layout relative to the player to move, for convolutional models:
+    # out (N, 3, BOARD_SIZE_Y, BOARD_SIZE_X) gets the planes of own disks, the opponent's disks and the empty cells.
+    # Returns out[:len(game_states)].
+    boards = np.asarray([game_state.board for game_state in game_states])
+    players = np.array([game_state.current_player for game_state in game_states]).reshape(-1, 1, 1)
+    out = out[:len(boards)]
+    np.equal(boards, players, out=out[:, 0])
+    np.equal(boards, 3 - players, out=out[:, 1])
+    np.equal(boards, 0, out=out[:, 2])
+    return out
+
+
+# The board symmetries (see game.game_logic.get_symmetries) applied to flat boards, vectorized over a batch:
+# board i is transformed by symmetry symmetries[i]. The moves are mapped with transform_cells.
+
+@lru_cache(maxsize=None)
+def symmetry_arrays(board_size_x, board_size_y):
+    # cell_images[k, c] is the image of cell c under symmetry k, and gathers[k] its inverse:
+    # board[gathers[k]] is the image of the board.
+    cell_images = np.array(get_symmetries(board_size_x, board_size_y), dtype=np.intp)
+    return cell_images, np.argsort(cell_images, axis=1)
+
+
+def transform_boards(boards, board_size_x, board_size_y, symmetries):
+    # boards (N, BOARD_SIZE_X*BOARD_SIZE_Y) -> a new array of their images.
+    _, gathers = symmetry_arrays(board_size_x, board_size_y)
+    return np.take_along_axis(boards, gathers[symmetries], axis=1)
+
+
+def transform_cells(cells, board_size_x, board_size_y, symmetries):
+    # Flat cell indices (N,) -> their images.
+    cell_images, _ = symmetry_arrays(board_size_x, board_size_y)
+    return cell_images[symmetries, cells]
+
+
+def inverse_transform_cells(cells, board_size_x, board_size_y, symmetries):
+    # The cells whose images are cells (N,): the moves on the original boards.
+    _, gathers = symmetry_arrays(board_size_x, board_size_y)
+    return gathers[symmetries, cells]
+
+
+def canonical_symmetries(boards, board_size_x, board_size_y):
+    # (N,) the symmetry taking each board to its canonical form, the lexicographically smallest image.
+    # The images are compared by 31 cells at a time, packed 2 bits per cell into an int64.
+    _, gathers = symmetry_arrays(board_size_x, board_size_y)
+    images = boards[:, gathers] # (N, number of symmetries, cells)
+    candidates = np.ones(images.shape[:2], dtype=bool)
+    for start in range(0, images.shape[2], 31):
+        chunk = images[:, :, start:start + 31].astype(np.int64)
+        keys = chunk @ (4 ** np.arange(chunk.shape[2] - 1, -1, -1, dtype=np.int64))
+        keys = np.where(candidates, keys, np.iinfo(np.int64).max)
+        candidates &= keys == keys.min(axis=1, keepdims=True)
+    return candidates.argmax(axis=1)
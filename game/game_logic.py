@@ -1,36 +1,193 @@
-import numpy as np
+from functools import lru_cache
+
+# numpy and the encoders are imported at the first get_state_rep (see _import_encoding), so that the game logic
+# imports without numpy. game.encoding imports this module too.
+np = encode_state = None
+
+
+def _import_encoding():
+    global np, encode_state
+    import numpy
+    from game.encoding import encode_state as encode
+    np, encode_state = numpy, encode
+
 
 class HipGameState:
-    def __init__(self, board, current_player, player_lost, square_found, moves_count):
+    def __init__(self, board, current_player, player_lost, square_found, moves_count, threats=None):
         self.board = board
         self.current_player = current_player
         self.player_lost = player_lost
         self.square_found = square_found
         self.moves_count = moves_count
+        # The ThreatMap of the game the state comes from, if any. It is live (like the board of HipGameLogic):
+        # it describes the position until the next move.
+        self.threats = threats
+
+    def get_state_rep(self, out=None):
+        # The state as a float32 array: the flattened board, the normalized player ID (-0.5 or 0.5)
+        # and the game-over flag. Written into out if given (see game/encoding.py for the batched encoders).
+        if encode_state is None:
+            _import_encoding()
+        if out is None:
+            out = np.empty(len(self.board) * len(self.board[0]) + 2, dtype=np.float32)
+        return encode_state(self, out)
+
+
+@lru_cache(maxsize=None)
+def get_squares(board_size_x, board_size_y):
+    # All the squares (axis-aligned and tilted) on a board of the given size, computed once per size.
+    # Each square is listed once as the vertex tuple ((x1, y1), (x2, y2), (x3, y3), (x4, y4)) 
+    # in the same order as HipGameLogic.find_square scans the board, 
+    # so the first complete square in this list is the one find_square would report.
+    squares = []
+    seen = set()
+    for y1 in range(board_size_y):
+        for x1 in range(board_size_x):
+            for y2 in range(y1, board_size_y):
+                for x2 in range(x1, board_size_x):
+                    if y1 == y2 and x1 == x2:
+                        continue
+                    delta_y = y2 - y1
+                    delta_x = x2 - x1
+                    y3, x3 = y2 + delta_x, x2 - delta_y
+                    y4, x4 = y1 + delta_x, x1 - delta_y
+                    if 0 <= y3 < board_size_y and 0 <= x3 < board_size_x \
+                            and 0 <= y4 < board_size_y and 0 <= x4 < board_size_x:
+                        square = ((x1, y1), (x2, y2), (x3, y3), (x4, y4))
+                        # An axis-aligned square is met twice in the scan, keep its first occurrence.
+                        if frozenset(square) not in seen:
+                            seen.add(frozenset(square))
+                            squares.append(square)
+
+    # Per-cell index: cell_squares[y * board_size_x + x] lists (in scan order) the squares through (x, y).
+    cell_squares = [[] for _ in range(board_size_x * board_size_y)]
+    for square in squares:
+        for (x, y) in square:
+            cell_squares[y * board_size_x + x].append(square)
+    return tuple(squares), tuple(tuple(s) for s in cell_squares)
+
+
+@lru_cache(maxsize=None)
+def get_symmetries(board_size_x, board_size_y):
+    # The symmetries of the board as permutations of the cells: perm[y * board_size_x + x] is the image of (x, y).
+    # 8 (rotations and reflections) for a square board, 4 for a rectangular one. The identity comes first.
+    X, Y = board_size_x - 1, board_size_y - 1
+    maps = [lambda x, y: (x, y), lambda x, y: (X - x, Y - y),
+            lambda x, y: (X - x, y), lambda x, y: (x, Y - y)]
+    if board_size_x == board_size_y:
+        maps += [lambda x, y: (y, x), lambda x, y: (Y - y, X - x),
+                 lambda x, y: (Y - y, x), lambda x, y: (y, X - x)]
+    symmetries = []
+    for f in maps:
+        perm = [0] * (board_size_x * board_size_y)
+        for y in range(board_size_y):
+            for x in range(board_size_x):
+                fx, fy = f(x, y)
+                perm[y * board_size_x + x] = fy * board_size_x + fx
+        symmetries.append(tuple(perm))
+    return tuple(symmetries)
+
+
+@lru_cache(maxsize=None)
+def get_square_cells(board_size_x, board_size_y):
+    # get_squares with flat cell indices: per square the sum of its cells, and per cell the ids of the squares
+    # through it (in scan order).
+    squares, _ = get_squares(board_size_x, board_size_y)
+    square_sums = tuple(sum(y * board_size_x + x for (x, y) in square) for square in squares)
+    cell_square_ids = [[] for _ in range(board_size_x * board_size_y)]
+    for s, square in enumerate(squares):
+        for (x, y) in square:
+            cell_square_ids[y * board_size_x + x].append(s)
+    return square_sums, tuple(tuple(ids) for ids in cell_square_ids)
+
+
+class ThreatMap:
+    # Maintained on every move (and undo): per player, the number of own disks on each square,
+    # and for each cell the number of squares the player would complete by playing there
+    # (the squares whose other three vertices the player holds).
+    # A square's entry packs the count (from bit 16 up) with the sum of the player's cells on it (the low bits),
+    # so the missing vertex of a square with three is the sum of its cells minus that sum.
+    COUNT_ONE = 1 << 16
+    CELLS_SUM = COUNT_ONE - 1
+
+    def __init__(self, board_size_x, board_size_y):
+        self.squares, _ = get_squares(board_size_x, board_size_y)
+        self.square_sums, self.cell_square_ids = get_square_cells(board_size_x, board_size_y)
+        num_squares, num_cells = len(self.squares), board_size_x * board_size_y
+        self.packed = [None, [0] * num_squares, [0] * num_squares]
+        self.losing_counts = [None, [0] * num_cells, [0] * num_cells]
+        # The cells with a nonzero losing count, occupied or not.
+        self.losing = [None, set(), set()]
+
+    def _threat(self, player, cell, delta):
+        losing_counts = self.losing_counts[player]
+        losing_counts[cell] += delta
+        if losing_counts[cell]:
+            self.losing[player].add(cell)
+        else:
+            self.losing[player].discard(cell)
+
+    def add(self, player, cell):
+        # The player puts a disk on the cell. Returns the first square completed (in scan order) or None.
+        packed = self.packed[player]
+        step = self.COUNT_ONE + cell
+        three = 3 * self.COUNT_ONE
+        completed = None
+        for s in self.cell_square_ids[cell]:
+            entry = packed[s] + step
+            packed[s] = entry
+            if entry >= three:
+                if entry < three + self.COUNT_ONE:
+                    self._threat(player, self.square_sums[s] - (entry & self.CELLS_SUM), 1)
+                else:
+                    self._threat(player, cell, -1)
+                    if completed is None:
+                        completed = self.squares[s]
+        return completed
+
+    def remove(self, player, cell):
+        packed = self.packed[player]
+        step = self.COUNT_ONE + cell
+        three = 3 * self.COUNT_ONE
+        for s in self.cell_square_ids[cell]:
+            entry = packed[s]
+            if entry >= three:
+                if entry < three + self.COUNT_ONE:
+                    self._threat(player, self.square_sums[s] - (entry & self.CELLS_SUM), -1)
+                else:
+                    self._threat(player, cell, 1)
+            packed[s] = entry - step
+
+    def completes_square(self, player, cell):
+        # Whether a disk of the player on the cell would complete a square (whether the cell is empty or not).
+        return self.losing_counts[player][cell] > 0
+
 
-    def get_state_rep(self):
-        res = np.array(self.board).flatten()
-        # Normalize player ID to -0.5 or 0.5 and append the game-over flag.
-        return np.append(res, [self.current_player - 1.5, float(self.player_lost != None)]) 
-    
 class HipGameLogic:
     def __init__(self, board_size_x, board_size_y):
         self.BOARD_SIZE_X = board_size_x
         self.BOARD_SIZE_Y = board_size_y
+        self.squares, self.cell_squares = get_squares(board_size_x, board_size_y)
         self.current_player = 1 # Player 1 starts.
         self.board = [[0 for _ in range(board_size_x)] for _ in range(board_size_y)]
         self.player_lost = None
         self.square_found = None   
         self.moves_count = 0
+        # The undo stack: (action, current_player, player_lost, square_found) before each move.
+        self.history = []
+        self.threats = ThreatMap(board_size_x, board_size_y)
 
     def make_move(self, player, action):
         x, y = action
         if not (0 <= x < self.BOARD_SIZE_X and 0 <= y < self.BOARD_SIZE_Y) or self.board[y][x]:
             return False  # Invalid move. The cell is already occupied or is out of bounds.
 
+        self.history.append((action, self.current_player, self.player_lost, self.square_found))
         self.moves_count += 1
         self.board[y][x] = player
-        found = self.find_square(player)
+        # Before the move the player had no squares, so only the squares through (x, y) can be complete.
+        # The threat map counts them (the same square as find_square_through would return).
+        found = self.threats.add(player, y * self.BOARD_SIZE_X + x)
         if found:
             self.square_found = found
             self.player_lost = player
@@ -41,9 +198,40 @@ class HipGameLogic:
         else:
             self.current_player = 2 if player == 1 else 1
             return True
+
+    def unmake_move(self):
+        # Take back the last move. Lets search code walk the game tree without copying boards.
+        if not self.history:
+            return False
+        (x, y), self.current_player, self.player_lost, self.square_found = self.history.pop()
+        self.threats.remove(self.board[y][x], y * self.BOARD_SIZE_X + x)
+        self.board[y][x] = 0
+        self.moves_count -= 1
+        return True
+
+    def is_losing_move(self, player, action):
+        # Whether playing the (empty) cell completes a square of the player. O(1), from the threat map.
+        x, y = action
+        return not self.board[y][x] and self.threats.completes_square(player, y * self.BOARD_SIZE_X + x)
+
+    def losing_cells(self, player):
+        # The empty cells where the player would complete a square.
+        return [(cell % self.BOARD_SIZE_X, cell // self.BOARD_SIZE_X) for cell in sorted(self.threats.losing[player])
+                if not self.board[cell // self.BOARD_SIZE_X][cell % self.BOARD_SIZE_X]]
+
+    def find_square_through(self, player, cell):
+        # Check the precomputed squares through the cell only.
+        x, y = cell
+        board = self.board
+        for square in self.cell_squares[y * self.BOARD_SIZE_X + x]:
+            (x1, y1), (x2, y2), (x3, y3), (x4, y4) = square
+            if board[y1][x1] == board[y2][x2] == board[y3][x3] == board[y4][x4] == player:
+                return square
+        return None
         
     def find_square(self, player):
         # Check if there is a square on the board formed by player's pieces.
+        # A full scan of the board. make_move relies on find_square_through instead.
         for y1 in range(self.BOARD_SIZE_Y):
             for x1 in range(self.BOARD_SIZE_X):
                 if self.board[y1][x1] == player:
@@ -66,11 +254,11 @@ class HipGameLogic:
     
     def check_for_draw(self):
         # Check if all the cells are filled, but no player has lost.
-        return self.player_lost is None and all(cell for row in self.board for cell in row)
+        return self.player_lost is None and self.moves_count == self.BOARD_SIZE_X * self.BOARD_SIZE_Y
     
     def get_state(self):
         return HipGameState(self.board, self.current_player, 
-                            self.player_lost, self.square_found, self.moves_count)
+                            self.player_lost, self.square_found, self.moves_count, self.threats)
     
     def reset_game(self):
         self.board = [[0 for _ in range(self.BOARD_SIZE_X)] for _ in range(self.BOARD_SIZE_Y)]
@@ -78,7 +266,183 @@ class HipGameLogic:
         self.player_lost = None
         self.square_found = None
         self.moves_count = 0
+        self.history = []
+        self.threats = ThreatMap(self.BOARD_SIZE_X, self.BOARD_SIZE_Y)
 
-    
-    
-    
\ No newline at end of file
+
+@lru_cache(maxsize=None)
+def get_square_masks(board_size_x, board_size_y):
+    # Bitboard versions of get_squares: cell (x, y) is bit y * board_size_x + x.
+    # Returns the mask of every square and, per cell, the (mask, square) pairs through that cell.
+    squares, cell_squares = get_squares(board_size_x, board_size_y)
+    masks = {square: sum(1 << (y * board_size_x + x) for (x, y) in square) for square in squares}
+    return (tuple(masks[square] for square in squares),
+            tuple(tuple((masks[square], square) for square in cs) for cs in cell_squares))
+
+
+@lru_cache(maxsize=None)
+def get_cell_rest_masks(board_size_x, board_size_y):
+    # For every cell, the masks of the other three vertices of each square through it:
+    # playing the cell completes a square iff the player already holds one of these.
+    _, cell_square_masks = get_square_masks(board_size_x, board_size_y)
+    return tuple(tuple(square_mask & ~(1 << cell) for square_mask, _ in cell_square_masks[cell])
+                 for cell in range(board_size_x * board_size_y))
+
+
+def completes_square(cell_rest_masks, mask, cell):
+    for rest in cell_rest_masks[cell]:
+        if mask & rest == rest:
+            return True
+    return False
+
+
+def masks_to_board(player_masks, board_size_x, board_size_y):
+    # A list-of-lists view of the bitboards, as used by HipGameState.board.
+    mask_1, mask_2 = player_masks[1], player_masks[2]
+    board = []
+    for y in range(board_size_y):
+        row = []
+        for x in range(board_size_x):
+            bit = 1 << (y * board_size_x + x)
+            row.append(1 if mask_1 & bit else 2 if mask_2 & bit else 0)
+        board.append(row)
+    return board
+
+
+def board_to_masks(board):
+    # The inverse of masks_to_board: (0, player 1 mask, player 2 mask) for a list-of-lists board.
+    player_masks = [0, 0, 0]
+    board_size_x = len(board[0])
+    for y, row in enumerate(board):
+        for x, cell_value in enumerate(row):
+            if cell_value:
+                player_masks[cell_value] |= 1 << (y * board_size_x + x)
+    return tuple(player_masks)
+
+
+class MaskThreats:
+    # The completes_square query of ThreatMap, answered from the player masks of a position
+    # (an AND and a compare per square through the cell) instead of maintained counts.
+    # A snapshot: it describes the position it was made for, whatever the game does next.
+    def __init__(self, player_masks, board_size_x, board_size_y):
+        self.player_masks = player_masks
+        self.cell_rest_masks = get_cell_rest_masks(board_size_x, board_size_y)
+
+    def completes_square(self, player, cell):
+        return completes_square(self.cell_rest_masks, self.player_masks[player], cell)
+
+
+class HipBitboardState(HipGameState):
+    # An immutable snapshot of a bitboard game: copying it costs two ints.
+    def __init__(self, player_masks, board_size_x, board_size_y, 
+                 current_player, player_lost, square_found, moves_count):
+        self.player_masks = player_masks
+        self.BOARD_SIZE_X = board_size_x
+        self.BOARD_SIZE_Y = board_size_y
+        self.current_player = current_player
+        self.player_lost = player_lost
+        self.square_found = square_found
+        self.moves_count = moves_count
+
+    @property
+    def board(self):
+        return masks_to_board(self.player_masks, self.BOARD_SIZE_X, self.BOARD_SIZE_Y)
+
+    @property
+    def threats(self):
+        # Built when asked for, from the masks of the snapshot.
+        return MaskThreats(self.player_masks, self.BOARD_SIZE_X, self.BOARD_SIZE_Y)
+
+
+class HipBitboardLogic:
+    # Same API as HipGameLogic, but the board is kept as one integer mask per player.
+    # Checking for a square is an AND and a compare per square through the last move. No ThreatMap is kept:
+    # the threat queries are answered from the masks too (see MaskThreats), which is cheaper than maintaining it.
+    def __init__(self, board_size_x, board_size_y):
+        self.BOARD_SIZE_X = board_size_x
+        self.BOARD_SIZE_Y = board_size_y
+        self.squares, _ = get_squares(board_size_x, board_size_y)
+        self.square_masks, self.cell_square_masks = get_square_masks(board_size_x, board_size_y)
+        self.cell_rest_masks = get_cell_rest_masks(board_size_x, board_size_y)
+        self.reset_game()
+
+    @property
+    def threats(self):
+        return MaskThreats(tuple(self.player_masks), self.BOARD_SIZE_X, self.BOARD_SIZE_Y)
+
+    @property
+    def board(self):
+        return masks_to_board(self.player_masks, self.BOARD_SIZE_X, self.BOARD_SIZE_Y)
+
+    def make_move(self, player, action):
+        x, y = action
+        if not (0 <= x < self.BOARD_SIZE_X and 0 <= y < self.BOARD_SIZE_Y):
+            return False
+        cell = y * self.BOARD_SIZE_X + x
+        bit = 1 << cell
+        if (self.player_masks[1] | self.player_masks[2]) & bit:
+            return False  # Invalid move. The cell is already occupied.
+
+        self.history.append((action, player, self.current_player, self.player_lost, self.square_found))
+        self.moves_count += 1
+        mask = self.player_masks[player] | bit
+        self.player_masks[player] = mask
+        for square_mask, square in self.cell_square_masks[cell]:
+            if mask & square_mask == square_mask:
+                self.square_found = square
+                self.player_lost = player
+                return True
+        if self.check_for_draw():
+            self.player_lost = 0
+        else:
+            self.current_player = 2 if player == 1 else 1
+        return True
+
+    def unmake_move(self):
+        if not self.history:
+            return False
+        (x, y), player, self.current_player, self.player_lost, self.square_found = self.history.pop()
+        self.player_masks[player] &= ~(1 << (y * self.BOARD_SIZE_X + x))
+        self.moves_count -= 1
+        return True
+
+    def is_losing_move(self, player, action):
+        x, y = action
+        cell = y * self.BOARD_SIZE_X + x
+        return not (self.player_masks[1] | self.player_masks[2]) >> cell & 1 \
+            and completes_square(self.cell_rest_masks, self.player_masks[player], cell)
+
+    def losing_cells(self, player):
+        occupied = self.player_masks[1] | self.player_masks[2]
+        mask = self.player_masks[player]
+        return [(cell % self.BOARD_SIZE_X, cell // self.BOARD_SIZE_X)
+                for cell in range(self.BOARD_SIZE_X * self.BOARD_SIZE_Y)
+                if not occupied >> cell & 1 and completes_square(self.cell_rest_masks, mask, cell)]
+
+    def find_square(self, player):
+        # A full check of all the squares, in the same order as HipGameLogic.find_square.
+        mask = self.player_masks[player]
+        for square_mask, square in zip(self.square_masks, self.squares):
+            if mask & square_mask == square_mask:
+                return square
+        return None
+
+    def check_for_draw(self):
+        return self.player_lost is None and self.moves_count == self.BOARD_SIZE_X * self.BOARD_SIZE_Y
+
+    def get_state(self):
+        return HipBitboardState((0, self.player_masks[1], self.player_masks[2]), 
+                                self.BOARD_SIZE_X, self.BOARD_SIZE_Y, self.current_player,
+                                self.player_lost, self.square_found, self.moves_count)
+
+    def reset_game(self):
+        self.player_masks = [0, 0, 0] # Indexed by player ID, index 0 is unused.
+        self.current_player = 1
+        self.player_lost = None
+        self.square_found = None
+        self.moves_count = 0
+        self.history = []
+
+
+# Selected by config.GAME_ENGINE.
+GAME_ENGINES = {'list': HipGameLogic, 'bitboard': HipBitboardLogic}
@@ -1,7 +1,50 @@
 from abc import ABC, abstractmethod
+import math
+import os
 import random
+import time
+from collections import OrderedDict
 import config
-from ai.agent import DQNAgent
+from game.game_logic import board_to_masks, get_cell_rest_masks, completes_square
+
+def load_config_tablebase(board_size):
+    # The tablebase config.TABLEBASE_FILE for the board size, or None. Imported here, as it needs NumPy.
+    if not config.TABLEBASE_FILE:
+        return None
+    from game.tablebase import load_tablebase
+    return load_tablebase(config.TABLEBASE_FILE, *board_size)
+
+def load_config_position_cache(board_size, producer):
+    # The position cache config.POSITION_CACHE_FILE for the board size and the producer, or None.
+    # producer - the string naming the player and the settings its moves depend on (see game/position_cache.py),
+    # None for a player whose moves are not worth caching.
+    if not config.POSITION_CACHE_FILE or producer is None:
+        return None
+    from game.position_cache import load_position_cache
+    return load_position_cache(config.POSITION_CACHE_FILE, *board_size, config.POSITION_CACHE_ENTRIES,
+                               config.POSITION_CACHE_WRITE, producer)
+
+def model_producer(player_class, model_filename, *settings):
+    # The producer string of a player with the model (None for a model file that cannot be read) and the settings.
+    from game.position_cache import file_fingerprint
+    fingerprint = file_fingerprint(model_filename) if model_filename else 'no model'
+    if fingerprint is None:
+        return None
+    return ' '.join(map(str, (player_class.__name__, fingerprint) + settings))
+
+# The modules of the MCTS evaluations, imported by the first MCTSPlayer (see _import_search_modules)
+# rather than here, so that the other players import without numpy and torch.
+np = torch = encoding = None
+
+def _import_search_modules(with_model):
+    global np, torch, encoding
+    if np is None:
+        import numpy
+        from game import encoding as encoding_module
+        np, encoding = numpy, encoding_module
+    if with_model and torch is None:
+        import torch as torch_module
+        torch = torch_module
 
 # An abstract superclass for both human and AI players.
 class Player(ABC):
@@ -23,26 +66,340 @@ class HumanPlayer(Player):
 
 
 class RandomAIPlayer(Player):
-    def __init__(self, player_name):
+    # With safe=True, the moves completing own square are avoided while there are others.
+    def __init__(self, player_name, safe=False):
         super().__init__(player_name, is_human=False)
+        self.safe = safe
 
     def get_move(self, game_state, click_info=None):
         # Randomly select a valid move.
-        valid_moves = [(x, y) for y in range(config.BOARD_SIZE_Y)
-                       for x in range(config.BOARD_SIZE_X)
-                       if game_state.board[y][x] == 0]
+        board = game_state.board
+        valid_moves = [(x, y) for y in range(len(board))
+                       for x in range(len(board[0]))
+                       if board[y][x] == 0]
+        if self.safe and valid_moves:
+            safe_moves = [move for move in valid_moves if not self._completes_square(game_state, move)]
+            valid_moves = safe_moves or valid_moves
         return random.choice(valid_moves) if valid_moves else None
 
+    def _completes_square(self, game_state, move):
+        # From the threat map of the game if the state has one, otherwise from the board.
+        x, y = move
+        board_size_x, board_size_y = len(game_state.board[0]), len(game_state.board)
+        cell = y * board_size_x + x
+        if game_state.threats is not None:
+            return game_state.threats.completes_square(game_state.current_player, cell)
+        masks = board_to_masks(game_state.board)
+        return completes_square(get_cell_rest_masks(board_size_x, board_size_y),
+                                masks[game_state.current_player], cell)
+
 class AIPlayer(Player):
+    # A model exported to an .npz (see ai/numpy_model.py) is run with NumPy, without importing torch.
+    # A .pth model is run by a DQNAgent, in the network of config.Q_NETWORK: a convolutional one plays on any board.
+    # The moves chosen are cached per position, least recently used out first.
+    # In the positions of the tablebase config.TABLEBASE_FILE, if any, its best moves are played.
+    # Otherwise the shared position cache config.POSITION_CACHE_FILE, if any, is looked up before the network,
+    # and the network's moves are added to it.
     def __init__(self, player_name, model_filename):
         super().__init__(player_name, is_human=False)
+        self.move_cache = OrderedDict() # (board, current player) -> move
+        self.move_cache_size = config.AI_MOVE_CACHE_SIZE
+        self.agent = None
+        self.board_size = (config.BOARD_SIZE_X, config.BOARD_SIZE_Y)
+        self.tablebase = load_config_tablebase(self.board_size)
+        # The moves of the model with the canonical replay (see DQNAgent.select_actions) differ from the others.
+        self.cache_producer = model_producer(AIPlayer, model_filename, config.REPLAY_SYMMETRY == 'canonical') \
+            if config.POSITION_CACHE_FILE else None
+        self.position_cache = load_config_position_cache(self.board_size, self.cache_producer)
+        # A missing model of either format is reported, and an untrained network (run by a DQNAgent) plays.
+        found = os.path.exists(model_filename)
+        if not found:
+            print(f'No model {model_filename} found.')
+        elif model_filename.endswith('.npz'):
+            from ai.numpy_model import NumpyQNetwork
+            canonical_board_size = self.board_size if config.REPLAY_SYMMETRY == 'canonical' else None
+            self.select_actions = NumpyQNetwork(model_filename, canonical_board_size).select_actions
+            print(f'Playing against AI. Loaded trained model {model_filename}.')
+            return
+
+        # Imported here so that the other players (and headless scripts) do not need torch.
+        from ai.agent import DQNAgent
         self.agent = DQNAgent(config, play_mode=True)
-        try:
+        self.select_actions = self.agent.select_actions
+        if found:
             self.agent.model.load(model_filename)
             print(f'Playing against AI. Loaded trained model {model_filename}.')
-        except FileNotFoundError:
-            print(f'No model {model_filename} found.')
-            return
 
     def get_move(self, game_state, click_info=None):
-        return self.agent.select_action(game_state.get_state_rep())
\ No newline at end of file
+        key = (tuple(map(tuple, game_state.board)), game_state.current_player)
+        if key in self.move_cache:
+            self.move_cache.move_to_end(key)
+            return self.move_cache[key]
+
+        board_size = (len(game_state.board[0]), len(game_state.board))
+        if board_size != self.board_size:
+            if self.agent is not None:
+                self.agent.set_board_size(*board_size)
+            self.board_size = board_size
+            self.tablebase = load_config_tablebase(board_size)
+            self.position_cache = load_config_position_cache(board_size, self.cache_producer)
+        result = self.tablebase.best_move(game_state) if self.tablebase is not None else None
+        cached = position_key = None
+        if (result is None and self.position_cache is not None
+                and game_state.moves_count < config.POSITION_CACHE_MAX_MOVES):
+            position_key = self.position_cache.position_key(game_state)
+            cached = self.position_cache.lookup(game_state, position_key)
+        if result is not None:
+            move = result[1]
+        elif cached is not None:
+            move = cached[0]
+        else:
+            index = int(self.select_actions(game_state.get_state_rep()[None, :])[0])
+            move = None if index < 0 else divmod(index, board_size[0])[::-1]
+            # No value: it would take another forward pass.
+            if position_key is not None and self.position_cache.writable:
+                self.position_cache.store(game_state, move, float('nan'), position_key)
+        self.move_cache[key] = move
+        if len(self.move_cache) > self.move_cache_size:
+            self.move_cache.popitem(last=False)
+        return move
+
+class MCTSNode:
+    __slots__ = ('prior', 'visits', 'value_sum', 'children', 'terminal_value')
+
+    def __init__(self, prior, terminal_value=None):
+        self.prior = prior
+        self.visits = 0
+        # The value is from the point of view of the player who made the move leading to the node.
+        self.value_sum = 0.0
+        self.children = None # {cell: MCTSNode}, once expanded.
+        self.terminal_value = terminal_value # -1 if the move completed a square, 0 if it filled the board.
+
+class MCTSPlayer(Player):
+    # PUCT search over bitboard positions. Leaves are collected in batches (with virtual loss
+    # on the paths, so that a batch spreads over different leaves) and evaluated together:
+    # the priors (and optionally the values) come from one forward pass of the Q-network over the batch.
+    # Without a model the priors are uniform, and the values come from random playouts that avoid own squares.
+    # The leaves in the tablebase config.TABLEBASE_FILE, if any, get their exact values from it.
+    # The moves in the shared position cache config.POSITION_CACHE_FILE, if any, are played without a search,
+    # and the moves searched are added to it with their values.
+    # The subtree of the position reached is kept between the moves.
+    def __init__(self, player_name, model_filename=None, simulations=None, time_budget=None):
+        super().__init__(player_name, is_human=False)
+        # A fixed number of simulations per move, unless a time budget (seconds per move) is given.
+        self.time_budget = time_budget if time_budget is not None else config.MCTS_TIME_BUDGET
+        self.simulations = simulations or config.MCTS_SIMULATIONS
+        self.batch_size = config.MCTS_BATCH_SIZE
+        self.c_puct = config.MCTS_C_PUCT
+        self.virtual_loss = config.MCTS_VIRTUAL_LOSS
+
+        self.agent = None
+        if model_filename:
+            from ai.agent import DQNAgent
+            self.agent = DQNAgent(config, play_mode=True)
+            try:
+                self.agent.model.load(model_filename)
+            except FileNotFoundError:
+                print(f'No model {model_filename} found. Searching with uniform priors.')
+                self.agent = None
+        _import_search_modules(self.agent is not None)
+
+        # The search settings the moves depend on (the time budget makes them depend on the machine too).
+        self.cache_producer = model_producer(
+            MCTSPlayer, model_filename if self.agent is not None else None, self.simulations, self.time_budget,
+            self.c_puct, config.MCTS_PRIOR_TEMPERATURE, config.MCTS_NETWORK_VALUES, config.MCTS_VALUE_SCALE,
+            bool(config.TABLEBASE_FILE), config.REPLAY_SYMMETRY == 'canonical') if config.POSITION_CACHE_FILE else None
+        self.tablebase = self.position_cache = None
+        self.tablebase_size = None # The board size the tablebase and the position cache were loaded for.
+        self.root = self.root_masks = self.root_player = None
+        # For reporting the search speed.
+        self.total_simulations = 0
+        self.total_search_time = 0.0
+
+    def get_move(self, game_state, click_info=None):
+        board = game_state.board
+        self.BOARD_SIZE_X, self.BOARD_SIZE_Y = len(board[0]), len(board)
+        self.num_cells = self.BOARD_SIZE_X * self.BOARD_SIZE_Y
+        self.full_mask = (1 << self.num_cells) - 1
+        if self.agent is not None:
+            self.agent.set_board_size(self.BOARD_SIZE_X, self.BOARD_SIZE_Y)
+        if self.tablebase_size != (self.BOARD_SIZE_X, self.BOARD_SIZE_Y):
+            self.tablebase_size = (self.BOARD_SIZE_X, self.BOARD_SIZE_Y)
+            self.tablebase = load_config_tablebase(self.tablebase_size)
+            self.position_cache = load_config_position_cache(self.tablebase_size, self.cache_producer)
+        self.cell_rest_masks = get_cell_rest_masks(self.BOARD_SIZE_X, self.BOARD_SIZE_Y)
+
+        masks = board_to_masks(board)
+        player = game_state.current_player
+        if not self.full_mask & ~(masks[1] | masks[2]):
+            return None
+        position_key = cached = None
+        if self.position_cache is not None and game_state.moves_count < config.POSITION_CACHE_MAX_MOVES:
+            position_key = self.position_cache.position_key(game_state)
+            cached = self.position_cache.lookup(game_state, position_key)
+        if cached is not None and cached[0] is not None:
+            self.root = None # No subtree to keep.
+            return cached[0]
+        self._advance_root(masks, player)
+
+        start = time.perf_counter()
+        simulations = 0
+        if self.root.children is None:
+            # A fresh root is the leaf of every descent: a whole batch would evaluate it batch_size times.
+            simulations += self._run_batch(1)
+        while (time.perf_counter() - start < self.time_budget) if self.time_budget else (simulations < self.simulations):
+            simulations += self._run_batch()
+        self.total_simulations += simulations
+        self.total_search_time += time.perf_counter() - start
+
+        cell, child = max(self.root.children.items(), key=lambda item: item[1].visits)
+        # Keep the subtree for the next move.
+        root_masks = list(masks)
+        root_masks[player] |= 1 << cell
+        self.root, self.root_masks, self.root_player = child, tuple(root_masks), 3 - player
+        y, x = divmod(cell, self.BOARD_SIZE_X)
+        if position_key is not None and self.position_cache.writable:
+            self.position_cache.store(game_state, (x, y), child.value_sum / child.visits if child.visits else 0.0,
+                                      position_key)
+        return (x, y)
+
+    @property
+    def simulations_per_second(self):
+        return self.total_simulations / self.total_search_time if self.total_search_time else 0.0
+
+    def _advance_root(self, masks, player):
+        # Reuse the tree if the position is the last root plus one opponent move, otherwise start afresh.
+        root = None
+        if self.root is not None and self.root.children is not None and player == 3 - self.root_player \
+                and masks[player] == self.root_masks[player]:
+            new_bits = masks[3 - player] ^ self.root_masks[3 - player]
+            if new_bits and not new_bits & (new_bits - 1) and masks[3 - player] & new_bits:
+                root = self.root.children.get(new_bits.bit_length() - 1)
+        self.root = root if root is not None and root.terminal_value is None else MCTSNode(1.0)
+        self.root_masks, self.root_player = masks, player
+
+    def _puct_child(self, node):
+        sqrt_visits = math.sqrt(node.visits + 1)
+        best_score, best = -math.inf, None
+        for cell, child in node.children.items():
+            q = child.value_sum / child.visits if child.visits else 0.0
+            score = q + self.c_puct * child.prior * sqrt_visits / (1 + child.visits)
+            if score > best_score:
+                best_score, best = score, (cell, child)
+        return best
+
+    def _run_batch(self, batch_size=None):
+        # Select up to batch_size (by default self.batch_size) leaves, evaluate them together and back the values up.
+        leaves = []
+        for _ in range(batch_size or self.batch_size):
+            node, masks, player, path = self.root, list(self.root_masks), self.root_player, [self.root]
+            while node.children is not None and node.terminal_value is None:
+                cell, node = self._puct_child(node)
+                masks[player] |= 1 << cell
+                player = 3 - player
+                path.append(node)
+                node.visits += self.virtual_loss
+                node.value_sum -= self.virtual_loss
+            leaves.append((node, masks, player, path))
+
+        pending = [(node, masks, player) for node, masks, player, _ in leaves if node.terminal_value is None]
+        evaluations = self._evaluate(pending)
+        for (node, masks, player), (priors, value) in zip(pending, evaluations):
+            if node.children is None:
+                self._expand(node, masks, player, priors)
+        if self.tablebase is not None:
+            for i, (_, masks, _) in enumerate(pending):
+                value = self.tablebase.probe_masks(masks)
+                if value is not None:
+                    evaluations[i] = (evaluations[i][0], float(value))
+        values = iter(value for _, value in evaluations)
+
+        for node, masks, player, path in leaves:
+            # The value for the player who moved into the leaf.
+            value = node.terminal_value if node.terminal_value is not None else -next(values)
+            for path_node in reversed(path):
+                if path_node is self.root:
+                    path_node.visits += 1
+                else:
+                    path_node.visits += 1 - self.virtual_loss
+                    path_node.value_sum += value + self.virtual_loss
+                value = -value
+        return len(leaves)
+
+    def _expand(self, node, masks, player, priors):
+        own = masks[player]
+        empty = self.full_mask & ~(masks[1] | masks[2])
+        filling = not empty & (empty - 1) # One empty cell left: the move fills the board.
+        node.children = {}
+        while empty:
+            bit = empty & -empty
+            empty ^= bit
+            cell = bit.bit_length() - 1
+            terminal_value = -1.0 if completes_square(self.cell_rest_masks, own, cell) else 0.0 if filling else None
+            node.children[cell] = MCTSNode(priors[cell], terminal_value)
+
+    def _evaluate(self, leaves):
+        # (priors over the cells, value for the player to move) for each leaf.
+        if not leaves:
+            return []
+        if self.agent is None:
+            uniform = np.full(self.num_cells, 1.0 / self.num_cells)
+            return [(uniform, self._playout(masks, player)) for _, masks, player in leaves]
+
+        # One forward pass over all the leaves of the batch.
+        state_reps = encoding.encode_boards(self._leaf_boards(leaves), [player for _, _, player in leaves], 0,
+                                            np.empty((len(leaves), self.num_cells + 2), dtype=np.float32))
+        canonical = self.agent.replay_symmetry == 'canonical'
+        if canonical:
+            # The model only knows the canonical orientations (see DQNAgent.select_actions).
+            boards = state_reps[:, :-2].astype(np.int8)
+            symmetries = encoding.canonical_symmetries(boards, self.BOARD_SIZE_X, self.BOARD_SIZE_Y)
+            model_input = state_reps.copy()
+            model_input[:, :-2] = encoding.transform_boards(boards, self.BOARD_SIZE_X, self.BOARD_SIZE_Y, symmetries)
+        else:
+            model_input = state_reps
+        with torch.inference_mode():
+            q_values = self.agent.model(torch.from_numpy(model_input)).numpy()
+        if canonical:
+            # The Q-value of each cell is the one of its image.
+            images = encoding.transform_cells(np.arange(self.num_cells)[None, :], self.BOARD_SIZE_X, self.BOARD_SIZE_Y,
+                                     symmetries[:, None])
+            q_values = np.take_along_axis(q_values, images, axis=1)
+        q_values = np.where(state_reps[:, :-2] == 0, q_values / config.MCTS_PRIOR_TEMPERATURE, -np.inf)
+        priors = np.exp(q_values - q_values.max(axis=1, keepdims=True))
+        priors /= priors.sum(axis=1, keepdims=True)
+
+        evaluations = []
+        for i, (_, masks, player) in enumerate(leaves):
+            if config.MCTS_NETWORK_VALUES:
+                value = math.tanh(q_values[i].max() / config.MCTS_VALUE_SCALE)
+            else:
+                value = self._playout(masks, player)
+            evaluations.append((priors[i], value))
+        return evaluations
+
+    def _leaf_boards(self, leaves):
+        # The boards of the leaves (N, cells), unpacked from the bits of their masks in one go.
+        num_bytes = (self.num_cells + 7) // 8
+        packed = b''.join(masks[player].to_bytes(num_bytes, 'little') for _, masks, _ in leaves for player in (1, 2))
+        bits = np.unpackbits(np.frombuffer(packed, dtype=np.uint8).reshape(len(leaves), 2, num_bytes),
+                             axis=2, bitorder='little')[:, :, :self.num_cells]
+        return bits[:, 0] + 2 * bits[:, 1]
+
+    def _playout(self, masks, player):
+        # A random game from the position, never completing own square while there is a choice.
+        # Returns 1, 0 or -1 for the player to move.
+        masks = list(masks)
+        empty_cells = [cell for cell in range(self.num_cells) if not (masks[1] | masks[2]) >> cell & 1]
+        random.shuffle(empty_cells)
+        to_move = player
+        while empty_cells:
+            for i, cell in enumerate(empty_cells):
+                if not completes_square(self.cell_rest_masks, masks[to_move], cell):
+                    break
+            else:
+                return -1 if to_move == player else 1 # Every move completes a square.
+            empty_cells.pop(i)
+            masks[to_move] |= 1 << cell
+            to_move = 3 - to_move
+        return 0
@@ -0,0 +1,279 @@
+import hashlib
+import os
+import random
+import struct
+import time
+import numpy as np
+from game.game_logic import board_to_masks, get_symmetries
+from game.solver import zobrist_keys, symmetry_keys, position_hashes
+
+# A persistent position cache: a file mapping positions (up to the board symmetries, with the side to move)
+# to a move and its value, shared by the players of any number of processes through a memory map.
+#
+# The file is a header and a fixed number of entries (a power of two) of four uint64 words:
+#   key   - the smallest of the Zobrist hashes of the position under the symmetries (0 marks an empty slot),
+#   data  - the value (float32 bits) and the move + 1 in the canonical orientation (0 for no move) above them,
+#           the value in the terms of the producer (NaN for none): the mean search value in [-1, 1]
+#           for MCTSPlayer, WIN, DRAW or LOSS for fill_from_solver; AIPlayer stores no value,
+#   check - key ^ data ^ CHECK_SALT,
+#   stamp - the write counter when the entry was written, for the eviction.
+# A key lives in one of PROBE_LENGTH slots from its home slot (open addressing with linear probing).
+# When all of them are taken, the entry written longest ago is replaced, so the size stays bounded.
+#
+# A file holds the moves of a single producer: the header keeps a hash of a string naming the player
+# and its settings, with a fingerprint of its model file (see AIPlayer, MCTSPlayer), and a cache opened
+# for another producer is rejected. So the players of an arena do not play each other's moves,
+# and a retrained model does not play the moves of the old one.
+#
+# Any number of processes read without locking: an entry is read whole and used only if its check matches,
+# so an entry being rewritten (a torn read) is a miss. Writers take an exclusive lock on the file.
+
+MAGIC = b'HIPPC\x00\x00\x01'
+HEADER_SIZE = 64
+PROBE_LENGTH = 8
+CHECK_SALT = 0x9E3779B97F4A7C15
+# The key of a position with the player 2 to move is XORed with this. In Hip the side to move follows
+# from the disk counts, but a cache should not depend on that.
+SIDE_KEY = 0xD1B54A32D192ED03
+
+
+class PositionCache:
+    # writable: add entries (creating the file with `entries` slots if there is none), or only look up.
+    # producer - the string naming who computes the moves, e.g. 'AIPlayer <model fingerprint>'.
+    def __init__(self, filename, board_size_x, board_size_y, entries=1 << 20, writable=False, producer=''):
+        self.filename = filename
+        self.producer = producer
+        self.BOARD_SIZE_X = board_size_x
+        self.BOARD_SIZE_Y = board_size_y
+        self.num_cells = board_size_x * board_size_y
+        self.writable = writable
+        if writable and not os.path.exists(filename):
+            create_cache_file(filename, board_size_x, board_size_y, entries, producer)
+
+        with open(filename, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{filename} is not a position cache.')
+        file_board_size_x, file_board_size_y, capacity, producer_hash = struct.unpack_from('<4Q', header, len(MAGIC))
+        if (file_board_size_x, file_board_size_y) != (board_size_x, board_size_y):
+            raise ValueError(f'The position cache {filename} is for a '
+                             f'{file_board_size_x}x{file_board_size_y} board.')
+        if producer_hash != hash_producer(producer):
+            raise ValueError(f'The position cache {filename} holds the moves of another player or model.')
+        self.capacity = capacity
+        self.mask = capacity - 1
+        # The header words (the last one is the write counter) and the (capacity, 4) entries.
+        # Plain arrays over the memory maps: indexing a np.memmap itself is several times slower.
+        mode = 'r+' if writable else 'r'
+        self.header = np.asarray(np.memmap(filename, dtype=np.uint64, mode=mode, shape=(HEADER_SIZE // 8,)))
+        self.entries = np.asarray(np.memmap(filename, dtype=np.uint64, mode=mode, offset=HEADER_SIZE,
+                                            shape=(capacity, 4)))
+        self.lock_file = open(filename, 'rb') if writable else None
+
+        self.keys = symmetry_keys(zobrist_keys(board_size_x, board_size_y))
+        self.symmetries = get_symmetries(board_size_x, board_size_y)
+        self.inverse_symmetries = []
+        for perm in self.symmetries:
+            inverse = [0] * self.num_cells
+            for cell, image in enumerate(perm):
+                inverse[image] = cell
+            self.inverse_symmetries.append(inverse)
+
+        # For reporting the hit rate.
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0
+
+    def __len__(self):
+        return int(np.count_nonzero(self.entries[:, 0]))
+
+    def position_key(self, game_state):
+        # (key, the symmetry mapping the position to its canonical orientation). It can be passed to lookup
+        # and then to store, to hash the position once.
+        masks = getattr(game_state, 'player_masks', None) or board_to_masks(game_state.board)
+        hashes = position_hashes(masks, self.keys)
+        key = min(hashes)
+        symmetry = hashes.index(key)
+        if game_state.current_player == 2:
+            key ^= SIDE_KEY
+        return key or 1, symmetry
+
+    def _find(self, key):
+        # The data of the key, or None.
+        home = key & self.mask
+        for i in range(PROBE_LENGTH):
+            slot_key, data, check, _ = self.entries[(home + i) & self.mask].tolist()
+            if slot_key == key:
+                return data if check == key ^ data ^ CHECK_SALT else None # Otherwise being rewritten.
+            if not slot_key:
+                return None
+        return None
+
+    def lookup(self, game_state, position_key=None):
+        # (move (x, y) or None, value) stored for the position, or None.
+        key, symmetry = position_key or self.position_key(game_state)
+        data = self._find(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value = struct.unpack('<f', struct.pack('<I', data & 0xFFFFFFFF))[0]
+        canonical_move = (data >> 32) - 1
+        if canonical_move < 0:
+            return None, value
+        y, x = divmod(self.inverse_symmetries[symmetry][canonical_move], self.BOARD_SIZE_X)
+        return (x, y), value
+
+    def store(self, game_state, move, value, position_key=None):
+        # Add (or replace) the move and value of the position. Does nothing if the cache is read-only.
+        if not self.writable:
+            return
+        import fcntl
+        key, symmetry = position_key or self.position_key(game_state)
+        canonical_move = -1 if move is None else self.symmetries[symmetry][move[1] * self.BOARD_SIZE_X + move[0]]
+        data = (canonical_move + 1) << 32 | struct.unpack('<I', struct.pack('<f', value))[0]
+
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            home = key & self.mask
+            slots = [(home + i) & self.mask for i in range(PROBE_LENGTH)]
+            slot = next((slot for slot in slots if int(self.entries[slot, 0]) in (key, 0)), None)
+            if slot is None:
+                slot = min(slots, key=lambda slot: int(self.entries[slot, 3]))
+            stamp = int(self.header[-1]) + 1
+            self.header[-1] = stamp
+            # The readers check the whole entry, so the order of the writes does not matter.
+            self.entries[slot] = (key, data, key ^ data ^ CHECK_SALT, stamp)
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def close(self):
+        if self.lock_file is not None:
+            self.lock_file.close()
+
+
+def hash_producer(producer):
+    return int.from_bytes(hashlib.blake2b(producer.encode(), digest_size=8).digest(), 'little')
+
+
+def file_fingerprint(filename):
+    # A hash of the contents of a (model) file, for the producer strings. None if there is no such file.
+    try:
+        with open(filename, 'rb') as f:
+            return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def create_cache_file(filename, board_size_x, board_size_y, entries, producer=''):
+    # An empty cache of at least `entries` slots (rounded up to a power of two), written to a temporary file
+    # and linked to the file name, so that no process opens a partial one. If the file exists by then
+    # (created by another process), it is kept: replacing it would leave the processes that opened it
+    # writing to an unlinked file.
+    capacity = 1 << max(entries - 1, 1).bit_length()
+    temporary_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(temporary_filename, 'wb') as f:
+        f.write((MAGIC + struct.pack('<4Q', board_size_x, board_size_y, capacity, hash_producer(producer)))
+                .ljust(HEADER_SIZE, b'\x00'))
+        f.truncate(HEADER_SIZE + 32 * capacity)
+    try:
+        os.link(temporary_filename, filename)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(temporary_filename)
+
+
+def load_position_cache(filename, board_size_x, board_size_y, entries, writable, producer):
+    # The cache in the file (config.POSITION_CACHE_FILE), or None (with a message) if there is no file name,
+    # no such file to read or the cache is for another board size or producer.
+    if not filename:
+        return None
+    try:
+        return PositionCache(filename, board_size_x, board_size_y, entries, writable, producer)
+    except FileNotFoundError:
+        print(f'No position cache {filename} found.')
+    except ValueError as e:
+        print(e)
+    return None
+
+
+# The producer of the caches filled by fill_from_solver.
+SOLVER_PRODUCER = 'HipSolver'
+
+
+def fill_from_solver(cache, game_states, solver):
+    # Store the proven values (WIN, DRAW or LOSS) and best moves of the positions, e.g. for an endgame book.
+    if cache.producer != SOLVER_PRODUCER:
+        raise ValueError(f'Open the cache with producer={SOLVER_PRODUCER!r} to fill it from the solver.')
+    for game_state in game_states:
+        value, move = solver.solve(game_state)
+        cache.store(game_state, move, value)
+
+
+def _play(player_factory, cache_filename, num_games, seed, opening_moves):
+    # In a worker: games of the player (a picklable factory of players) against a random player avoiding
+    # own squares, colours alternating. Returns {phase: [hits, lookups, player moves, CPU seconds in the moves]}
+    # for the opening (the first opening_moves moves of a game) and the rest. CPU time, so that the workers
+    # sharing the cores do not count in each other's latency.
+    import config
+    from game.game_logic import GAME_ENGINES
+    from game.player import RandomAIPlayer
+    random.seed(seed)
+    config.POSITION_CACHE_FILE = cache_filename
+    player = player_factory()
+    opponent = RandomAIPlayer('Random', safe=True)
+    results = {'opening': [0, 0, 0, 0.0], 'rest': [0, 0, 0, 0.0]}
+    for game_index in range(num_games):
+        players = {1: player, 2: opponent} if game_index % 2 else {1: opponent, 2: player}
+        game = GAME_ENGINES[config.GAME_ENGINE](config.BOARD_SIZE_X, config.BOARD_SIZE_Y)
+        while game.player_lost is None:
+            state = game.get_state()
+            if players[game.current_player] is not player:
+                game.make_move(game.current_player, opponent.get_move(state))
+                continue
+            cache = player.position_cache
+            hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+            start = time.process_time()
+            move = player.get_move(state)
+            result = results['opening' if game.moves_count < opening_moves else 'rest']
+            result[3] += time.process_time() - start
+            result[2] += 1
+            if cache is not None:
+                result[0] += cache.hits - hits
+                result[1] += cache.hits + cache.misses - hits - misses
+            game.make_move(game.current_player, move)
+    return results
+
+
+def benchmark(player_factory, num_games=200, processes=4, opening_moves=8, filename='position_cache_benchmark.bin'):
+    # Per-move latency of the player without the cache, then with a cache file shared by `processes` workers:
+    # a cold run filling it and a warm run reading it. Prints the hit rates and latencies.
+    from multiprocessing import Pool
+    if os.path.exists(filename):
+        os.remove(filename)
+    # The warm run plays other games than the cold one: only the positions that recur are hit.
+    for run, (label, cache_filename) in enumerate((('no cache', ''), ('cold cache', filename),
+                                                   ('warm cache', filename))):
+        with Pool(processes) as pool:
+            results = pool.starmap(_play, [(player_factory, cache_filename, num_games // processes,
+                                            (run > 1) * processes + seed, opening_moves)
+                                           for seed in range(processes)])
+        report = []
+        for phase in ('opening', 'rest'):
+            hits, lookups, moves, seconds = (sum(result[phase][i] for result in results) for i in range(4))
+            report.append(f'{phase} {moves} moves, {seconds / moves * 1e6:.0f} us per move'
+                          + (f', hit rate {hits / lookups:.1%}' if lookups else ''))
+        print(f'{label}: ' + '; '.join(report), flush=True)
+    os.remove(filename)
+
+if __name__ == '__main__':
+    from functools import partial
+    from game.player import AIPlayer, MCTSPlayer
+    print('AIPlayer (models/usual_6_by_6.npz):')
+    benchmark(partial(AIPlayer, 'AI', 'models/usual_6_by_6.npz'), num_games=400)
+    print('MCTSPlayer (200 simulations, playouts):')
+    benchmark(partial(MCTSPlayer, 'MCTS', simulations=200), num_games=40)
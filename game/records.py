@@ -0,0 +1,117 @@
+import os
+import struct
+
+# Game records: an append-only binary log of finished games, for replaying, analysis and offline training
+# (see ai.offline.GameRecordDataset).
+#
+# The file starts with a header: MAGIC, the board size and the names of the players (one byte each for
+# BOARD_SIZE_X, BOARD_SIZE_Y and the number of names, then every name as a length byte and UTF-8).
+# Then the games, one record each:
+#   player 1, player 2 - the indices of the names of the players (one byte each),
+#   moves count        - two bytes,
+#   outcome            - the player who lost, 0 for a draw, UNFINISHED for a game stopped before the end,
+#   moves              - one byte per move, the cell y * BOARD_SIZE_X + x, player 1 moving first.
+# That is 5 bytes + 1 per move: about 32 bytes for a game on the 6x6 board.
+# A file cut in a record (e.g. by a crash) is read up to it, and a writer appending to it drops the cut record first.
+
+MAGIC = b'HIPGR\x00\x00\x01'
+GAME_HEADER = struct.Struct('<BBHB')
+UNFINISHED = 3
+
+
+def encode_header(board_size_x, board_size_y, players):
+    if board_size_x * board_size_y > 256:
+        raise ValueError('A game record holds a move in a byte: at most 256 cells.')
+    names = [name.encode() for name in players]
+    if len(names) > 255 or any(len(name) > 255 for name in names):
+        raise ValueError('At most 255 players with names of at most 255 bytes.')
+    return MAGIC + bytes((board_size_x, board_size_y, len(names))) + b''.join(bytes((len(name),)) + name
+                                                                             for name in names)
+
+
+def read_header(f):
+    # (BOARD_SIZE_X, BOARD_SIZE_Y, player names) from a file open at its start. Leaves it at the first game.
+    header = f.read(len(MAGIC) + 3)
+    if len(header) < len(MAGIC) + 3 or header[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{f.name} is not a game record file.')
+    board_size_x, board_size_y, num_players = header[len(MAGIC):]
+    players = []
+    for _ in range(num_players):
+        length = f.read(1)[0]
+        players.append(f.read(length).decode())
+    return board_size_x, board_size_y, players
+
+
+def skip_games(f):
+    # The position after the last complete game record, scanning from the current position.
+    position = f.tell()
+    end = f.seek(0, os.SEEK_END)
+    while position + GAME_HEADER.size <= end:
+        f.seek(position)
+        moves_count = GAME_HEADER.unpack(f.read(GAME_HEADER.size))[2]
+        if position + GAME_HEADER.size + moves_count > end:
+            break
+        position += GAME_HEADER.size + moves_count
+    return position
+
+
+def game_moves(game):
+    # The moves of a game so far as cells, from its undo history (both engines keep the move first).
+    return [y * game.BOARD_SIZE_X + x for (x, y), *_ in game.history]
+
+
+class GameRecordWriter:
+    # Appends the games to the file, creating it with the header if there is none. An existing file must be
+    # for the same board size and players. The records are buffered: close() (or flush()) writes the rest out.
+    def __init__(self, filename, board_size_x, board_size_y, players):
+        self.filename = filename
+        self.BOARD_SIZE_X = board_size_x
+        self.BOARD_SIZE_Y = board_size_y
+        self.players = list(players)
+        header = encode_header(board_size_x, board_size_y, self.players)
+        if os.path.exists(filename) and os.path.getsize(filename):
+            with open(filename, 'r+b') as f:
+                if read_header(f) != (board_size_x, board_size_y, self.players):
+                    raise ValueError(f'The game records {filename} are for another board size or other players.')
+                f.truncate(skip_games(f))
+            self.file = open(filename, 'ab')
+        else:
+            self.file = open(filename, 'wb')
+            self.file.write(header)
+        self.games_written = 0
+
+    def write_game(self, moves, player_lost, players=(0, 1)):
+        # moves - the cells y * BOARD_SIZE_X + x in the order played. player_lost as in the game (None if unfinished).
+        # players - the indices in self.players of the players 1 and 2.
+        outcome = UNFINISHED if player_lost is None else player_lost
+        self.file.write(GAME_HEADER.pack(players[0], players[1], len(moves), outcome) + bytes(moves))
+        self.games_written += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_game_records(filename):
+    # A generator of the games in the file: (player names (player 1, player 2), moves [(x, y), ...], player_lost),
+    # player_lost None for an unfinished game. Reads the file as it goes, so it can follow a file being written.
+    with open(filename, 'rb') as f:
+        board_size_x, _, players = read_header(f)
+        while True:
+            game_header = f.read(GAME_HEADER.size)
+            if len(game_header) < GAME_HEADER.size:
+                return
+            player_1, player_2, moves_count, outcome = GAME_HEADER.unpack(game_header)
+            moves = f.read(moves_count)
+            if len(moves) < moves_count:
+                return # A record cut short.
+            yield ((players[player_1], players[player_2]),
+                   [(cell % board_size_x, cell // board_size_x) for cell in moves],
+                   None if outcome == UNFINISHED else outcome)
+
+
+def open_game_records(filename, board_size_x, board_size_y, players):
+    # A writer to the file (config.GAME_RECORDS_FILE), or None if there is no file name.
+    return GameRecordWriter(filename, board_size_x, board_size_y, players) if filename else None
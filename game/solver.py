@@ -0,0 +1,213 @@
+import random
+import time
+from functools import reduce
+from operator import xor
+from game.game_logic import HipGameLogic, get_cell_rest_masks, get_symmetries, completes_square
+
+# Game values, from the point of view of the player to move.
+WIN, DRAW, LOSS = 1, 0, -1
+
+# Transposition table entry flags: the stored value is exact, a lower bound or an upper bound.
+EXACT, LOWER, UPPER = 0, 1, 2
+
+
+def zobrist_keys(board_size_x, board_size_y, seed=0):
+    # zobrist[player][cell] is a tuple of the keys of the cell's image under each symmetry:
+    # the hashes of a position under all the symmetries are the XORs of these over its disks,
+    # and the smallest of them is the key of the position's symmetry class (shared with game.tablebase).
+    symmetries = get_symmetries(board_size_x, board_size_y)
+    num_cells = board_size_x * board_size_y
+    rng = random.Random(seed)
+    keys = {player: [rng.getrandbits(64) for _ in range(num_cells)] for player in (1, 2)}
+    return {player: [tuple(keys[player][perm[cell]] for perm in symmetries)
+                     for cell in range(num_cells)] for player in (1, 2)}
+
+
+def symmetry_keys(zobrist):
+    # The keys of zobrist_keys regrouped per symmetry: keys[player][symmetry][cell], for position_hashes.
+    return {player: list(zip(*keys)) for player, keys in zobrist.items()}
+
+
+def position_hashes(masks, keys):
+    # The hashes of a position (masks[1], masks[2]) under all the symmetries (keys from symmetry_keys),
+    # computed at once rather than incrementally, for lookups outside the search.
+    hashes = [0] * len(keys[1])
+    for player in (1, 2):
+        cells = [cell for cell in range(len(keys[player][0])) if masks[player] >> cell & 1]
+        for symmetry, cell_keys in enumerate(keys[player]):
+            hashes[symmetry] ^= reduce(xor, map(cell_keys.__getitem__, cells), 0)
+    return hashes
+
+
+class HipSolver:
+    # An exact negamax/alpha-beta solver over bitboard positions.
+    # Positions are hashed with Zobrist keys under all the board symmetries at once (updated incrementally),
+    # and the smallest of the hashes is the key of the position's symmetry class in the transposition table.
+    # With a tablebase (game.tablebase.Tablebase, keyed with the same Zobrist keys of seed 0), the positions
+    # it covers are looked up instead of searched.
+    def __init__(self, board_size_x, board_size_y, tt_bits=20, seed=0, tablebase=None):
+        if tablebase is not None and (seed or (tablebase.BOARD_SIZE_X, tablebase.BOARD_SIZE_Y)
+                                      != (board_size_x, board_size_y)):
+            raise ValueError('The tablebase needs the same board size and the Zobrist keys of seed 0.')
+        self.tablebase = tablebase
+        self.BOARD_SIZE_X = board_size_x
+        self.BOARD_SIZE_Y = board_size_y
+        self.num_cells = board_size_x * board_size_y
+        self.full_mask = (1 << self.num_cells) - 1
+
+        self.cell_rest_masks = get_cell_rest_masks(board_size_x, board_size_y)
+
+        self.symmetries = get_symmetries(board_size_x, board_size_y)
+        self.inverse_symmetries = []
+        for perm in self.symmetries:
+            inverse = [0] * self.num_cells
+            for cell, image in enumerate(perm):
+                inverse[image] = cell
+            self.inverse_symmetries.append(inverse)
+
+        self.zobrist = zobrist_keys(board_size_x, board_size_y, seed)
+
+        # A two-tier transposition table: the first tier keeps the entry with the larger subtree
+        # (more empty cells), the second one is always replaced.
+        self.tt_mask = (1 << tt_bits) - 1
+        self.tt_deep = [None] * (1 << tt_bits)
+        self.tt_recent = [None] * (1 << tt_bits)
+        self.nodes = 0
+
+    def _tt_probe(self, key):
+        index = key & self.tt_mask
+        for table in (self.tt_deep, self.tt_recent):
+            entry = table[index]
+            if entry is not None and entry[0] == key:
+                return entry
+        return None
+
+    def _tt_store(self, key, value, flag, depth, move):
+        index = key & self.tt_mask
+        entry = (key, value, flag, depth, move)
+        stored = self.tt_deep[index]
+        if stored is None or stored[0] == key or depth >= stored[3]:
+            self.tt_deep[index] = entry
+        else:
+            self.tt_recent[index] = entry
+
+    def _ordered_moves(self, own, other, empty, tt_move):
+        # The moves that do not complete own square, best guesses first: the previous best move,
+        # then the cells that are safe for the opponent too (take them away), then the cells only safe for us
+        # (keep them for later). The cells completing own square are never played by choice.
+        first, second = [], []
+        while empty:
+            bit = empty & -empty
+            empty ^= bit
+            cell = bit.bit_length() - 1
+            if completes_square(self.cell_rest_masks, own, cell):
+                continue
+            if cell == tt_move:
+                first.insert(0, cell)
+            elif completes_square(self.cell_rest_masks, other, cell):
+                second.append(cell)
+            else:
+                first.append(cell)
+        return first + second
+
+    def _negamax(self, masks, player, hashes, alpha, beta):
+        # masks[player] is the mask of the player to move. Returns WIN, DRAW or LOSS for them.
+        own, other = masks[player], masks[3 - player]
+        empty = self.full_mask & ~(own | other)
+        if not empty:
+            return DRAW
+        self.nodes += 1
+
+        key = min(hashes)
+        if self.tablebase is not None and bin(empty).count('1') <= self.tablebase.max_empty:
+            value = self.tablebase.probe_key(key)
+            if value is not None:
+                return value
+        symmetry = hashes.index(key)
+        tt_move = None
+        entry = self._tt_probe(key)
+        if entry is not None:
+            _, value, flag, _, canonical_move = entry
+            if flag == EXACT or (flag == LOWER and value >= beta) or (flag == UPPER and value <= alpha):
+                return value
+            if canonical_move is not None:
+                tt_move = self.inverse_symmetries[symmetry][canonical_move]
+
+        moves = self._ordered_moves(own, other, empty, tt_move)
+        alpha_orig = alpha
+        best_value, best_move = LOSS, None # With no safe moves left, any move completes a square.
+        zobrist = self.zobrist[player]
+        for cell in moves:
+            child_masks = list(masks)
+            child_masks[player] = own | (1 << cell)
+            child_hashes = tuple(h ^ k for h, k in zip(hashes, zobrist[cell]))
+            value = -self._negamax(child_masks, 3 - player, child_hashes, -beta, -alpha)
+            if best_move is None or value > best_value:
+                best_value, best_move = value, cell
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        flag = UPPER if best_value <= alpha_orig else LOWER if best_value >= beta else EXACT
+        canonical_move = None if best_move is None else self.symmetries[symmetry][best_move]
+        self._tt_store(key, best_value, flag, bin(empty).count('1'), canonical_move)
+        return best_value
+
+    def solve(self, game_state):
+        # The proven value of the position for the player to move (WIN, DRAW or LOSS) and a best move (x, y).
+        # If every move completes a square, any empty cell is returned as the move.
+        if game_state.player_lost is not None:
+            raise ValueError('The game is already over.')
+        if self.tablebase is not None:
+            result = self.tablebase.best_move(game_state)
+            if result is not None:
+                self.nodes = 0
+                return result
+        masks = [0, 0, 0]
+        hashes = (0,) * len(self.symmetries)
+        for y, row in enumerate(game_state.board):
+            for x, cell_value in enumerate(row):
+                if cell_value:
+                    cell = y * self.BOARD_SIZE_X + x
+                    masks[cell_value] |= 1 << cell
+                    hashes = tuple(h ^ k for h, k in zip(hashes, self.zobrist[cell_value][cell]))
+
+        self.nodes = 0
+        value = self._negamax(masks, game_state.current_player, hashes, LOSS, WIN)
+        entry = self._tt_probe(min(hashes))
+        if entry is not None and entry[4] is not None:
+            move = self.inverse_symmetries[hashes.index(min(hashes))][entry[4]]
+        else:
+            empty = self.full_mask & ~(masks[1] | masks[2])
+            move = (empty & -empty).bit_length() - 1
+        y, x = divmod(move, self.BOARD_SIZE_X)
+        return value, (x, y)
+
+
+def play_random_safe_moves(game, num_moves, rng):
+    # Play up to num_moves random moves that do not end the game.
+    for _ in range(num_moves):
+        if game.moves_count >= game.BOARD_SIZE_X * game.BOARD_SIZE_Y - 1:
+            break # The last move would end the game either way.
+        safe_moves = [(x, y) for y in range(game.BOARD_SIZE_Y) for x in range(game.BOARD_SIZE_X)
+                      if not game.board[y][x] and not game.is_losing_move(game.current_player, (x, y))]
+        if not safe_moves:
+            break
+        game.make_move(game.current_player, rng.choice(safe_moves))
+
+
+def benchmark(board_size_x, board_size_y, num_random_moves=0, seed=0):
+    # Solve a position reached by a few random moves. Returns (value, move, nodes, seconds).
+    game = HipGameLogic(board_size_x, board_size_y)
+    play_random_safe_moves(game, num_random_moves, random.Random(seed))
+    solver = HipSolver(board_size_x, board_size_y)
+    start = time.perf_counter()
+    value, move = solver.solve(game.get_state())
+    return value, move, solver.nodes, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    for board_size_x, board_size_y, num_random_moves in ((4, 4, 0), (5, 5, 8), (6, 6, 22), (6, 6, 20), (6, 6, 18)):
+        value, move, nodes, seconds = benchmark(board_size_x, board_size_y, num_random_moves)
+        print(f'{board_size_x}x{board_size_y}, {num_random_moves} random moves: value {value:+d}, move {move}, '
+              f'{nodes} nodes, {seconds:.2f} s')
@@ -0,0 +1,303 @@
+import os
+import random
+import time
+from multiprocessing import Pool
+import numpy as np
+from game.game_logic import HipGameLogic, board_to_masks, get_cell_rest_masks, completes_square
+from game.solver import WIN, DRAW, LOSS, zobrist_keys, symmetry_keys, position_hashes, play_random_safe_moves
+
+# An endgame tablebase: the exact values (WIN, DRAW or LOSS for the player to move) of all the positions
+# with at most max_empty empty cells reachable from a set of seed positions. The positions are generated
+# level by level (by the number of empty cells) down from the seeds, then solved backwards from the full boards,
+# each level over a process pool.
+# All the legal positions with max_empty empty cells are far too many even on 6x6 (some 1e13 for 8 empty cells),
+# hence the seeds: positions of actual games, taken as the game reaches max_empty empty cells.
+#
+# The positions are keyed by the symmetry-reduced Zobrist hash of HipSolver (the smallest of the hashes under
+# the board symmetries), so that a lookup needs no canonical form and the solver can probe with its own keys.
+# The file is a header, the sorted uint64 keys and the values packed 2 bits each. It is read through memory maps,
+# so that a lookup (a binary search) only touches a few pages, and any number of processes can share it.
+
+MAGIC = b'HIPTB\x00\x00\x01'
+HEADER_SIZE = 64
+# The 2-bit codes of the values, 0 unused.
+VALUE_CODES = {LOSS: 1, DRAW: 2, WIN: 3}
+CODE_VALUES = (None, LOSS, DRAW, WIN)
+
+
+class Tablebase:
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{filename} is not a tablebase.')
+        board_size_x, board_size_y, max_empty, count = map(int, np.frombuffer(header, np.uint64, 4, len(MAGIC)))
+        self.BOARD_SIZE_X, self.BOARD_SIZE_Y = board_size_x, board_size_y
+        self.max_empty = max_empty
+        self.num_cells = board_size_x * board_size_y
+        # Plain arrays over the memory maps: indexing a np.memmap itself is several times slower.
+        self.keys = np.asarray(np.memmap(filename, dtype=np.uint64, mode='r', offset=HEADER_SIZE, shape=(count,)))
+        self.codes = np.asarray(np.memmap(filename, dtype=np.uint8, mode='r', offset=HEADER_SIZE + 8 * count,
+                                          shape=((count + 3) // 4,)))
+        self.cell_rest_masks = get_cell_rest_masks(board_size_x, board_size_y)
+        zobrist = zobrist_keys(board_size_x, board_size_y)
+        # The same keys per player as a (cells, symmetries) array, for the moves, and as a list per symmetry,
+        # for the hashes of a position.
+        self.zobrist = {player: np.array(keys, dtype=np.uint64) for player, keys in zobrist.items()}
+        self.symmetry_keys = symmetry_keys(zobrist)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def probe_keys(self, keys):
+        # The value codes (see VALUE_CODES) of the positions with the given keys, 0 for the ones not in the table.
+        keys = np.asarray(keys, dtype=np.uint64)
+        indices = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        codes = self.codes[indices >> 2] >> (2 * (indices & 3)).astype(np.uint8) & 3
+        return np.where(self.keys[indices] == keys, codes, 0)
+
+    def probe_key(self, key):
+        # The value of the position with the given key, or None.
+        index = int(self.keys.searchsorted(np.uint64(key)))
+        if index == len(self.keys) or int(self.keys[index]) != key:
+            return None
+        return CODE_VALUES[int(self.codes[index >> 2]) >> 2 * (index & 3) & 3]
+
+    def _masks(self, game_state):
+        if (len(game_state.board[0]), len(game_state.board)) != (self.BOARD_SIZE_X, self.BOARD_SIZE_Y):
+            raise ValueError(f'The tablebase is for a {self.BOARD_SIZE_X}x{self.BOARD_SIZE_Y} board.')
+        return getattr(game_state, 'player_masks', None) or board_to_masks(game_state.board)
+
+    def probe_masks(self, masks):
+        # The value of a position (0, player 1 mask, player 2 mask), not over, for the player to move, or None.
+        if self.num_cells - bin(masks[1] | masks[2]).count('1') > self.max_empty or not len(self):
+            return None
+        return self.probe_key(min(position_hashes(masks, self.symmetry_keys)))
+
+    def probe(self, game_state):
+        # The value of the position for the player to move, or None if it is not in the table.
+        if game_state.player_lost is not None:
+            return None
+        return self.probe_masks(self._masks(game_state))
+
+    def outcome(self, game_state):
+        # How the game ends in perfect play from the position, as HipGameState.player_lost would say
+        # (the player completing a square, or 0 for a draw), or None if the position is not in the table.
+        value = self.probe(game_state)
+        if value is None:
+            return None
+        return 0 if value == DRAW else game_state.current_player if value == LOSS else 3 - game_state.current_player
+
+    def best_move(self, game_state):
+        # (value, (x, y)) of a best move in a position of the table, or None. All the moves are probed at once.
+        if game_state.player_lost is not None:
+            return None
+        masks, player = self._masks(game_state), game_state.current_player
+        if self.num_cells - bin(masks[1] | masks[2]).count('1') > self.max_empty or not len(self):
+            return None
+        empty = [cell for cell in range(self.num_cells) if not (masks[1] | masks[2]) >> cell & 1]
+        losing = np.array([completes_square(self.cell_rest_masks, masks[player], cell) for cell in empty])
+        if len(empty) == 1:
+            values = np.where(losing, LOSS, DRAW) # The board is full after the move.
+        else:
+            hashes = np.array(position_hashes(masks, self.symmetry_keys), dtype=np.uint64)
+            codes = self.probe_keys((hashes[None, :] ^ self.zobrist[player][empty]).min(axis=1))
+            if (codes[~losing] == 0).any():
+                return None # The position was not built completely (it is not reachable from a seed).
+            values = np.where(losing, LOSS, -np.array(CODE_VALUES[1:])[np.maximum(codes, 1) - 1])
+        best = int(values.argmax())
+        y, x = divmod(empty[best], self.BOARD_SIZE_X)
+        return int(values[best]), (x, y)
+
+
+def load_tablebase(filename, board_size_x, board_size_y):
+    # The tablebase in the file (config.TABLEBASE_FILE), or None if there is no file name,
+    # no such file (with a message) or the table is for another board size.
+    if not filename:
+        return None
+    try:
+        tablebase = Tablebase(filename)
+    except FileNotFoundError:
+        print(f'No tablebase {filename} found.')
+        return None
+    if (tablebase.BOARD_SIZE_X, tablebase.BOARD_SIZE_Y) != (board_size_x, board_size_y):
+        return None
+    return tablebase
+
+
+# The build. In the workers the tables of the board and the values of the level solved last are globals,
+# set by the Pool initializer (_init_worker), so that they are sent once per worker rather than with every chunk.
+_tables = None
+_child_values = None
+
+
+def _set_tables(board_size_x, board_size_y):
+    global _tables
+    num_cells = board_size_x * board_size_y
+    zobrist = zobrist_keys(board_size_x, board_size_y)
+    _tables = ((1 << num_cells) - 1, get_cell_rest_masks(board_size_x, board_size_y), zobrist, symmetry_keys(zobrist))
+
+
+def _init_worker(board_size_x, board_size_y, child_values=None):
+    global _child_values
+    _set_tables(board_size_x, board_size_y)
+    _child_values = child_values
+
+
+def _moves(masks):
+    # (player to move, cell, completes own square, child hashes) for the moves of the player to move.
+    full_mask, cell_rest_masks, zobrist, keys = _tables
+    player = 1 if bin(masks[1]).count('1') == bin(masks[2]).count('1') else 2
+    hashes = position_hashes(masks, keys)
+    empty = full_mask & ~(masks[1] | masks[2])
+    while empty:
+        bit = empty & -empty
+        empty ^= bit
+        cell = bit.bit_length() - 1
+        if completes_square(cell_rest_masks, masks[player], cell):
+            yield player, cell, True, None
+        else:
+            yield player, cell, False, [h ^ k for h, k in zip(hashes, zobrist[player][cell])]
+
+
+def _expand(positions):
+    # The children of the positions (mask pairs) by the moves that do not end the game: {key: masks}.
+    children = {}
+    for masks in positions:
+        masks = (0,) + masks
+        for player, cell, losing, child_hashes in _moves(masks):
+            if not losing:
+                child = list(masks)
+                child[player] |= 1 << cell
+                children[min(child_hashes)] = (child[1], child[2])
+    return children
+
+
+def _evaluate(positions):
+    # The value codes of the positions (key, masks) one empty cell above the level in _child_values.
+    results = []
+    for key, masks in positions:
+        best = LOSS
+        for _, cell, losing, child_hashes in _moves((0,) + masks):
+            if losing:
+                continue
+            value = -_child_values[min(child_hashes)] if _child_values is not None else DRAW
+            if value > best:
+                best = value
+                if best == WIN:
+                    break
+        results.append((key, VALUE_CODES[best]))
+    return results
+
+
+def _chunks(items, chunk_size):
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def build_tablebase(board_size_x, board_size_y, max_empty, seeds, filename, processes=None, chunk_size=5000):
+    # seeds - game states (or (player 1 mask, player 2 mask) pairs) with at most max_empty empty cells,
+    # not over. Writes the table to filename and returns the number of positions per level.
+    _set_tables(board_size_x, board_size_y)
+    keys = _tables[3]
+    num_cells = board_size_x * board_size_y
+    levels = {num_empty: {} for num_empty in range(1, max_empty + 1)}
+    for seed in seeds:
+        masks = tuple(seed) if isinstance(seed, tuple) else board_to_masks(seed.board)[1:]
+        num_empty = num_cells - bin(masks[0] | masks[1]).count('1')
+        if 1 <= num_empty <= max_empty:
+            levels[num_empty][min(position_hashes((0,) + masks, keys))] = masks
+
+    with Pool(processes, initializer=_init_worker, initargs=(board_size_x, board_size_y)) as pool:
+        # Down from the seeds: the positions of every level.
+        for num_empty in range(max_empty, 1, -1):
+            for children in pool.map(_expand, _chunks(list(levels[num_empty].values()), chunk_size)):
+                levels[num_empty - 1].update(children)
+
+    # Up from the full boards: a level is solved from the values of the level below.
+    all_keys, all_codes = [], []
+    child_values = None
+    for num_empty in range(1, max_empty + 1):
+        with Pool(processes, initializer=_init_worker, initargs=(board_size_x, board_size_y, child_values)) as pool:
+            results = [result for chunk in pool.map(_evaluate, _chunks(list(levels[num_empty].items()), chunk_size))
+                       for result in chunk]
+        child_values = {key: CODE_VALUES[code] for key, code in results}
+        del levels[num_empty]
+        all_keys.append(np.fromiter((key for key, _ in results), dtype=np.uint64, count=len(results)))
+        all_codes.append(np.fromiter((code for _, code in results), dtype=np.uint8, count=len(results)))
+
+    write_tablebase(filename, board_size_x, board_size_y, max_empty, np.concatenate(all_keys),
+                    np.concatenate(all_codes))
+    return [len(keys) for keys in all_keys]
+
+
+def write_tablebase(filename, board_size_x, board_size_y, max_empty, keys, codes):
+    # The keys sorted, the codes packed 4 to a byte. Written to a temporary file and renamed.
+    keys, first = np.unique(keys, return_index=True)
+    padded = np.zeros(-(-len(keys) // 4) * 4, dtype=np.uint8)
+    padded[:len(keys)] = codes[first]
+    padded = padded.reshape(-1, 4)
+    packed = padded[:, 0] | padded[:, 1] << 2 | padded[:, 2] << 4 | padded[:, 3] << 6
+    header = MAGIC + np.array([board_size_x, board_size_y, max_empty, len(keys)], dtype=np.uint64).tobytes()
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\x00'))
+        f.write(keys.tobytes())
+        f.write(packed.tobytes())
+    os.replace(filename + '.tmp', filename)
+
+
+def sample_seeds(board_size_x, board_size_y, max_empty, num_seeds, seed=0):
+    # Positions with max_empty empty cells from random games avoiding own squares, as seeds for build_tablebase.
+    rng = random.Random(seed)
+    seeds = {}
+    attempts = 0
+    while len(seeds) < num_seeds and attempts < 100 * num_seeds:
+        attempts += 1
+        game = HipGameLogic(board_size_x, board_size_y)
+        play_random_safe_moves(game, board_size_x * board_size_y - max_empty, rng)
+        if game.player_lost is None and game.moves_count == board_size_x * board_size_y - max_empty:
+            seeds[tuple(map(tuple, game.board))] = game.get_state()
+    return list(seeds.values())
+
+
+def benchmark(board_size_x, board_size_y, max_empty, num_seeds, filename, num_lookups=1000, seed=0):
+    # Build a table from random seeds, then time lookups of positions of it (a seed and a few random moves).
+    # Returns (positions per level, build seconds, file bytes, probe microseconds, best_move microseconds).
+    seeds = sample_seeds(board_size_x, board_size_y, max_empty, num_seeds, seed)
+    start = time.perf_counter()
+    level_sizes = build_tablebase(board_size_x, board_size_y, max_empty, seeds, filename)
+    build_seconds = time.perf_counter() - start
+
+    tablebase = Tablebase(filename)
+    rng = random.Random(seed)
+    states = []
+    while len(states) < num_lookups:
+        game = HipGameLogic(board_size_x, board_size_y)
+        board = rng.choice(seeds).board
+        cells = {player: [(x, y) for y, row in enumerate(board) for x, cell_value in enumerate(row)
+                          if cell_value == player] for player in (1, 2)}
+        for move in range(len(cells[1]) + len(cells[2])):
+            game.make_move(game.current_player, cells[game.current_player][move // 2])
+        play_random_safe_moves(game, rng.randrange(max_empty), rng)
+        if game.player_lost is None:
+            states.append(game.get_state())
+
+    start = time.perf_counter()
+    for state in states:
+        tablebase.probe(state)
+    probe_us = (time.perf_counter() - start) / num_lookups * 1e6
+    start = time.perf_counter()
+    for state in states:
+        tablebase.best_move(state)
+    best_move_us = (time.perf_counter() - start) / num_lookups * 1e6
+    return level_sizes, build_seconds, os.path.getsize(filename), probe_us, best_move_us
+
+
+if __name__ == '__main__':
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        for board_size_x, board_size_y, max_empty, num_seeds in ((6, 6, 8, 20_000), (6, 6, 12, 1000), (6, 6, 16, 50)):
+            level_sizes, build_seconds, file_size, probe_us, best_move_us = benchmark(
+                board_size_x, board_size_y, max_empty, num_seeds, os.path.join(directory, 'tablebase.bin'))
+            print(f'{board_size_x}x{board_size_y}, at most {max_empty} empty cells, {num_seeds} seeds: '
+                  f'{sum(level_sizes)} positions, built in {build_seconds:.1f} s, {file_size / 2**20:.2f} MiB, '
+                  f'probe {probe_us:.1f} us, best_move {best_move_us:.1f} us', flush=True)
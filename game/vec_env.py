@@ -0,0 +1,113 @@
+import time
+import numpy as np
+from game.game_logic import get_squares
+from game.encoding import encode_boards
+
+class VecHipEnv:
+    # N games of Hip stepped together: one move per game per call to step().
+    # Finished games are reset automatically, so every row always holds a game in progress.
+    def __init__(self, num_envs, board_size_x, board_size_y,
+                 loss_reward=-5, draw_reward=20, step_reward=2):
+        self.num_envs = num_envs
+        self.BOARD_SIZE_X = board_size_x
+        self.BOARD_SIZE_Y = board_size_y
+        self.num_cells = board_size_x * board_size_y
+
+        # Rewards for the player making the move, the same as train_agent.reward_usual by default.
+        self.loss_reward = loss_reward
+        self.draw_reward = draw_reward
+        self.step_reward = step_reward
+
+        # The square-incidence matrix: incidence[cell, s] = 1 if the square s passes through the cell.
+        squares, _ = get_squares(board_size_x, board_size_y)
+        self.incidence = np.zeros((self.num_cells, len(squares)), dtype=np.int8)
+        for s, square in enumerate(squares):
+            for (x, y) in square:
+                self.incidence[y * board_size_x + x, s] = 1
+
+        self.boards = np.zeros((num_envs, board_size_y, board_size_x), dtype=np.int8)
+        self.current_player = np.ones(num_envs, dtype=np.int8)
+        self.moves_count = np.zeros(num_envs, dtype=np.int16)
+        # Per game and per player: the number of the player's disks on each square.
+        # A player loses as soon as one of the counts reaches 4.
+        self.square_counts = np.zeros((num_envs, 2, len(squares)), dtype=np.int8)
+
+        # The outcome of the games finished by the last step (player_lost is -1 for the games going on).
+        self.last_player_lost = np.full(num_envs, -1, dtype=np.int8)
+        self.last_moves_count = np.zeros(num_envs, dtype=np.int16)
+        self.games_finished = 0
+
+        self._rows = np.arange(num_envs)
+
+    def reset(self, mask=None):
+        if mask is None:
+            mask = np.ones(self.num_envs, dtype=bool)
+        self.boards[mask] = 0
+        self.current_player[mask] = 1
+        self.moves_count[mask] = 0
+        self.square_counts[mask] = 0
+        return self.get_state_reps()
+
+    def get_state_reps(self):
+        # The same encoding as HipGameState.get_state_rep, one row per game, as float32.
+        # The games in the env are never over, so the game-over flag is always 0.
+        return encode_boards(self.boards, self.current_player, 0,
+                             np.empty((self.num_envs, self.num_cells + 2), dtype=np.float32))
+
+    def get_valid_actions_mask(self):
+        return self.boards.reshape(self.num_envs, -1) == 0
+
+    def random_actions(self, rng=np.random):
+        # A uniformly random empty cell per game, as flat indices y * BOARD_SIZE_X + x.
+        return (rng.random((self.num_envs, self.num_cells)) * self.get_valid_actions_mask()).argmax(axis=1)
+
+    def step(self, actions):
+        # actions - (N,) flat cell indices y * BOARD_SIZE_X + x, one per game.
+        # Returns the state reps after the moves (before the finished games are reset),
+        # the rewards for the players who moved and the game-over flags.
+        actions = np.asarray(actions)
+        flat_boards = self.boards.reshape(self.num_envs, -1)
+        if flat_boards[self._rows, actions].any():
+            raise ValueError('Invalid move: the cell is already occupied.')
+
+        players = self.current_player.copy()
+        flat_boards[self._rows, actions] = players
+        self.moves_count += 1
+
+        # Only the squares through the new disk change. Before the move the player had no complete squares,
+        # so any count of 4 is a loss.
+        counts = self.square_counts[self._rows, players - 1] + self.incidence[actions]
+        self.square_counts[self._rows, players - 1] = counts
+        lost = (counts == 4).any(axis=1)
+        draw = ~lost & (self.moves_count == self.num_cells)
+        dones = lost | draw
+
+        rewards = np.where(lost, self.loss_reward,
+                           np.where(draw, self.draw_reward, self.step_reward)).astype(np.float32)
+
+        self.current_player = np.where(dones, players, 3 - players).astype(np.int8)
+        next_state_reps = self.get_state_reps()
+        next_state_reps[:, -1] = dones
+
+        self.last_player_lost = np.where(lost, players, np.where(draw, 0, -1)).astype(np.int8)
+        self.last_moves_count = np.where(dones, self.moves_count, 0).astype(np.int16)
+        if dones.any():
+            self.games_finished += int(dones.sum())
+            self.reset(dones)
+
+        return next_state_reps, rewards, dones
+
+
+def benchmark(num_envs, board_size_x=6, board_size_y=6, num_games=20000, seed=0):
+    # Random self-play throughput, in finished games per second.
+    rng = np.random.default_rng(seed)
+    env = VecHipEnv(num_envs, board_size_x, board_size_y)
+    start = time.perf_counter()
+    while env.games_finished < num_games:
+        env.step(env.random_actions(rng))
+    return env.games_finished / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    for num_envs in (1, 64, 1024):
+        print(f'N={num_envs}: {benchmark(num_envs):.0f} games/sec on a 6x6 board')
@@ -33,102 +33,128 @@ class HipGameGraphics:
         self.MSGBOX_TEXT_COLOR = config.MSGBOX_TEXT_COLOR
         self.MSGBOX_COLOR = config.MSGBOX_COLOR
         self.MSGBOX_BORDER_COLOR = config.MSGBOX_BORDER_COLOR    
-        self.MSGBOX_RECT = config.MSGBOX_RECT
+        self.MSGBOX_RECT = pygame.Rect(config.MSGBOX_RECT)
 
         # Player names
         self.PLAYER_NAMES = {key: players[key].player_name for key in sorted(players.keys())}  
 
-        self.BOARD_ELEMENTS = [self._draw_new_game_button, 
-                               self._draw_grid, 
-                               self._draw_disks, 
-                               self._draw_message_box,
-                               self._draw_player_names]  
+        # Text surfaces are rendered once.
+        self.PLAYER_NAME_SURFS = {key: self.FONT.render(name, True, self.PLAYER_COLORS[key])
+                                  for key, name in self.PLAYER_NAMES.items()}
+        self.LOST_TEXT_SURFS = {key: self.FONT.render(f'{name} lost', True, self.MSGBOX_TEXT_COLOR)
+                                for key, name in self.PLAYER_NAMES.items()}
+        self.DRAW_TEXT_SURF = self.FONT.render('Draw', True, self.MSGBOX_TEXT_COLOR)
 
-        self.screen.fill(self.BG_COLOR)
+        # Everything that never changes during a game is drawn once onto a cached background.
+        self.background = pygame.Surface(self.screen.get_size())
+        self.background.fill(self.BG_COLOR)
+        for element in (self._draw_new_game_button, self._draw_grid, self._draw_player_names):
+            element(self.background)
 
+        # The board as last drawn, to find the cells to redraw. None forces a full redraw.
+        self.drawn_board = None
+        self.drawn_player_lost = None
 
-    def _draw_new_game_button(self, game_state):
+
+    def _draw_new_game_button(self, surface):
         # Draw a 'New Game' button
-        pygame.draw.rect(self.screen, self.BUTTON_COLOR, self.BUTTON_RECT)
-        pygame.draw.rect(self.screen, self.LINE_COLOR, self.BUTTON_RECT, width=2) 
+        pygame.draw.rect(surface, self.BUTTON_COLOR, self.BUTTON_RECT)
+        pygame.draw.rect(surface, self.LINE_COLOR, self.BUTTON_RECT, width=2) 
         text_blit_rect = self.BUTTON_TEXT_SURF.get_rect(center=self.BUTTON_RECT.center)
-        self.screen.blit(self.BUTTON_TEXT_SURF, text_blit_rect)
+        surface.blit(self.BUTTON_TEXT_SURF, text_blit_rect)
 
-    def _draw_grid(self, game_state):
+    def _draw_grid(self, surface):
         # Draw grid
         for i in range(self.BOARD_SIZE_Y + 1):
-            pygame.draw.line(self.screen, self.LINE_COLOR,
+            pygame.draw.line(surface, self.LINE_COLOR,
                              (self.MARGIN, self.MARGIN + i * self.CELL_SIZE),
                              (self.MARGIN + self.BOARD_SIZE_X * self.CELL_SIZE, self.MARGIN + i * self.CELL_SIZE), 2)
         for j in range(self.BOARD_SIZE_X + 1):
-            pygame.draw.line(self.screen, self.LINE_COLOR,
+            pygame.draw.line(surface, self.LINE_COLOR,
                              (self.MARGIN + j * self.CELL_SIZE, self.MARGIN),
                              (self.MARGIN + j * self.CELL_SIZE, self.MARGIN + self.BOARD_SIZE_Y * self.CELL_SIZE), 2)
 
-    def _draw_disks(self, game_state):
-        # Draw disks
-        for y in range(self.BOARD_SIZE_Y):
-            for x in range(self.BOARD_SIZE_X):
-                if game_state.board[y][x]:
-                    color = self.PLAYER_COLORS[game_state.board[y][x]]
-                    center = (self.MARGIN + x * self.CELL_SIZE + self.CELL_SIZE // 2,
-                              self.MARGIN + y * self.CELL_SIZE + self.CELL_SIZE // 2)
-                    pygame.draw.circle(self.screen, color, center, self.CIRCLE_RADIUS)
-                    pygame.draw.circle(self.screen, self.LINE_COLOR, center, self.CIRCLE_RADIUS, width=2)
-    
-   
+    def _draw_player_names(self, surface):
+        # Draw player names at the bottom of the screen.
+        cum_width = 0
+        for i, text_surf in self.PLAYER_NAME_SURFS.items():
+            text_rect = text_surf.get_rect(midleft=(self.MARGIN + cum_width,
+                                                    self.HEIGHT - self.MARGIN // 2))
+            cum_width += text_rect.width + 20
+            surface.blit(text_surf, text_rect)
+
+    def _cell_center(self, x, y):
+        return (self.MARGIN + x * self.CELL_SIZE + self.CELL_SIZE // 2,
+                self.MARGIN + y * self.CELL_SIZE + self.CELL_SIZE // 2)
+
+    def _draw_disk(self, game_state, x, y):
+        # Draw a disk. Returns the rectangle of the screen that has changed.
+        center = self._cell_center(x, y)
+        color = self.PLAYER_COLORS[game_state.board[y][x]]
+        pygame.draw.circle(self.screen, color, center, self.CIRCLE_RADIUS)
+        return pygame.draw.circle(self.screen, self.LINE_COLOR, center, self.CIRCLE_RADIUS, width=2)
+
     def _draw_message_box(self, game_state):
         # Put up a message box if the game is over (player_lost != None). 
-        # Highlight a losing square if it's not a draw.
+        # Highlight a losing square if it's not a draw. Returns the rectangles of the screen that have changed.
+        dirty_rects = []
         if game_state.player_lost:
             square_vertices = []
             for (x, y) in game_state.square_found:
-                center = (self.MARGIN + x * self.CELL_SIZE + self.CELL_SIZE // 2,
-                          self.MARGIN + y * self.CELL_SIZE + self.CELL_SIZE // 2)
+                center = self._cell_center(x, y)
                 color = self.PLAYER_COLORS_LOST[game_state.player_lost]
-                pygame.draw.circle(self.screen, color, center, self.CIRCLE_RADIUS)
-                pygame.draw.circle(self.screen, self.HIGHLIGHT_COLOR, center, self.CIRCLE_RADIUS, width=3)
+                # The disks reach past the polygon, so their rectangles are pushed too.
+                dirty_rects.append(pygame.draw.circle(self.screen, color, center, self.CIRCLE_RADIUS))
+                dirty_rects.append(pygame.draw.circle(self.screen, self.HIGHLIGHT_COLOR, center,
+                                                      self.CIRCLE_RADIUS, width=3))
                 square_vertices.append(center)
             
             # Highlight the square found.
-            pygame.draw.polygon(self.screen, self.HIGHLIGHT_COLOR, square_vertices, width=3)
-            
-            pygame.draw.rect(self.screen, self.MSGBOX_COLOR, self.MSGBOX_RECT)
-            pygame.draw.rect(self.screen, self.MSGBOX_BORDER_COLOR, self.MSGBOX_RECT, width=2)
-            lost_text = self.FONT.render(f'{self.PLAYER_NAMES[game_state.player_lost]} lost', True, self.MSGBOX_TEXT_COLOR)
-            text_rect = lost_text.get_rect(center=(self.WIDTH // 2, self.HEIGHT // 2))
-            
-            self.screen.blit(lost_text, text_rect)
+            dirty_rects.append(pygame.draw.polygon(self.screen, self.HIGHLIGHT_COLOR, square_vertices, width=3))
+            text_surf = self.LOST_TEXT_SURFS[game_state.player_lost]
 
         elif game_state.player_lost == 0: # A draw
-            pygame.draw.rect(self.screen, self.MSGBOX_COLOR, self.MSGBOX_RECT)
-            pygame.draw.rect(self.screen, self.MSGBOX_BORDER_COLOR, 
-                             self.MSGBOX_RECT, 
-                             width=2)
-            draw_text = self.FONT.render('Draw', True, self.MSGBOX_TEXT_COLOR)
-            text_rect = draw_text.get_rect(center=(self.WIDTH // 2, self.HEIGHT // 2))
-            self.screen.blit(draw_text, text_rect)
-
-    def _draw_player_names(self, game_state):
-        # Draw player names at the bottom of the screen.
-        cum_width = 0
-        for i, player_name in self.PLAYER_NAMES.items():
-            text_surf = self.FONT.render(player_name, True, self.PLAYER_COLORS[i])
-            text_rect = text_surf.get_rect(midleft=(self.MARGIN + cum_width,
-                                                    self.HEIGHT - self.MARGIN // 2))
-            cum_width += text_rect.width + 20
-            self.screen.blit(text_surf, text_rect)
+            text_surf = self.DRAW_TEXT_SURF
+        else:
+            return dirty_rects
 
-    def draw_board(self, game_state):
-        self.screen.fill(self.BG_COLOR)
-        for element in self.BOARD_ELEMENTS:
-            element(game_state)
+        pygame.draw.rect(self.screen, self.MSGBOX_COLOR, self.MSGBOX_RECT)
+        pygame.draw.rect(self.screen, self.MSGBOX_BORDER_COLOR, self.MSGBOX_RECT, width=2)
+        text_rect = text_surf.get_rect(center=(self.WIDTH // 2, self.HEIGHT // 2))
+        self.screen.blit(text_surf, text_rect)
+        dirty_rects.append(self.MSGBOX_RECT.union(text_rect))
+        return dirty_rects
 
-        pygame.display.flip()
+    def draw_board(self, game_state):
+        # Only the cells changed since the last call (and the message box, once the game is over) are redrawn
+        # and pushed to the display. A new game (or any cell cleared or recoloured) redraws everything.
+        board = game_state.board
+        changed = None
+        if self.drawn_board is not None and self.drawn_player_lost is None:
+            changed = [(x, y) for y, row in enumerate(board) for x, cell in enumerate(row)
+                       if cell != self.drawn_board[y][x]]
+            if any(self.drawn_board[y][x] for (x, y) in changed):
+                changed = None
+
+        if changed is None:
+            self.screen.blit(self.background, (0, 0))
+            for y, row in enumerate(board):
+                for x, cell in enumerate(row):
+                    if cell:
+                        self._draw_disk(game_state, x, y)
+            self._draw_message_box(game_state)
+            pygame.display.flip()
+        else:
+            dirty_rects = [self._draw_disk(game_state, x, y) for (x, y) in changed]
+            dirty_rects += self._draw_message_box(game_state)
+            if dirty_rects:
+                pygame.display.update(dirty_rects)
+
+        self.drawn_board = [list(row) for row in board]
+        self.drawn_player_lost = game_state.player_lost
     
-    def save_screenshot(self, filename):
-        self.screen.fill(self.BG_COLOR) 
-        self.draw_board() 
+    def save_screenshot(self, filename, game_state):
+        self.draw_board(game_state) 
         # Save the screenshot
         pygame.image.save(self.screen, filename)
         print(f'A screenshot saved as {filename}')
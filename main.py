@@ -5,19 +5,26 @@ import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 import config
-from game.game_logic import HipGameLogic
+from game.game_logic import GAME_ENGINES
 from game_graphics.rendering import HipGameGraphics
 from game.player import HumanPlayer, RandomAIPlayer, AIPlayer
+from game.records import open_game_records, game_moves
 from collections import defaultdict
 
-def run_single_game(screen, players):
-    game = HipGameLogic(board_size_x=config.BOARD_SIZE_X, board_size_y=config.BOARD_SIZE_Y)
+def run_single_game(screen, players, clock=None, records=None):
+    # records - a game record writer (game/records.py) for the games finished, if any.
+    game = GAME_ENGINES[config.GAME_ENGINE](board_size_x=config.BOARD_SIZE_X, board_size_y=config.BOARD_SIZE_Y)
     game_graphics = HipGameGraphics(screen, players)
     game_graphics.draw_board(game.get_state())
+    clock = clock or pygame.time.Clock()
 
     running = True
     while running:
-        for event in pygame.event.get():
+        # Nothing changes on the screen until an event comes, unless a bot is to move:
+        # then block on the event queue instead of spinning.
+        bot_to_move = game.player_lost == None and not players[game.current_player].is_human
+        events = pygame.event.get() if bot_to_move else [pygame.event.wait()]
+        for event in events:
             if event.type == pygame.QUIT:
                 running = False
             elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
@@ -28,29 +35,41 @@ def run_single_game(screen, players):
                 elif clicked_element == 'cell' and game.player_lost == None \
                     and players[game.current_player].is_human:
                         move = players[game.current_player].get_move(game.get_state(), click_info)
-                        game.make_move(game.current_player, move)
-                        game_graphics.draw_board(game.get_state())
+                        if game.make_move(game.current_player, move):
+                            game_graphics.draw_board(game.get_state())
+                            write_if_over(game, records)
 
-        if game.player_lost == None and not players[game.current_player].is_human:
+        if running and game.player_lost == None and not players[game.current_player].is_human:
             # AI: given a board state, get a move from the bot.
             move = players[game.current_player].get_move(game.get_state())
             if move and game.make_move(game.current_player, move):
                 game_graphics.draw_board(game.get_state())    
+                write_if_over(game, records)
             else:
                 raise Exception('AI could not make a valid move.')
-            
-        pygame.display.flip()
+            # Bot moves are shown at most FPS times a second.
+            clock.tick(config.FPS)
     
     return game.player_lost
 
 
-def run_match(screen, players, num_rounds):
+def write_if_over(game, records):
+    if records is not None and game.player_lost is not None:
+        records.write_game(game_moves(game), game.player_lost)
+
+
+def run_match(screen, players, num_rounds, records_file=''):
+    # records_file - a game record file (game/records.py) the games are appended to, if given.
     lost_count = defaultdict(int)
     print(f'Starting a match of {num_rounds}.')
+    records = open_game_records(records_file, config.BOARD_SIZE_X, config.BOARD_SIZE_Y,
+                                (players[1].player_name, players[2].player_name))
 
     for r_ in range(num_rounds):
-        res = run_single_game(screen, players)
+        res = run_single_game(screen, players, records=records)
         lost_count[res] += 1
+    if records is not None:
+        records.close()
     
     print ('Loss counts:')
     for player_id, player in players.items():
@@ -64,9 +83,9 @@ if __name__ == "__main__":
     clock = pygame.time.Clock()
 
     players = {1: HumanPlayer('Player 1'), 2: HumanPlayer('Player 2')}
-    run_single_game(screen, players)
+    run_single_game(screen, players, clock)
 
-    # players = {1: HumanPlayer('Player 1'), 2: AIPlayer('AI', 'models/usual_6_by_6.pth')}
+    # players = {1: HumanPlayer('Player 1'), 2: AIPlayer('AI', 'models/usual_6_by_6.npz')}
     # run_match(screen, players, 5)
 
     pygame.quit()
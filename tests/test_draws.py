@@ -0,0 +1,39 @@
+import pytest
+from game.draws import enumerate_draws
+from game.game_logic import get_square_masks
+
+# enumerate_draws against a plain backtracking over the cells in index order, without the symmetries.
+# Run from the repo root: python -m pytest tests
+
+
+def brute_force_draws(board_size_x, board_size_y):
+    num_cells = board_size_x * board_size_y
+    square_masks, _ = get_square_masks(board_size_x, board_size_y)
+    # The squares by their highest cell: they are complete once it is coloured.
+    closing = [[] for _ in range(num_cells)]
+    for square_mask in square_masks:
+        closing[square_mask.bit_length() - 1].append(square_mask)
+    draws = []
+
+    def extend(cell, masks, left):
+        if cell == num_cells:
+            draws.append((masks[1], masks[2]))
+            return
+        for colour in (1, 2):
+            if not left[colour]:
+                continue
+            mask = masks[colour] | 1 << cell
+            if any(mask & square_mask == square_mask for square_mask in closing[cell]):
+                continue
+            new_masks, new_left = list(masks), list(left)
+            new_masks[colour], new_left[colour] = mask, left[colour] - 1
+            extend(cell + 1, new_masks, new_left)
+
+    extend(0, [0, 0, 0], [0, (num_cells + 1) // 2, num_cells // 2])
+    return sorted(draws)
+
+
+@pytest.mark.parametrize('board_size', [(4, 4), (5, 4), (5, 5)])
+def test_enumerate_draws_matches_brute_force(board_size):
+    draws, _, _ = enumerate_draws(*board_size, processes=2)
+    assert draws == brute_force_draws(*board_size)
@@ -0,0 +1,75 @@
+import random
+import pytest
+from game.game_logic import GAME_ENGINES, HipGameLogic
+
+# Random games on several board sizes, checked move by move against the brute-force find_square.
+# Run from the repo root: python -m pytest tests
+
+BOARD_SIZES = [(2, 2), (3, 4), (4, 4), (5, 5), (6, 6), (7, 5), (8, 8)]
+
+
+def play_random_game(game, rng):
+    # Yields the player and the cell of every move, after it is made.
+    cells = [(x, y) for y in range(game.BOARD_SIZE_Y) for x in range(game.BOARD_SIZE_X)]
+    rng.shuffle(cells)
+    for cell in cells:
+        player = game.current_player
+        assert game.make_move(player, cell)
+        yield player, cell
+        if game.player_lost is not None:
+            return
+
+
+@pytest.mark.parametrize('board_size', BOARD_SIZES)
+def test_find_square_through_matches_find_square(board_size):
+    rng = random.Random(0)
+    game = HipGameLogic(*board_size)
+    for _ in range(200):
+        game.reset_game()
+        for player, cell in play_random_game(game, rng):
+            square = game.find_square(player)
+            assert game.find_square_through(player, cell) == square
+            assert game.square_found == square
+            if square:
+                assert game.player_lost == player
+            else:
+                assert game.player_lost == (0 if game.moves_count == board_size[0] * board_size[1] else None)
+            assert game.find_square(3 - player) is None
+
+
+@pytest.mark.parametrize('engine', list(GAME_ENGINES))
+@pytest.mark.parametrize('board_size', BOARD_SIZES)
+def test_engine_square_found_matches_find_square(engine, board_size):
+    rng = random.Random(1)
+    game = GAME_ENGINES[engine](*board_size)
+    for _ in range(200):
+        game.reset_game()
+        for player, _ in play_random_game(game, rng):
+            assert game.square_found == game.find_square(player)
+
+
+@pytest.mark.parametrize('engine', list(GAME_ENGINES))
+@pytest.mark.parametrize('board_size', BOARD_SIZES)
+def test_unmaking_every_move_restores_the_initial_state(engine, board_size):
+    rng = random.Random(2)
+    game = GAME_ENGINES[engine](*board_size)
+
+    def snapshot():
+        # The losing cells are part of the undo state too (the list engine keeps them in a ThreatMap).
+        return ([row[:] for row in game.board], game.current_player, game.player_lost, game.square_found,
+                game.moves_count, len(game.history), game.losing_cells(1), game.losing_cells(2))
+
+    initial = snapshot()
+    for _ in range(100):
+        game.reset_game()
+        snapshots = [snapshot()]
+        for _ in play_random_game(game, rng):
+            snapshots.append(snapshot())
+        snapshots.pop()
+        while snapshots:
+            assert game.unmake_move()
+            assert snapshot() == snapshots.pop()
+        assert not game.unmake_move()
+        assert snapshot() == initial
+        if engine == 'list':
+            assert not any(any(packed) for packed in game.threats.packed[1:])
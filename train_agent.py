@@ -1,68 +1,362 @@
 import copy
+import queue
+import random
 import statistics
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
 import config
-from game.game_logic import HipGameLogic
+from game.game_logic import GAME_ENGINES
+from game.encoding import state_rep_size
+from ai.metrics import TrainingMetrics, StepProfiler
 from ai.agent import DQNAgent
+from ai.checkpoint import Checkpointer, is_checkpoint_directory, load_checkpoint
+from game.tablebase import load_tablebase
+from game.records import open_game_records, game_moves
 from collections import deque
 
 
-def run_training_session(agent, num_episodes=None, load_model_from='', save_model_to=''):
-    game = HipGameLogic(board_size_x=agent.BOARD_SIZE_X, board_size_y=agent.BOARD_SIZE_Y)
-
+def load_pretrained_model(agent, load_model_from):
+    # A checkpoint directory (see ai/checkpoint.py) restores the whole training state, and the extra state
+    # of the training loop saved with it is returned. A model file only loads the weights.
+    if load_model_from and is_checkpoint_directory(load_model_from):
+        extra = load_checkpoint(agent, load_model_from)
+        print(f'Resuming from checkpoint {load_model_from} after {agent.games_played} games.')
+        return extra
     if load_model_from:
         try:
             agent.model.load(load_model_from)
             print(f'Loaded a pre-trained model {load_model_from}.')
         except FileNotFoundError:
             print(f'Could not load model {load_model_from}. Starting from scratch.')
+    return None
+
+def save_training_state(checkpointer, agent, save_model_to, losers, game_length, env_steps):
+    # Every SAVE_EVERY games: the weights to save_model_to and, if CHECKPOINT_DIR is set, a full checkpoint.
+    # Both are written in the background. env_steps is kept for the learner schedule of the resumed session.
+    if save_model_to:
+        checkpointer.save_weights(agent.model, save_model_to)
+    if config.CHECKPOINT_DIR:
+        checkpointer.save(agent, config.CHECKPOINT_DIR, {'losers': list(losers), 'game_length': list(game_length),
+                                                         'env_steps': env_steps})
+
+def set_torch_threads():
+    # The thread pools of the training process, if set in config. The interop pool can only be sized
+    # before its first use, so a second session in the same process keeps the first setting.
+    if config.TORCH_NUM_THREADS:
+        torch.set_num_threads(config.TORCH_NUM_THREADS)
+    if config.TORCH_INTEROP_THREADS:
+        try:
+            torch.set_num_interop_threads(config.TORCH_INTEROP_THREADS)
+        except RuntimeError:
+            pass
+
+def reached_game_length(game_length, target_game_length):
+    # The stopping condition on the rolling mean game length, once the window is full.
+    return (target_game_length and len(game_length) == game_length.maxlen
+            and statistics.mean(game_length) >= target_game_length)
+
+def tablebase_outcome(tablebase, next_state):
+    # With a tablebase holding the position after the move, the transition is terminal: next_state with the end
+    # of the game in perfect play (for the reward function) and done. The game itself goes on.
+    player_lost = tablebase.outcome(next_state) if tablebase is not None else None
+    if player_lost is None:
+        return next_state, False
+    outcome_state = copy.copy(next_state)
+    outcome_state.player_lost = player_lost
+    return outcome_state, True
+
+# The player names in the game records of the self-play sessions: the agent plays both sides.
+SELF_PLAY_PLAYERS = ('DQN self-play',)
+
+def print_progress(agent, losers, game_length, *extra):
+    print (f'Games played: {agent.games_played}',
+           f'epsilon: {agent.epsilon:.2f}',
+           f'P1 losing ratio: {losers.count(1) / len(losers):.2f}',
+           f'P2 losing ratio: {losers.count(2) / len(losers):.2f}',
+           f'Mean game length: {statistics.mean(game_length):.2f}',
+           *extra)
+
+def run_training_session(agent, num_episodes=None, load_model_from='', save_model_to='', target_game_length=None):
+    # Stops after num_episodes games in total, or once the rolling mean game length reaches target_game_length.
+    # Returns the rolling game lengths (a deque of the last ROLLING_AVG_WINDOW games) and the env steps made.
+    set_torch_threads()
+    game = GAME_ENGINES[config.GAME_ENGINE](board_size_x=agent.BOARD_SIZE_X, board_size_y=agent.BOARD_SIZE_Y)
+    resumed = load_pretrained_model(agent, load_model_from) or {}
+    checkpointer = Checkpointer(config.CHECKPOINT_KEEP)
+    tablebase = load_tablebase(config.TABLEBASE_FILE, agent.BOARD_SIZE_X, agent.BOARD_SIZE_Y)
+    records = open_game_records(config.GAME_RECORDS_FILE, agent.BOARD_SIZE_X, agent.BOARD_SIZE_Y, SELF_PLAY_PLAYERS)
 
     # For progess-tracking purposes.
-    losers = deque(maxlen=config.ROLLING_AVG_WINDOW)
-    game_length = deque(maxlen=config.ROLLING_AVG_WINDOW)
+    losers = deque(resumed.get('losers', ()), maxlen=config.ROLLING_AVG_WINDOW)
+    game_length = deque(resumed.get('game_length', ()), maxlen=config.ROLLING_AVG_WINDOW)
+
+    # The state reps are written into two preallocated buffers, swapped after each move:
+    # the next state of a move is the state of the following one.
+    state_rep = np.empty(state_rep_size(agent.BOARD_SIZE_X, agent.BOARD_SIZE_Y), dtype=np.float32)
+    next_state_rep = np.empty_like(state_rep)
+    state = game.get_state()
+    state.get_state_rep(state_rep)
+
+    # Phase timings and the other metrics go to config.METRICS_FILE, if set, every METRICS_EVERY games.
+    metrics = TrainingMetrics(agent, ('select_action', 'make_move', 'get_state_rep', 'reward', 'replay_append',
+                                      'replay_sample', 'train_step', 'update_priorities'), config.METRICS_FILE)
+    # The learner schedule (train_on_schedule) goes on in the phase of the checkpoint resumed from, if any.
+    metrics.env_steps = metrics.last_env_steps = resumed.get('env_steps', 0)
+    timer = agent.timer
+    profiler = StepProfiler(config.PROFILE, config.PROFILE_STEPS, config.PROFILE_OUTPUT)
 
     while True:
         # A training cycle: 
         # get state -> get action -> perform action -> memorize the outcome -> train on a batch
-        state = game.get_state()
-        state_rep = state.get_state_rep()
-        action = agent.select_action(state_rep)        
+        t = time.perf_counter()
+        avoid = agent.get_losing_actions_mask(game) if config.AVOID_LOSING_MOVES else None
+        action = agent.select_action(state_rep, avoid)        
+        t = timer.lap('select_action', t)
         if action == None:
             raise Exception(f'No valid action found for player {state.current_player}.')
         else:
             x, y = action
             action_rep = y * agent.BOARD_SIZE_X + x
             game.make_move(game.current_player, (x, y))
-            next_state_rep = game.get_state().get_state_rep()
+            t = timer.lap('make_move', t)
+            next_state = game.get_state()
+            next_state.get_state_rep(next_state_rep)
+            t = timer.lap('get_state_rep', t)
             done = game.player_lost != None 
         
-        reward = agent.reward_function(state, game.get_state(), action)
-        agent.memory.append((state_rep, action_rep, reward, next_state_rep, done))
+        # The transition ends the game for the learner if the tablebase knows how it ends.
+        outcome_state, terminal = (next_state, True) if done else tablebase_outcome(tablebase, next_state)
+        reward = agent.reward_function(state, outcome_state, action)
+        t = timer.lap('reward', t)
+        agent.memory.append((state_rep, action_rep, reward, next_state_rep, terminal))
+        timer.lap('replay_append', t)
+        state, state_rep, next_state_rep = next_state, next_state_rep, state_rep
 
-        agent.train()
+        metrics.env_steps += 1
+        metrics.add_loss(agent.train_on_schedule(metrics.env_steps))
+        profiler.step()
 
         if done:
             agent.games_played += 1            
-            agent.epsilon = max(agent.epsilon_end, 
-                                agent.epsilon_start - (agent.games_played / agent.epsilon_decay_games) * (agent.epsilon_start - agent.epsilon_end))
+            agent.update_epsilon()
 
             losers.append(game.player_lost)
             game_length.append(game.moves_count)
+            if records is not None:
+                records.write_game(game_moves(game), game.player_lost, (0, 0))
+
+            if not agent.games_played % config.METRICS_EVERY:
+                metrics.report(losers, game_length)
 
             if not agent.games_played % config.ROLLING_AVG_WINDOW:
-                print (f'Games played: {agent.games_played}',
-                       f'epsilon: {agent.epsilon:.2f}',
-                       f'P1 losing ratio: {losers.count(1) / len(losers):.2f}',
-                       f'P2 losing ratio: {losers.count(2) / len(losers):.2f}',
-                       f'Mean game length: {statistics.mean(game_length):.2f}')
+                print_progress(agent, losers, game_length)
                 
-            if not agent.games_played % config.SAVE_EVERY and save_model_to:
-                agent.model.save(save_model_to)
+            if not agent.games_played % config.SAVE_EVERY:
+                save_training_state(checkpointer, agent, save_model_to, losers, game_length, metrics.env_steps)
             
-            if num_episodes and agent.games_played >= num_episodes:
+            if (num_episodes and agent.games_played >= num_episodes
+                    or reached_game_length(game_length, target_game_length)):
                 break
             game.reset_game()
+            state = game.get_state()
+            state.get_state_rep(state_rep)
+
+    profiler.stop()
+    metrics.close()
+    checkpointer.close()
+    if records is not None:
+        records.close()
+    print (f'Training finished after {agent.games_played} episodes.')
+    return game_length, metrics.env_steps
+
+
+# Actor/learner training: the actor processes play self-play games with a copy of the model
+# and send the games to the learner, which owns the replay memory and the QTrainer.
+def run_actor(shared_model, model_lock, weights_version, epsilon, stop_event, games_queue, reward_function):
+    torch.set_num_threads(1)
+    # The forked actors would otherwise share the parent's random state.
+    random.seed()
+    np.random.seed()
+
+    agent = DQNAgent(config, reward_function=reward_function)
+    game = GAME_ENGINES[config.GAME_ENGINE](board_size_x=agent.BOARD_SIZE_X, board_size_y=agent.BOARD_SIZE_Y)
+    version = None
+    num_cells = agent.BOARD_SIZE_X * agent.BOARD_SIZE_Y
+    reps = np.empty((num_cells + 1, state_rep_size(agent.BOARD_SIZE_X, agent.BOARD_SIZE_Y)), dtype=np.float32)
+
+    while not stop_event.is_set():
+        # Refresh the weights (if the learner has published new ones) and epsilon between the games.
+        if version != weights_version.value:
+            with model_lock:
+                version = weights_version.value
+                agent.model.load_state_dict(shared_model.state_dict())
+        agent.epsilon = epsilon.value
+
+        # reps[t] is the state before move t, so the next state reps of the game are reps[1:].
+        game.get_state().get_state_rep(reps[0])
+        actions, rewards = [], []
+        while game.player_lost == None:
+            state = game.get_state()
+            avoid = agent.get_losing_actions_mask(game) if config.AVOID_LOSING_MOVES else None
+            action = agent.select_action(reps[game.moves_count], avoid)
+            if action == None:
+                raise Exception(f'No valid action found for player {state.current_player}.')
+            x, y = action
+            game.make_move(game.current_player, (x, y))
+            next_state = game.get_state()
+            next_state.get_state_rep(reps[game.moves_count])
+
+            actions.append(y * agent.BOARD_SIZE_X + x)
+            rewards.append(agent.reward_function(state, next_state, action))
+
+        # A copy: the queue pickles in a background thread, after reps may have been overwritten.
+        games_queue.put((reps[:game.moves_count + 1].copy(), np.array(actions), np.array(rewards, dtype=np.float32),
+                         game.player_lost, game.moves_count))
+        game.reset_game()
 
+def run_parallel_training_session(agent, num_actors=None, num_episodes=None, load_model_from='', save_model_to='',
+                                  target_game_length=None):
+    # Stops and returns as run_training_session.
+    num_actors = num_actors or config.NUM_ACTORS
+    set_torch_threads()
+    resumed = load_pretrained_model(agent, load_model_from) or {}
+    checkpointer = Checkpointer(config.CHECKPOINT_KEEP)
+    records = open_game_records(config.GAME_RECORDS_FILE, agent.BOARD_SIZE_X, agent.BOARD_SIZE_Y, SELF_PLAY_PLAYERS)
+
+    # The actors read the weights from the shared memory, the learner writes them every ACTOR_SYNC_EVERY training steps.
+    shared_model = copy.deepcopy(agent.model).share_memory()
+    model_lock = mp.Lock()
+    weights_version = mp.Value('i', 0)
+    epsilon = mp.Value('d', agent.epsilon)
+    stop_event = mp.Event()
+    games_queue = mp.Queue(maxsize=config.ACTOR_QUEUE_SIZE)
+
+    actors = [mp.Process(target=run_actor, daemon=True,
+                         args=(shared_model, model_lock, weights_version, epsilon, stop_event, 
+                               games_queue, agent.reward_function)) 
+              for _ in range(num_actors)]
+    for actor in actors:
+        actor.start()
+
+    # For progess-tracking purposes. The phases timed are the learner's (the actors are not instrumented).
+    losers = deque(resumed.get('losers', ()), maxlen=config.ROLLING_AVG_WINDOW)
+    game_length = deque(resumed.get('game_length', ()), maxlen=config.ROLLING_AVG_WINDOW)
+    metrics = TrainingMetrics(agent, ('queue_get', 'replay_append', 'replay_sample', 'train_step',
+                                      'update_priorities', 'publish_weights'), config.METRICS_FILE)
+    timer = agent.timer
+    profiler = StepProfiler(config.PROFILE, config.PROFILE_STEPS, config.PROFILE_OUTPUT)
+    start_time = time.perf_counter()
+    # The learner trains at most TRAIN_GRADIENT_STEPS / TRAIN_EVERY steps per env step of this session.
+    start_training_steps = agent.training_steps_count
+    train_ratio = config.TRAIN_GRADIENT_STEPS / config.TRAIN_EVERY
+    def learner_ahead():
+        return agent.training_steps_count - start_training_steps >= metrics.env_steps * train_ratio
+    
+    running = True
+    while running:
+        # Take in all the games finished so far. Block only while there is too little to train on,
+        # or the learner is ahead of its schedule.
+        while True:
+            t = time.perf_counter()
+            try:
+                block = len(agent.memory) < agent.batch_size or learner_ahead()
+                reps, actions, rewards, player_lost, moves_count = games_queue.get(block=block, timeout=1)
+            except queue.Empty:
+                break
+            t = timer.lap('queue_get', t)
+
+            agent.memory.append_batch(reps[:-1], actions, rewards, reps[1:])
+            timer.lap('replay_append', t)
+            metrics.env_steps += len(actions)
+            agent.games_played += 1
+            agent.update_epsilon()
+            epsilon.value = agent.epsilon
+
+            losers.append(player_lost)
+            game_length.append(moves_count)
+            if records is not None:
+                records.write_game(actions.tolist(), player_lost, (0, 0))
+
+            if not agent.games_played % config.METRICS_EVERY:
+                metrics.report(losers, game_length)
+
+            if not agent.games_played % config.ROLLING_AVG_WINDOW:
+                elapsed = time.perf_counter() - start_time
+                print_progress(agent, losers, game_length, 
+                               f'env-steps/sec: {metrics.env_steps / elapsed:.0f}',
+                               f'train-steps/sec: {agent.training_steps_count / elapsed:.0f}')
+                
+            if not agent.games_played % config.SAVE_EVERY:
+                save_training_state(checkpointer, agent, save_model_to, losers, game_length, metrics.env_steps)
+
+            if (num_episodes and agent.games_played >= num_episodes
+                    or reached_game_length(game_length, target_game_length)):
+                running = False
+                break
+
+        if learner_ahead():
+            continue
+        loss = agent.train()
+        metrics.add_loss(loss)
+        profiler.step()
+        if loss is not None and not agent.training_steps_count % config.ACTOR_SYNC_EVERY:
+            t = time.perf_counter()
+            with model_lock:
+                shared_model.load_state_dict(agent.model.state_dict())
+                weights_version.value += 1
+            timer.lap('publish_weights', t)
+
+    # Keep draining the queue, so that no actor is stuck on a put() while shutting down.
+    stop_event.set()
+    while any(actor.is_alive() for actor in actors):
+        try:
+            games_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    for actor in actors:
+        actor.join()
+
+    profiler.stop()
+    metrics.close()
+    checkpointer.close()
+    if records is not None:
+        records.close()
     print (f'Training finished after {agent.games_played} episodes.')
+    return game_length, metrics.env_steps
+
+
+# Offline training: num_steps training steps on batches sampled from the games in a game record file
+# (config.GAME_RECORDS_FILE of earlier sessions, main.run_match or arena.run_tournament), with no games played.
+def run_offline_training(agent, records_filename, num_steps, load_model_from='', save_model_to=''):
+    from ai.offline import GameRecordDataset
+    if agent.prioritized_replay:
+        raise ValueError('The offline training samples uniformly: set PRIORITIZED_REPLAY to False.')
+    set_torch_threads()
+    load_pretrained_model(agent, load_model_from)
+    dataset = GameRecordDataset(records_filename, agent.reward_function, symmetry=agent.replay_symmetry)
+    if (dataset.BOARD_SIZE_X, dataset.BOARD_SIZE_Y) != (agent.BOARD_SIZE_X, agent.BOARD_SIZE_Y):
+        raise ValueError(f'The game records {records_filename} are for a {dataset.BOARD_SIZE_X}x{dataset.BOARD_SIZE_Y} '
+                         f'board.')
+    print(f'{len(dataset)} transitions of {len(dataset.lengths)} games in {records_filename}.')
+    agent.memory = dataset
+    agent.batch_buffers = dataset.new_batch(agent.batch_size)
+
+    losses = []
+    start_time = time.perf_counter()
+    for _ in range(num_steps):
+        loss = agent.train()
+        if loss is None:
+            break # Fewer transitions than a batch.
+        losses.append(loss)
+        if not agent.training_steps_count % config.ROLLING_AVG_WINDOW:
+            print(f'Training steps: {agent.training_steps_count}',
+                  f'mean loss: {statistics.mean(losses[-config.ROLLING_AVG_WINDOW:]):.4f}',
+                  f'train-steps/sec: {len(losses) / (time.perf_counter() - start_time):.0f}')
+    if save_model_to:
+        agent.model.save(save_model_to)
+    print (f'Offline training finished after {agent.training_steps_count} training steps.')
 
 def reward_usual(cur_state, next_state, action):
     if action == None:
@@ -74,15 +368,6 @@ def reward_usual(cur_state, next_state, action):
     return 2 # Encourage continuation.
 
 
-# A throwaway board to use in the cooperative reward calculations.
-class TempBoard: 
-    def __init__(self, board_size_x, board_size_y):
-        self.board = None
-        self.BOARD_SIZE_X = board_size_x
-        self.BOARD_SIZE_Y = board_size_y
-
-temp_board = TempBoard(config.BOARD_SIZE_X, config.BOARD_SIZE_Y)
-
 def reward_cooperative(cur_state, next_state, action):
     if action is None:
         return -10 # Penalty for not coming up with an action (should not happen normally).
@@ -92,10 +377,10 @@ def reward_cooperative(cur_state, next_state, action):
     if next_state.player_lost == cur_state.current_player:
         return -50 # A large penalty for a loss.
     
+    # Would the other player have completed a square on the cell just taken? 
+    # Asked of the game's threat map, which the move does not change for the other player.
     x, y = action    
-    temp_board.board = copy.deepcopy(next_state.board)    
-    temp_board.board[y][x] = next_state.current_player     
-    if HipGameLogic.find_square(temp_board, next_state.current_player):
+    if next_state.threats.completes_square(next_state.current_player, y * config.BOARD_SIZE_X + x):
         return 4 # Reward for covering cells unfavorable for the other player. 
     
     return 3 # Encourage continuation.
@@ -107,6 +392,9 @@ def reward_cooperative(cur_state, next_state, action):
 
 # run_training_session(agent, save_model_to='models/usual_7_by_7.pth')
 
-agent = DQNAgent(config, reward_function=reward_usual, play_mode=False)
+if __name__ == '__main__':
+    agent = DQNAgent(config, reward_function=reward_usual, play_mode=False)
+
+    run_training_session(agent, num_episodes=50_000, save_model_to='models/usual_6_by_6.pth')
 
-run_training_session(agent, num_episodes=50_000, save_model_to='models/usual_6_by_6.pth')
+    # run_parallel_training_session(agent, num_actors=4, num_episodes=50_000, save_model_to='models/usual_6_by_6.pth')